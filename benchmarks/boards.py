@@ -0,0 +1,84 @@
+""" Measures how long darwindb.boards takes to read departure and arrival boards.
+
+Point it at a scratch database using the same environment variables as example.py:
+
+  $ POSTGRES_HOST=... POSTGRES_DB=... POSTGRES_USER=... POSTGRES_PASS=... \\
+        python -m benchmarks.boards [--schedules N] [--days D] [--queries Q] ...
+
+Unless --no-load is given, it first bulk loads --schedules synthetic schedules (see
+benchmarks.workload) spread over --days days. The defaults are about a week of the real
+timetable, or some four million locations, which takes a few minutes. Then it reads --queries
+boards of --window minutes each for random tiplocs and times, and reports the p50 and p99
+latency of reading each board in full, and how many services were on them.
+"""
+from benchmarks.workload import Workload
+from darwindb.boards import Boards
+from darwindb.stores import PostgresConnection, PostgresStore
+
+import argparse
+import datetime
+import os
+import random
+import time
+
+
+def load(store, workload, schedules, chunk_size=2000):
+    start = time.perf_counter()
+    for n in range(0, schedules, chunk_size):
+        with store.batch():
+            store.save_snapshot_schedule_messages([workload.schedule() for _ in range(min(chunk_size, schedules - n))])
+    cursor = store.connection.cursor()
+    cursor.execute("ANALYZE")
+    store.connection.commit()
+    cursor.execute("SELECT count(*) FROM {}".format(store.table_schedule_location_name))
+    print("Loaded {} schedules, {} locations in total, in {:.1f}s".format(
+        schedules, cursor.fetchone()[0], time.perf_counter() - start))
+    store.connection.commit()
+
+
+def measure(board, queries, rng, first_date, days, window):
+    latencies = []
+    services = 0
+    for _ in range(0, queries):
+        tiploc = "TIP{:04d}".format(rng.randrange(5000))
+        start = datetime.datetime.combine(first_date, datetime.time()) + datetime.timedelta(minutes=rng.randrange(days * 24 * 60))
+        t = time.perf_counter()
+        services += len(list(board(tiploc, start, start + datetime.timedelta(minutes=window))))
+        latencies.append(time.perf_counter() - t)
+    latencies.sort()
+    return latencies, services
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the latency of reading departure and arrival boards.")
+    parser.add_argument("--schedules", type=int, default=150000)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--first-date", default="2016-06-01")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--window", type=int, default=60, help="Minutes each board covers.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-load", action="store_true", help="Use the schedules already in the database.")
+    args = parser.parse_args()
+
+    connection_args = dict(host=os.environ["POSTGRES_HOST"],
+                           dbname=os.environ["POSTGRES_DB"],
+                           user=os.environ["POSTGRES_USER"],
+                           password=os.environ["POSTGRES_PASS"])
+    connection = PostgresConnection(**connection_args)
+    connection.connect()
+    store = PostgresStore(connection)
+    store.create_tables()
+
+    first_date = datetime.datetime.strptime(args.first_date, "%Y-%m-%d").date()
+    if not args.no_load:
+        start_dates = [(first_date + datetime.timedelta(days=d)).isoformat() for d in range(0, args.days)]
+        load(store, Workload(seed=args.seed, start_dates=start_dates), args.schedules)
+
+    boards = Boards(connection_args)
+    rng = random.Random(args.seed)
+    print("  {:<12} {:>8} {:>10} {:>10} {:>10}".format("", "boards", "p50 ms", "p99 ms", "services"))
+    for name, board in [("departures", boards.departures), ("arrivals", boards.arrivals)]:
+        latencies, services = measure(board, args.queries, rng, first_date, args.days, args.window)
+        print("  {:<12} {:>8} {:>10.3f} {:>10.3f} {:>10.1f}".format(
+            name, len(latencies), latencies[len(latencies) // 2] * 1000,
+            latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000, services / len(latencies)))
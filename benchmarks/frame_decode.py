@@ -0,0 +1,68 @@
+""" Compares decoding a snapshot frame with json.loads() against darwindb.frames.FrameReader.
+
+  $ python -m benchmarks.frame_decode [capture.gz | schedules]
+
+Uses the largest frame in the capture file if one is given, or otherwise generates a snapshot
+frame with that many schedules (20000 by default) using benchmarks.workload.
+
+Each way of decoding goes through every message in the frame, in the chunks apply_frame() would
+bulk load them in. We report how long that took, and separately, as tracing allocations slows it
+down, the peak memory allocated on top of the frame's bytes.
+"""
+from benchmarks.workload import Workload
+from darwindb.capture import read_capture
+from darwindb.frames import FrameReader, chunked, ijson, orjson
+
+import json
+import sys
+import time
+import tracemalloc
+
+
+keys = ["schedule_messages", "association_messages", "deactivated_messages", "train_status_messages"]
+
+
+def decode_all(data):
+    m = json.loads(data.decode("utf-8"))
+    return sum([len(chunk) for key in keys for chunk in chunked(m[key], 1000)])
+
+
+def decode_streaming(data, backend):
+    m = FrameReader(data, backend)
+    return sum([len(chunk) for key in keys for chunk in chunked(m[key], 1000)])
+
+
+def measure(f, *args):
+    start = time.perf_counter()
+    count = f(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    f(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, elapsed, peak
+
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else "20000"
+    if source.isdigit():
+        workload = Workload(seed=0, snapshot_every=1, snapshot_size=int(source))
+        data = json.dumps(workload.frame()).encode("utf-8")
+    else:
+        data = max([body for _, _, body in read_capture(source)], key=len)
+
+    print("Frame of {:.1f}MB".format(len(data) / 1024 / 1024))
+    candidates = [("json.loads()", decode_all, ()), ("FrameReader (json)", decode_streaming, ("json",))]
+    if orjson is not None:
+        candidates.append(("FrameReader (orjson)", decode_streaming, ("orjson",)))
+    else:
+        print("  orjson is not installed, so skipping its backend.")
+    if ijson is not None:
+        candidates.append(("FrameReader (ijson {})".format(ijson.backend), decode_streaming, ("ijson",)))
+    else:
+        print("  ijson is not installed, so skipping its backend.")
+
+    for name, f, args in candidates:
+        count, elapsed, peak = measure(f, data, *args)
+        print("  {:<32} {:>8} messages {:>8.0f}ms {:>8.1f}MB peak".format(name, count, elapsed * 1000, peak / 1024 / 1024))
@@ -0,0 +1,152 @@
+""" Replays a capture file (see darwindb.capture) through PostgresStore and reports how it went.
+
+Point it at a scratch database using the same environment variables as example.py:
+
+  $ POSTGRES_HOST=... POSTGRES_DB=... POSTGRES_USER=... POSTGRES_PASS=... \\
+        python -m benchmarks.replay capture.gz [speed]
+
+With no speed, frames are replayed as fast as the store can take them. Otherwise they are replayed
+at the pace they were recorded, sped up speed times.
+
+For each message type it reports messages per second of time spent saving them, the p50 and p99
+latency of saving a single message, and database round trips per message. Each frame's commit is
+reported separately. Snapshot schedules are saved in bulk, a chunk at a time, so their latency is
+each chunk's save divided by the number of schedules in it.
+
+Set PROFILE_SLOW_MS to also time every statement with darwindb.profiling, logging the plans of
+any which take longer than that.
+"""
+from benchmarks.round_trips import CountingConnection
+from darwindb.capture import read_capture
+from darwindb.ingest import apply_frame
+from darwindb.profiling import Profiler
+from darwindb.stores import PostgresStore
+
+from contextlib import contextmanager
+
+import json
+import logging
+import os
+import sys
+import time
+
+
+class Stats:
+
+    def __init__(self):
+        self.latencies = []
+        self.round_trips = 0
+
+    def add(self, seconds, round_trips, count=1):
+        self.latencies.extend([seconds / count] * count)
+        self.round_trips += round_trips
+
+    def percentile(self, p):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def timed(connection, stats, f, *args, count=1):
+    before = connection.round_trips
+    start = time.perf_counter()
+    f(*args)
+    stats.add(time.perf_counter() - start, connection.round_trips - before, count)
+
+
+""" Stands in for the store when applying frames, timing each message it's asked to save.
+
+Frames are replayed with darwindb.ingest.apply_frame(), exactly as they're ingested, so this only
+needs to know which of the store's methods save which type of message.
+"""
+class TimedStore:
+
+    stat_names = {
+        "save_snapshot_schedule_messages": "schedule (snapshot)",
+        "save_schedule_message": "schedule",
+        "save_association_message": "association",
+        "save_deactivated_message": "deactivated",
+        "save_train_status_message": "train status",
+    }
+
+    def __init__(self, connection, store, stats):
+        self.connection = connection
+        self.store = store
+        self.stats = stats
+
+    def stat(self, name):
+        if name not in self.stats:
+            self.stats[name] = Stats()
+        return self.stats[name]
+
+    def __getattr__(self, name):
+        f = getattr(self.store, name)
+        if name not in self.stat_names:
+            return f
+
+        def timed_f(*args):
+            # Snapshot schedules are saved in bulk, a chunk at a time.
+            count = len(args[0]) if name == "save_snapshot_schedule_messages" else 1
+            timed(self.connection, self.stat(self.stat_names[name]), f, *args, count=count)
+        return timed_f
+
+    @contextmanager
+    def batch(self):
+        with self.store.batch():
+            yield self
+            # The batch commits as the block exits, so time that from here.
+            before = self.connection.round_trips
+            start = time.perf_counter()
+        self.stat("commit").add(time.perf_counter() - start, self.connection.round_trips - before)
+
+
+def replay(connection, store, path, speed=None):
+    stats = {}
+    frames = 0
+    first = None
+
+    start = time.perf_counter()
+    for recorded, headers, body in read_capture(path):
+        if speed is not None:
+            if first is None:
+                first = recorded
+            delay = (recorded - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        apply_frame(TimedStore(connection, store, stats), json.loads(body.decode("utf-8")))
+        frames += 1
+
+    return frames, time.perf_counter() - start, stats
+
+
+if __name__ == "__main__":
+    path = sys.argv[1]
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    connection = CountingConnection(host=os.environ["POSTGRES_HOST"],
+                                    dbname=os.environ["POSTGRES_DB"],
+                                    user=os.environ["POSTGRES_USER"],
+                                    password=os.environ["POSTGRES_PASS"])
+    connection.connect()
+    profiler = None
+    if "PROFILE_SLOW_MS" in os.environ:
+        logging.basicConfig()
+        profiler = Profiler(slow_seconds=float(os.environ["PROFILE_SLOW_MS"]) / 1000, explain=True)
+    store = PostgresStore(connection, profiler=profiler)
+    store.create_tables()
+
+    frames, elapsed, stats = replay(connection, store, path, speed)
+
+    print("{} frames in {:.2f}s ({:.1f} frames/s, {} round trips)".format(
+        frames, elapsed, frames / elapsed if elapsed else 0, connection.round_trips))
+    print("  {:<20} {:>8} {:>10} {:>10} {:>10} {:>12}".format(
+        "", "count", "msgs/s", "p50 ms", "p99 ms", "round trips"))
+    for name, s in stats.items():
+        total = sum(s.latencies)
+        print("  {:<20} {:>8} {:>10.1f} {:>10.3f} {:>10.3f} {:>12.2f}".format(
+            name, len(s.latencies), len(s.latencies) / total if total else 0,
+            s.percentile(50) * 1000, s.percentile(99) * 1000, s.round_trips / len(s.latencies)))
+    if store.counters:
+        print("  " + ", ".join(["{}: {}".format(k, v) for k, v in sorted(store.counters.items())]))
+    if profiler is not None:
+        print(profiler.report())
@@ -0,0 +1,102 @@
+""" Counts the database round trips PostgresStore makes for each schedule message.
+
+Point it at a scratch database using the same environment variables as example.py:
+
+  $ POSTGRES_HOST=... POSTGRES_DB=... POSTGRES_USER=... POSTGRES_PASS=... \\
+        python -m benchmarks.round_trips [schedules] [locations]
+
+Every call to execute(), executemany() or copy_expert() on a cursor, and every commit, is
+counted as one round trip.
+"""
+from darwindb.stores import PostgresConnection, PostgresStore
+
+import copy
+import os
+import psycopg2.extensions
+import sys
+import time
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+
+    def execute(self, *args, **kwargs):
+        self.counter.round_trips += 1
+        return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.counter.round_trips += 1
+        return super().executemany(*args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        self.counter.round_trips += 1
+        return super().copy_expert(*args, **kwargs)
+
+
+class CountingConnection(PostgresConnection):
+
+    round_trips = 0
+
+    def cursor(self, name=None):
+        cursor = self.conn.cursor(name, cursor_factory=CountingCursor)
+        cursor.counter = self
+        return cursor
+
+    def commit(self):
+        self.round_trips += 1
+        return super().commit()
+
+
+def hhmm(minutes):
+    return "{:02d}:{:02d}".format((minutes // 60) % 24, minutes % 60)
+
+
+def build_schedule(rid, locations):
+    points = [{"location_type": "OR", "tiploc": "ORIGIN", "working_departure_time": hhmm(360)+":30",
+               "public_departure_time": hhmm(360)}]
+    for i in range(1, locations-1):
+        t = 360 + i*3
+        if i % 2 == 0:
+            points.append({"location_type": "PP", "tiploc": "PASS{}".format(i), "working_pass_time": hhmm(t)+":30"})
+        else:
+            points.append({"location_type": "IP", "tiploc": "STOP{}".format(i),
+                           "working_arrival_time": hhmm(t), "public_arrival_time": hhmm(t),
+                           "working_departure_time": hhmm(t+1), "public_departure_time": hhmm(t+1)})
+    t = 360 + (locations-1)*3
+    points.append({"location_type": "DT", "tiploc": "DEST", "working_arrival_time": hhmm(t),
+                   "public_arrival_time": hhmm(t)})
+    return {"rid": rid, "uid": "Z00001", "headcode": "1Z99", "start_date": "2016-06-01", "toc_code": "ZZ",
+            "passenger_service": True, "status": "P", "category": "XX", "active": True, "deleted": False,
+            "charter": False, "locations": points}
+
+
+def measure(connection, store, messages, snapshot):
+    before = connection.round_trips
+    start = time.time()
+    for m in messages:
+        store.save_schedule_message(copy.deepcopy(m), snapshot)
+    elapsed = time.time() - start
+    return (connection.round_trips - before) / len(messages), elapsed / len(messages) * 1000
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    locations = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+
+    connection = CountingConnection(host=os.environ["POSTGRES_HOST"],
+                                    dbname=os.environ["POSTGRES_DB"],
+                                    user=os.environ["POSTGRES_USER"],
+                                    password=os.environ["POSTGRES_PASS"])
+    connection.connect()
+    store = PostgresStore(connection)
+    store.create_tables()
+
+    run = int(time.time())
+    messages = [build_schedule("B{}{:06d}".format(run, i), locations) for i in range(count)]
+
+    # Make sure the queries are prepared before we start counting.
+    store.save_schedule_message(build_schedule("B{}WARMUP".format(run), locations), False)
+
+    print("{} schedules with {} locations each".format(count, locations))
+    for name, snapshot in [("new (live)", False), ("re-sent (live)", False), ("re-sent (snapshot)", True)]:
+        round_trips, ms = measure(connection, store, messages, snapshot)
+        print("  {:<20} {:>6.1f} round trips/schedule {:>8.2f} ms/schedule".format(name, round_trips, ms))
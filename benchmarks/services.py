@@ -0,0 +1,108 @@
+""" Measures how fast darwindb.services looks up whole services, against querying each table in turn.
+
+Point it at a scratch database using the same environment variables as example.py:
+
+  $ POSTGRES_HOST=... POSTGRES_DB=... POSTGRES_USER=... POSTGRES_PASS=... \\
+        python -m benchmarks.services [--schedules N] [--lookups L] [--hot H] ...
+
+Unless --no-load is given, it first loads --schedules synthetic schedules (see benchmarks.workload),
+and an association for every tenth of them. Then it looks up --lookups random services each way:
+with a query for the schedule, its locations and its associations in each direction; with
+Services.service(); and with Services.service() going through its cache, for lookups spread over
+just --hot services. Lookups are made one after another on a connection in autocommit mode, and we
+report how many were made per second, with their p50 and p99 latency.
+"""
+from benchmarks.workload import Workload
+from darwindb.services import Services
+from darwindb.stores import PostgresConnection, PostgresStore
+
+import argparse
+import os
+import random
+import time
+
+
+def load(store, workload, schedules, chunk_size=2000):
+    start = time.perf_counter()
+    for n in range(0, schedules, chunk_size):
+        with store.batch():
+            store.save_snapshot_schedule_messages([workload.new_schedule() for _ in range(min(chunk_size, schedules - n))])
+            for _ in range(0, min(chunk_size, schedules - n) // 10):
+                store.save_association_message(workload.association())
+    cursor = store.connection.cursor()
+    cursor.execute("ANALYZE")
+    store.connection.commit()
+    print("Loaded {} schedules in {:.1f}s".format(schedules, time.perf_counter() - start))
+
+
+def separate_queries(store, connection):
+    cursor = connection.cursor()
+
+    def lookup(rid):
+        cursor.execute("SELECT * FROM {} WHERE rid = %s".format(store.table_schedule_name), (rid,))
+        schedule = cursor.fetchone()
+        cursor.execute("SELECT * FROM {} WHERE rid = %s ORDER BY position".format(store.schedule_location_source), (rid,))
+        locations = cursor.fetchall()
+        cursor.execute("SELECT * FROM {} WHERE main_rid = %s".format(store.table_assoc_name), (rid,))
+        associations = cursor.fetchall()
+        cursor.execute("SELECT * FROM {} WHERE assoc_rid = %s".format(store.table_assoc_name), (rid,))
+        return schedule, locations, associations + cursor.fetchall()
+    return lookup
+
+
+def measure(lookup, rids):
+    latencies = []
+    start = time.perf_counter()
+    for rid in rids:
+        t = time.perf_counter()
+        lookup(rid)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(rids) / elapsed, latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the rate of looking up whole services.")
+    parser.add_argument("--schedules", type=int, default=50000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--hot", type=int, default=1000, help="How many services the cached lookups are spread over.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-load", action="store_true", help="Use the schedules already in the database.")
+    args = parser.parse_args()
+
+    connection_args = dict(host=os.environ["POSTGRES_HOST"],
+                           dbname=os.environ["POSTGRES_DB"],
+                           user=os.environ["POSTGRES_USER"],
+                           password=os.environ["POSTGRES_PASS"])
+    connection = PostgresConnection(**connection_args)
+    connection.connect()
+    store = PostgresStore(connection)
+    store.create_tables()
+    if not args.no_load:
+        load(store, Workload(seed=args.seed), args.schedules)
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT rid FROM {}".format(store.table_schedule_name))
+    all_rids = [r[0] for r in cursor.fetchall()]
+    connection.commit()
+
+    reader = PostgresConnection(**connection_args)
+    reader.connect()
+    reader.set_autocommit(True)
+
+    rng = random.Random(args.seed)
+    rids = [rng.choice(all_rids) for _ in range(0, args.lookups)]
+    hot = rng.sample(all_rids, min(args.hot, len(all_rids)))
+    cached = Services(connection_args, cache_bytes=256*1024*1024)
+
+    print("  {:<24} {:>10} {:>10} {:>10}".format("", "lookups/s", "p50 ms", "p99 ms"))
+    for name, lookup, lookup_rids in [
+            ("separate queries", separate_queries(store, reader), rids),
+            ("service()", Services(connection_args).service, rids),
+            ("service(), cached", cached.service, [rng.choice(hot) for _ in range(0, args.lookups)])]:
+        rate, p50, p99 = measure(lookup, lookup_rids)
+        print("  {:<24} {:>10.0f} {:>10.3f} {:>10.3f}".format(name, rate, p50 * 1000, p99 * 1000))
+    stats = cached.cache.stats()
+    print("  The cache hit {:.1%} of lookups, holding {} services in {:.1f}MB.".format(
+        stats["hits"] / (stats["hits"] + stats["misses"]), stats["entries"], stats["bytes"] / 1024 / 1024))
@@ -0,0 +1,57 @@
+""" Compares the Darwin time parsers in darwindb.utils with dateutil.
+
+  $ python -m benchmarks.time_parsing
+
+Checks that both give the same results for every time Darwin can send, then times parsing on
+its own and as part of build_sanitised_times() on a 60 location schedule.
+"""
+from benchmarks.round_trips import build_schedule
+from darwindb.stores import PostgresStore
+from darwindb.utils import parse_darwin_date, parse_darwin_time
+
+import copy
+import sys
+import timeit
+
+from dateutil.parser import parse
+
+
+def dateutil_time(s):
+    return parse(s).time()
+
+
+def dateutil_date(s):
+    return parse(s).date()
+
+
+if __name__ == "__main__":
+    times = ["{:02d}:{:02d}".format(h, m) for h in range(24) for m in range(60)]
+    times += [t + ":30" for t in times]
+    dates = ["2016-{:02d}-{:02d}".format(m, d) for m in range(1, 13) for d in range(1, 29)]
+
+    for t in times:
+        assert parse_darwin_time(t) == dateutil_time(t), t
+    for d in dates:
+        assert parse_darwin_date(d) == dateutil_date(d), d
+    print("Checked {} times and {} dates against dateutil.".format(len(times), len(dates)))
+
+    number = 20000
+    sample = times[::len(times) // 100]
+    for name, f in [("dateutil", dateutil_time),
+                    ("parse_darwin_time (no memo)", parse_darwin_time.__wrapped__),
+                    ("parse_darwin_time", parse_darwin_time)]:
+        elapsed = timeit.timeit(lambda: [f(t) for t in sample], number=number // len(sample))
+        print("  {:<30} {:>8.2f} us/time".format(name, elapsed / number * 1000000))
+
+    # The stores package shadows the PostgresStore module with the class of the same name.
+    postgres_store = sys.modules["darwindb.stores.PostgresStore"]
+    store = PostgresStore(None)
+    schedule = build_schedule("201606010000001", 60)
+    messages = [copy.deepcopy(schedule) for _ in range(200)]
+    for name, time_parser, date_parser in [("dateutil", dateutil_time, dateutil_date),
+                                           ("parse_darwin_*", parse_darwin_time, parse_darwin_date)]:
+        postgres_store.parse_darwin_time = time_parser
+        postgres_store.parse_darwin_date = date_parser
+        batch = copy.deepcopy(messages)
+        elapsed = timeit.timeit(lambda: store.build_sanitised_times(batch.pop()), number=len(messages))
+        print("  build_sanitised_times with {:<16} {:>8.2f} ms/schedule".format(name, elapsed / len(messages) * 1000))
@@ -0,0 +1,26 @@
+""" Times the table-driven timezone functions in darwindb.utils against the pytz versions.
+
+  $ python -m benchmarks.timezones
+
+That both give identical results is checked by tests/test_utils.py.
+"""
+from darwindb.utils import apply_date_and_tz_to_time, pytz_apply_date_and_tz_to_time
+from darwindb.utils import timezone_for_date_and_time, pytz_timezone_for_date_and_time
+
+from datetime import datetime, time
+
+import pytz
+import timeit
+
+
+if __name__ == "__main__":
+    day = datetime(2016, 3, 27).date()
+    dated_time = datetime(2016, 3, 26, 23, 30, tzinfo=pytz.utc)
+    tz = pytz.timezone("Etc/GMT-1")
+    number = 50000
+    for name, f in [("timezone_for_date_and_time", lambda: timezone_for_date_and_time(day, time(0, 30))),
+                    ("pytz_timezone_for_date_and_time", lambda: pytz_timezone_for_date_and_time(day, time(0, 30))),
+                    ("apply_date_and_tz_to_time", lambda: apply_date_and_tz_to_time(dated_time, tz, time(23, 30), time(0, 30))),
+                    ("pytz_apply_date_and_tz_to_time", lambda: pytz_apply_date_and_tz_to_time(dated_time, tz, time(23, 30), time(0, 30)))]:
+        elapsed = timeit.timeit(f, number=number)
+        print("  {:<32} {:>8.2f} us/call".format(name, elapsed / number * 1000000))
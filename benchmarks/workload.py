@@ -0,0 +1,238 @@
+""" Generates synthetic Push Port traffic, for load testing the store without a live feed.
+
+  $ python -m benchmarks.workload capture.gz [--frames N] [--seed S] [--scale X] ...
+
+The frames are written to a capture file (see darwindb.capture), in the same shape as
+example.Listener.on_message consumes, ready to be replayed with benchmarks.replay. Run with --help
+to see the options for the shape and rate of the traffic.
+
+Everything is drawn from a random number generator seeded with --seed, so the same options always
+produce the same capture.
+"""
+from darwindb.capture import CaptureWriter
+
+import argparse
+import datetime
+import json
+import random
+
+
+def hhmm(minutes):
+    return "{:02d}:{:02d}".format((minutes // 60) % 24, minutes % 60)
+
+
+def hhmmss(minutes):
+    return hhmm(minutes) + ":30"
+
+
+""" Produces frames of synthetic messages.
+
+Schedules are generated for the given start dates, which by default include both summer time
+changes, and can be made to run through midnight or to have very many locations. Train status,
+association and deactivation messages only ever refer to schedules which have already been sent.
+
+Message counts per frame are averages; the actual number in each frame is drawn at random around
+them. Every snapshot_every frames a snapshot frame is sent instead, re-sending snapshot_size
+schedules, most of which we have already seen.
+"""
+class Workload:
+
+    def __init__(self, seed=0, start_dates=("2016-03-26", "2016-03-27", "2016-06-01", "2016-10-30"),
+                 schedules_per_frame=0.5, train_statuses_per_frame=8, associations_per_frame=0.05,
+                 deactivations_per_frame=0.05, min_locations=4, max_locations=40, long_fraction=0.02,
+                 long_locations=250, midnight_fraction=0.1, snapshot_every=0, snapshot_size=2000,
+                 max_delay=20):
+        self.rng = random.Random(seed)
+        self.start_dates = start_dates
+        self.schedules_per_frame = schedules_per_frame
+        self.train_statuses_per_frame = train_statuses_per_frame
+        self.associations_per_frame = associations_per_frame
+        self.deactivations_per_frame = deactivations_per_frame
+        self.min_locations = min_locations
+        self.max_locations = max_locations
+        self.long_fraction = long_fraction
+        self.long_locations = long_locations
+        self.midnight_fraction = midnight_fraction
+        self.snapshot_every = snapshot_every
+        self.snapshot_size = snapshot_size
+        self.max_delay = max_delay
+
+        # Schedules sent so far, and how far along its journey each train has got.
+        self.schedules = {}
+        self.progress = {}
+        self.rids = []
+        self.next_rid = 0
+        self.frame_count = 0
+
+    """ Draws how many messages to put in a frame, averaging out at rate. """
+    def count(self, rate):
+        n = int(rate)
+        if self.rng.random() < rate - n:
+            n += 1
+        return n if n == 0 else self.rng.randint(0, 2 * n)
+
+    def schedule(self):
+        start_date = self.rng.choice(self.start_dates)
+        rid = start_date.replace("-", "") + "{:07d}".format(self.next_rid)
+        self.next_rid += 1
+
+        if self.rng.random() < self.long_fraction:
+            n = self.long_locations
+        else:
+            n = self.rng.randint(self.min_locations, self.max_locations)
+        # Keep even the longest schedules to well under a day.
+        step = self.rng.randint(2, max(2, min(6, 18*60 // n)))
+
+        if self.rng.random() < self.midnight_fraction:
+            # Start shortly enough before midnight that the journey runs through it.
+            t = 24*60 - self.rng.randint(1, max(1, n * step - 1))
+        else:
+            t = self.rng.randint(5*60, 24*60 - n * step) if n * step < 19*60 else self.rng.randint(0, 5*60)
+
+        locations = []
+        for i in range(0, n):
+            tiploc = "TIP{:04d}".format(self.rng.randrange(5000))
+            if i == 0:
+                locations.append({"location_type": "OR", "tiploc": tiploc, "activity_codes": "TB",
+                                  "working_departure_time": hhmmss(t), "public_departure_time": hhmm(t)})
+            elif i == n - 1:
+                locations.append({"location_type": "DT", "tiploc": tiploc, "activity_codes": "TF",
+                                  "working_arrival_time": hhmm(t), "public_arrival_time": hhmm(t)})
+            elif self.rng.random() < 0.4:
+                locations.append({"location_type": "PP", "tiploc": tiploc, "working_pass_time": hhmmss(t)})
+            else:
+                locations.append({"location_type": "IP", "tiploc": tiploc, "activity_codes": "T",
+                                  "working_arrival_time": hhmm(t), "public_arrival_time": hhmm(t),
+                                  "working_departure_time": hhmm(t + 1), "public_departure_time": hhmm(t + 1)})
+            t += step
+
+        return {"rid": rid, "uid": "Y{:05d}".format(self.next_rid % 100000),
+                "headcode": "{}{}{:02d}".format(self.rng.randint(1, 9), self.rng.choice("ABCDEFGHJKLMNPRSTUVWXYZ"), self.rng.randrange(100)),
+                "start_date": start_date, "toc_code": self.rng.choice(["GW", "VT", "SW", "XC", "LM"]),
+                "passenger_service": True, "status": "P", "category": "OO", "active": True, "deleted": False,
+                "charter": False, "locations": locations}
+
+    def new_schedule(self):
+        s = self.schedule()
+        self.schedules[s["rid"]] = s
+        self.progress[s["rid"]] = 0
+        self.rids.append(s["rid"])
+        return s
+
+    """ A train status message for the next few locations of a train we've already sent. """
+    def train_status(self):
+        rid = self.rng.choice(self.rids)
+        s = self.schedules[rid]
+        first = self.progress[rid]
+        last = min(len(s["locations"]), first + self.rng.randint(1, 4))
+        self.progress[rid] = last if last < len(s["locations"]) else 0
+        delay = self.rng.randint(-2, self.max_delay)
+
+        locations = []
+        for i, l in enumerate(s["locations"][first:last], first):
+            m = {"tiploc": l["tiploc"]}
+            for key in ["working_arrival_time", "working_pass_time", "working_departure_time",
+                        "public_arrival_time", "public_departure_time"]:
+                if key in l:
+                    m[key] = l[key]
+            for kind, key in [("arrival", "working_arrival_time"), ("pass", "working_pass_time"),
+                              ("departure", "working_departure_time")]:
+                if key in l:
+                    hh, mm = l[key][:5].split(":")
+                    t = int(hh)*60 + int(mm) + delay
+                    m[kind] = {"estimated_time": hhmm(t), "working_estimated_time": hhmm(t), "source": "Darwin"}
+                    if i < last - 1:
+                        m[kind]["actual_time"] = hhmm(t)
+                        m[kind]["actual_time_removed"] = False
+            if "working_pass_time" not in l:
+                m["platform"] = {"number": str(self.rng.randint(1, 12)), "confirmed": self.rng.random() < 0.5,
+                                 "source": "P"}
+            locations.append(m)
+
+        return {"rid": rid, "reverse_formation": False, "locations": locations}
+
+    def association(self):
+        main, other = self.rng.choice(self.rids), self.rng.choice(self.rids)
+        l = self.rng.choice(self.schedules[main]["locations"])
+        return {"tiploc": l["tiploc"], "category": self.rng.choice(["JJ", "VV", "NP"]), "deleted": False,
+                "main_service": {"rid": main, "working_arrival_time": l.get("working_arrival_time", None)},
+                "associated_service": {"rid": other, "working_departure_time": l.get("working_departure_time", None)}}
+
+    def deactivation(self):
+        rid = self.rids.pop(self.rng.randrange(len(self.rids)))
+        del self.progress[rid]
+        return {"rid": rid}
+
+    def frame(self):
+        self.frame_count += 1
+
+        if self.snapshot_every and self.frame_count % self.snapshot_every == 0:
+            known = self.rng.sample(self.rids, min(len(self.rids), self.snapshot_size * 9 // 10))
+            schedules = [self.schedules[rid] for rid in known]
+            schedules += [self.new_schedule() for _ in range(0, self.snapshot_size - len(schedules))]
+            return {"message_type": "snapshot", "schedule_messages": schedules, "association_messages": [],
+                    "deactivated_messages": [], "train_status_messages": []}
+
+        m = {"message_type": "live", "schedule_messages": [], "association_messages": [],
+             "deactivated_messages": [], "train_status_messages": []}
+        for _ in range(0, self.count(self.schedules_per_frame) or (0 if self.rids else 1)):
+            m["schedule_messages"].append(self.new_schedule())
+        if self.rids:
+            for _ in range(0, self.count(self.associations_per_frame)):
+                m["association_messages"].append(self.association())
+            for _ in range(0, self.count(self.train_statuses_per_frame)):
+                m["train_status_messages"].append(self.train_status())
+            # Always keep at least one train running.
+            for _ in range(0, min(len(self.rids) - 1, self.count(self.deactivations_per_frame))):
+                m["deactivated_messages"].append(self.deactivation())
+        return m
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a capture file of synthetic Push Port traffic.")
+    parser.add_argument("path")
+    parser.add_argument("--frames", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--frames-per-second", type=float, default=2.0,
+                        help="The rate frames are timestamped at, which benchmarks.replay paces itself by.")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiplies the frame rate, e.g. 10 for ten times today's traffic.")
+    parser.add_argument("--schedules-per-frame", type=float, default=0.5)
+    parser.add_argument("--train-statuses-per-frame", type=float, default=8)
+    parser.add_argument("--associations-per-frame", type=float, default=0.05)
+    parser.add_argument("--deactivations-per-frame", type=float, default=0.05)
+    parser.add_argument("--min-locations", type=int, default=4)
+    parser.add_argument("--max-locations", type=int, default=40)
+    parser.add_argument("--long-fraction", type=float, default=0.02)
+    parser.add_argument("--long-locations", type=int, default=250)
+    parser.add_argument("--midnight-fraction", type=float, default=0.1)
+    parser.add_argument("--snapshot-every", type=int, default=0)
+    parser.add_argument("--snapshot-size", type=int, default=2000)
+    args = parser.parse_args()
+
+    workload = Workload(seed=args.seed,
+                        schedules_per_frame=args.schedules_per_frame,
+                        train_statuses_per_frame=args.train_statuses_per_frame,
+                        associations_per_frame=args.associations_per_frame,
+                        deactivations_per_frame=args.deactivations_per_frame,
+                        min_locations=args.min_locations,
+                        max_locations=args.max_locations,
+                        long_fraction=args.long_fraction,
+                        long_locations=args.long_locations,
+                        midnight_fraction=args.midnight_fraction,
+                        snapshot_every=args.snapshot_every,
+                        snapshot_size=args.snapshot_size)
+
+    writer = CaptureWriter(args.path)
+    start = datetime.datetime(2016, 6, 1).timestamp()
+    interval = 1.0 / (args.frames_per_second * args.scale)
+    messages = 0
+    for n in range(0, args.frames):
+        m = workload.frame()
+        messages += sum([len(v) for k, v in m.items() if k != "message_type"])
+        writer.write(start + n * interval, {"message-id": "synthetic-{}".format(n), "subscription": "1"},
+                     json.dumps(m).encode("utf-8"))
+    writer.close()
+
+    print("Wrote {} frames with {} messages ({:.0f} messages/s at the recorded pace).".format(
+        args.frames, messages, messages / (args.frames * interval)))
@@ -1 +1,11 @@
 from darwindb.client import Client
+from darwindb.ingest import ShardedIngest
+from darwindb.boards import Boards
+from darwindb.services import Services
+
+import sys
+
+# The asyncio variant needs Python 3.7+, but the rest still runs on 3.4.
+if sys.version_info >= (3, 7):
+    from darwindb.async_client import AsyncClient
+    from darwindb.stores.AsyncPostgresStore import Store as AsyncPostgresStore
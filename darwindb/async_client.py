@@ -0,0 +1,271 @@
+from darwindb.metrics import Metrics
+
+import asyncio
+import time
+
+import logging
+log = logging.getLogger("darwindb")
+
+
+def escape_header(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(":", "\\c")
+
+
+def unescape_header(value):
+    out = []
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == "\\" and i + 1 < len(value):
+            out.append({"n": "\n", "c": ":", "\\": "\\", "r": "\r"}.get(value[i+1], value[i+1]))
+            i += 2
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out)
+
+
+""" An asyncio STOMP 1.1 consumer, for use with an async listener and the AsyncPostgresStore.
+
+The listener's on_message(headers, body) coroutine is run as its own task for each frame, with up
+to max_in_flight frames being processed at once. Tasks are created in the order frames arrive, so
+a store which routes work as soon as it's called (as AsyncPostgresStore does) still sees every
+train's messages in order. Once max_in_flight frames are outstanding, nothing more is read from
+the socket until one completes.
+
+As with Client, the listener calls ack() once a frame has been committed, and the client only
+sends a cumulative ack for the newest frame with every frame before it committed too, holding it
+back for up to ack_every frames or max_ack_delay seconds.
+
+Also as with Client, if the listener raises, or a frame goes ack_timeout seconds without being
+committed, the client drops the connection. run() then waits for the frames still in flight to
+finish, which they should do quickly, as AsyncPostgresStore refuses any more work once part of a
+frame has failed. It then reconnects, and the broker redelivers everything from that frame on.
+"""
+class AsyncClient:
+
+    def __init__(self, listener, max_in_flight=16, prefetch=None, ack_every=1, max_ack_delay=1, ack_timeout=600,
+                 max_frame_bytes=256*1024*1024, metrics=None):
+        self.cb = listener
+        self.metrics = metrics or Metrics()
+        self.max_frame_bytes = max_frame_bytes
+        self.max_in_flight = max_in_flight
+        self.prefetch = prefetch
+        self.ack_every = ack_every
+        self.max_ack_delay = max_ack_delay
+        self.ack_timeout = ack_timeout
+
+        self.reader = None
+        self.writer = None
+
+        # Frames received but not acked yet: seq -> [headers, committed, when received], and
+        # message-id -> seq. unsent is the newest committed frame whose ack is being held back.
+        self.frames = {}
+        self.seqs = {}
+        self.next_seq = 0
+        self.next_ack_seq = 0
+        self.unsent = None
+        self.unsent_since = None
+        self.unsent_acks = 0
+
+        # Why the connection is being dropped to have frames redelivered, or None if it isn't.
+        self.failed = None
+
+    async def connect(self, server, port, user, password, queue):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.destination = queue
+        await self.open()
+
+    async def open(self):
+        log.debug("AsyncStompClient.connect()")
+
+        # Snapshot frames can be far larger than the default 64KiB limit on lines.
+        self.reader, self.writer = await asyncio.open_connection(self.server, self.port, limit=self.max_frame_bytes)
+        await self.send("CONNECT", {"accept-version": "1.1", "host": self.server, "login": self.user,
+                                    "passcode": self.password, "heart-beat": "0,0"})
+
+        frame = await self.read_frame()
+        if frame is None or frame[0] != "CONNECTED":
+            raise ConnectionError("Could not connect to STOMP server: {}".format(frame))
+        command, headers, body = frame
+
+        # Anything we hadn't acked will be redelivered, so stop waiting for it.
+        self.frames.clear()
+        self.seqs.clear()
+        self.next_ack_seq = self.next_seq
+        self.unsent = None
+        self.unsent_since = None
+        self.unsent_acks = 0
+        self.failed = None
+
+        subscribe = {"destination": self.destination, "id": "1", "ack": "client"}
+        if self.prefetch is not None:
+            subscribe["activemq.prefetchSize"] = self.prefetch
+        await self.send("SUBSCRIBE", subscribe)
+
+        if hasattr(self.cb, "on_connected"):
+            await self.cb.on_connected(headers, body)
+
+    """ Hands frames to the listener until the broker closes the connection, reconnecting after any failure. """
+    async def run(self):
+        while True:
+            await self.receive()
+            if self.failed is None:
+                break
+            log.error("AsyncStompClient: reconnecting, as {}".format(self.failed))
+
+            delay = 1
+            while True:
+                try:
+                    await self.open()
+                    break
+                except Exception:
+                    log.exception("AsyncStompClient: failed to reconnect, trying again in {}s".format(delay))
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60)
+
+    """ Reads frames and hands them to the listener until the connection is closed. """
+    async def receive(self):
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        watchdog = asyncio.ensure_future(self.watch())
+
+        try:
+            while True:
+                frame = await self.read_frame()
+                # Frames still buffered once we've given up on the connection will be redelivered.
+                if frame is None or self.failed is not None:
+                    break
+                command, headers, body = frame
+
+                if command == "ERROR":
+                    log.debug("AsyncStompClient.onError(headers={}, message={})".format(headers, body))
+                    if hasattr(self.cb, "on_error"):
+                        await self.cb.on_error(headers, body)
+                    continue
+                if command != "MESSAGE":
+                    continue
+
+                log.debug("AsyncStompClient.onMessage(headers={}, body=<truncated>)".format(headers))
+                self.frames[self.next_seq] = [headers, False, time.monotonic()]
+                self.seqs[headers["message-id"]] = self.next_seq
+                self.next_seq += 1
+
+                await in_flight.acquire()
+                task = asyncio.ensure_future(self.cb.on_message(headers, body))
+                tasks.add(task)
+                task.add_done_callback(lambda t, headers=headers: self.on_done(t, headers, in_flight, tasks))
+        finally:
+            watchdog.cancel()
+
+        if tasks:
+            await asyncio.wait(tasks)
+
+        if hasattr(self.cb, "on_disconnected"):
+            await self.cb.on_disconnected()
+
+    def on_done(self, task, headers, in_flight, tasks):
+        tasks.discard(task)
+        in_flight.release()
+        if not task.cancelled() and task.exception() is not None:
+            log.error("AsyncStompClient: listener failed on message {}".format(headers["message-id"]),
+                      exc_info=task.exception())
+            self.fail("the listener failed on message {}".format(headers["message-id"]))
+
+    """ Drops the connection, so the broker redelivers every frame we haven't acked (see run()). """
+    def fail(self, reason):
+        if self.failed is not None:
+            return
+        self.failed = reason
+        self.writer.close()
+
+    """ Sends any ack held back for max_ack_delay, and drops the connection if a frame's gone ack_timeout uncommitted. """
+    async def watch(self):
+        while True:
+            await asyncio.sleep(max(0.01, min(1, self.max_ack_delay)))
+            if self.failed is not None:
+                continue
+            now = time.monotonic()
+            if self.unsent is not None and now - self.unsent_since >= self.max_ack_delay:
+                await self.send_ack()
+            oldest = self.frames.get(self.next_ack_seq, None)
+            if self.ack_timeout is not None and oldest is not None and now - oldest[2] >= self.ack_timeout:
+                self.fail("message {} wasn't committed within {}s".format(oldest[0]["message-id"], self.ack_timeout))
+
+    async def disconnect(self):
+        await self.send("DISCONNECT", {})
+        self.writer.close()
+
+    # Acks are cumulative, so this records that the frame has been committed, and acks the newest
+    # frame that has nothing uncommitted before it.
+    async def ack(self, headers):
+        # Frames from a connection we're dropping will be redelivered, so needn't be acked.
+        seq = self.seqs.pop(headers["message-id"], None)
+        if seq is None or self.failed is not None:
+            return
+        self.frames[seq][1] = True
+
+        while self.next_ack_seq in self.frames and self.frames[self.next_ack_seq][1]:
+            self.unsent = self.frames.pop(self.next_ack_seq)[0]
+            self.next_ack_seq += 1
+            self.unsent_acks += 1
+            if self.unsent_since is None:
+                self.unsent_since = time.monotonic()
+
+        if self.unsent is None:
+            return
+        if self.unsent_acks < self.ack_every and self.next_ack_seq < self.next_seq:
+            return
+        await self.send_ack()
+
+    async def send_ack(self):
+        # Taken before sending, so an ack made while this one drains can't send it again.
+        last = self.unsent
+        self.unsent = None
+        self.unsent_since = None
+        self.unsent_acks = 0
+        with self.metrics.time("darwindb_stage_seconds", stage="ack", type="frame"):
+            await self.send("ACK", {"id": last["message-id"], "subscription": last["subscription"]})
+
+    async def send(self, command, headers, body=b""):
+        # Headers on CONNECT frames aren't escaped, so that passwords can contain colons.
+        escape = str if command == "CONNECT" else escape_header
+        lines = [command] + ["{}:{}".format(escape(k), escape(v)) for k, v in headers.items()]
+        self.writer.write("\n".join(lines).encode("utf-8") + b"\n\n" + body + b"\x00")
+        await self.writer.drain()
+
+    """ Reads the next frame, returning (command, headers, body), or None once the connection closes. """
+    async def read_frame(self):
+        try:
+            return await self.read_frame_or_raise()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def read_frame_or_raise(self):
+        # Skip the newlines which are sent between frames as heart-beats.
+        line = b"\n"
+        while line in (b"\n", b"\r\n"):
+            line = await self.reader.readline()
+            if not line:
+                return None
+        command = line.decode("utf-8").rstrip("\r\n")
+
+        headers = {}
+        while True:
+            line = (await self.reader.readline()).decode("utf-8").rstrip("\r\n")
+            if line == "":
+                break
+            key, _, value = line.partition(":")
+            # Repeated headers keep the first value they were given.
+            headers.setdefault(unescape_header(key), unescape_header(value))
+
+        if "content-length" in headers:
+            body = await self.reader.readexactly(int(headers["content-length"]))
+            await self.reader.readexactly(1)
+        else:
+            body = (await self.reader.readuntil(b"\x00"))[:-1]
+
+        return command, headers, body
@@ -0,0 +1,111 @@
+from darwindb.stores.PostgresStore import Store as PostgresStore
+from darwindb.stores.PostgresStore import Connection as PostgresConnection
+
+from collections import namedtuple
+import itertools
+import pytz
+import threading
+
+
+""" One service calling at a location, as listed on a departure or arrival board.
+
+scheduled is the public time if there is one, or the working time if not. expected is the best
+time we have for it, and expected_source says what that is: "actual", "estimated", or
+"scheduled" if we have neither. Times are in the board's time zone. platform is None if it is
+suppressed from the public.
+"""
+Call = namedtuple("Call", [
+    "rid", "uid", "headcode", "toc_code", "category", "position", "location_type", "public",
+    "scheduled", "expected", "expected_source", "platform", "platform_confirmed", "cancelled", "active",
+])
+
+
+""" Reads departure and arrival boards from the tables a PostgresStore writes.
+
+Each board is one query, using the index on (tiploc, working departure or arrival time), and its
+rows are streamed from a server-side cursor rather than fetched all at once. Boards cover the
+services whose working time at the tiploc is from start up to (but not including) end. Those
+may be aware datetimes in any time zone, or naive ones in timezone, which times on the board are
+also given in. That defaults to Europe/London, which is what the railway runs on, rather than the
+fixed offset each schedule's times were worked out in.
+
+Boards are read on a connection of their own, made from connection_args, as server-side cursors
+need a transaction to live in, and it mustn't be one an ingest store is part way through. The
+tables are found from store_args, as given to the PostgresStore which writes them.
+
+That transaction is only ended once every board has been read to the end or closed, so a caller
+which stops reading one early should close() it (or read it in contextlib.closing()) rather
+than leave that to the garbage collector.
+"""
+class Boards:
+
+    def __init__(self, connection_args, store_args=None, timezone="Europe/London", itersize=500):
+        self.connection = PostgresConnection(**connection_args)
+        self.connection.connect()
+        store = PostgresStore(self.connection, **(store_args or {}))
+        self.timezone = pytz.timezone(timezone)
+        self.itersize = itersize
+
+        # Server-side cursors need names which are unique on the connection, even if several
+        # boards are being read at once, from any thread. They only last until the transaction
+        # ends, so that's left open until none are. The lock is reentrant as a board which is
+        # garbage collected part way through closes itself on whichever thread that happens on.
+        self.cursor_names = itertools.count()
+        self.open_boards = 0
+        self.lock = threading.RLock()
+
+        self.queries = dict([(kind, self.board_query(store, kind)) for kind in ["departure", "arrival"]])
+
+    def board_query(self, store, kind):
+        forecast = "l.forecast_{}_".format(kind)
+        return (
+                "SELECT s.rid, s.uid, s.headcode, s.toc_code, s.category, l.position, l.type, " +
+                    "l.public_{k}_time IS NOT NULL, COALESCE(l.public_{k}_time, l.working_{k}_time), " +
+                    "CASE WHEN {f}actual_time_removed IS NOT TRUE AND {f}actual_time IS NOT NULL THEN {f}actual_time " +
+                        "ELSE COALESCE({f}estimated_time, {f}working_estimated_time, l.public_{k}_time, l.working_{k}_time) END, " +
+                    "CASE WHEN {f}actual_time_removed IS NOT TRUE AND {f}actual_time IS NOT NULL THEN 'actual' " +
+                        "WHEN COALESCE({f}estimated_time, {f}working_estimated_time) IS NOT NULL THEN 'estimated' " +
+                        "ELSE 'scheduled' END, " +
+                    "CASE WHEN l.platform_suppressed IS NOT TRUE THEN l.platform_number END, l.platform_confirmed, " +
+                    "COALESCE(l.cancelled, false), s.active " +
+                "FROM {location} l JOIN {schedule} s ON s.rid = l.rid " +
+                "WHERE l.tiploc = %s AND l.working_{k}_time >= %s AND l.working_{k}_time < %s AND s.deleted IS NOT TRUE " +
+                "ORDER BY l.working_{k}_time, s.rid").format(
+                k=kind,
+                f=forecast,
+                location=store.schedule_location_source,
+                schedule=store.table_schedule_name)
+
+    """ Yields a Call for each service departing tiploc from start up to end, in working time order. """
+    def departures(self, tiploc, start, end):
+        return self.board("departure", tiploc, start, end)
+
+    """ Yields a Call for each service arriving at tiploc from start up to end, in working time order. """
+    def arrivals(self, tiploc, start, end):
+        return self.board("arrival", tiploc, start, end)
+
+    def board(self, kind, tiploc, start, end):
+        with self.lock:
+            cursor = self.connection.cursor(name="darwindb_board_{}".format(next(self.cursor_names)))
+            cursor.itersize = self.itersize
+            self.open_boards += 1
+        try:
+            cursor.execute(self.queries[kind], (tiploc, self.aware(start), self.aware(end)))
+            for row in cursor:
+                yield Call(*(row[0:8] + (self.local(row[8]), self.local(row[9])) + row[10:]))
+        finally:
+            # Runs when the board has been read to the end, and when the generator is closed (or
+            # garbage collected) part way through.
+            with self.lock:
+                try:
+                    cursor.close()
+                finally:
+                    self.open_boards -= 1
+                    if self.open_boards == 0:
+                        self.connection.rollback()
+
+    def aware(self, t):
+        return self.timezone.localize(t) if t.tzinfo is None else t
+
+    def local(self, t):
+        return t.astimezone(self.timezone) if t is not None else None
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+
+import sys
+
+
+""" Roughly how many bytes of memory an object takes up, including the things it contains. """
+def deep_sizeof(o):
+    size = sys.getsizeof(o)
+    if isinstance(o, (tuple, list)):
+        size += sum([deep_sizeof(i) for i in o])
+    elif isinstance(o, dict):
+        size += sum([deep_sizeof(k) + deep_sizeof(v) for k, v in o.items()])
+    return size
+
+
+""" A least-recently-used cache bounded by the number of entries and the memory they use.
+
+Once either limit is exceeded, the least recently used entries are evicted until it is back
+within bounds. Either limit can be None to leave it unbounded.
+"""
+class LRUCache:
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=deep_sizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        self.invalidate(key)
+
+        size = self.sizeof(key) + self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        self.entries[key] = (value, size)
+        self.bytes += size
+        self.evict()
+
+    """ Accounts for an entry's value having grown or shrunk by delta bytes in place. """
+    def resize(self, key, delta):
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            self.entries[key] = (entry[0], entry[1] + delta)
+            self.bytes += delta
+            self.evict()
+
+    def evict(self):
+        while (self.max_entries is not None and len(self.entries) > self.max_entries) or \
+              (self.max_bytes is not None and self.bytes > self.max_bytes):
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
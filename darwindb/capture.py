@@ -0,0 +1,65 @@
+import gzip
+import json
+import time
+import zlib
+
+
+""" Appends frames to a capture file.
+
+Each frame is written as one line of JSON holding the time it arrived, its headers and its body.
+The file is gzip compressed and only ever appended to, so a capture can be built up over several
+runs, and the frames written so far can still be read if the process dies part way through.
+"""
+class CaptureWriter:
+
+    def __init__(self, path):
+        self.file = gzip.open(path, "ab")
+
+    def write(self, arrived, headers, message):
+        self.file.write(json.dumps({
+            "time": arrived,
+            "headers": headers,
+            "body": message.decode("utf-8"),
+        }).encode("utf-8") + b"\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+""" Listener which records every frame to a capture file before passing it on.
+
+Wrap the real listener with it, and it looks just the same to the Client:
+
+  c.connect(..., listener=Recorder(Listener(c), "darwin.capture.gz"))
+"""
+class Recorder:
+
+    def __init__(self, listener, path):
+        self.listener = listener
+        self.writer = CaptureWriter(path)
+
+    def __getattr__(self, name):
+        return getattr(self.listener, name)
+
+    def on_message(self, headers, message):
+        self.writer.write(time.time(), headers, message)
+        self.listener.on_message(headers, message)
+
+    def close(self):
+        self.writer.close()
+
+
+""" Reads back the frames in a capture file as (time, headers, body) tuples, oldest first. """
+def read_capture(path):
+    with gzip.open(path, "rb") as f:
+        while True:
+            try:
+                line = f.readline()
+            except (EOFError, zlib.error):
+                # The recorder was stopped part way through writing a frame.
+                return
+            if not line.endswith(b"\n"):
+                return
+            record = json.loads(line.decode("utf-8"))
+            yield record["time"], record["headers"], record["body"].encode("utf-8")
@@ -1,5 +1,11 @@
+from darwindb.metrics import Metrics
+
 from stomp.connect import StompConnection11
 
+from queue import Empty, Queue
+import threading
+import time
+
 import logging
 log = logging.getLogger("darwindb")
 
@@ -15,17 +21,148 @@ log = logging.getLogger("darwindb")
 def has_method(_class, _method):
     return callable(getattr(_class, _method, None))
 
+""" Passes on what happens on one connection to the client, along with which connection it was.
+
+A connection's receiver thread can still be handing over frames after we've moved on to a new
+connection, and those will be redelivered on the new one, so the client drops them.
+"""
+class ConnectionListener:
+    def __init__(self, client, generation):
+        self.client = client
+        self.generation = generation
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def on_message(self, headers, message):
+        self.client.on_message(headers, message, self.generation)
+
+""" Connects to the broker and passes each frame on to a listener.
+
+By default the listener is called directly on stomp.py's receiver thread, so nothing more is read
+from the socket until it returns. Passing queue_size puts the client in consumer mode instead,
+where received frames go onto a bounded queue and writer threads call the listener. The receiver
+thread then only blocks once the queue is full, so short stalls in the database don't hold up the
+socket, while memory use stays bounded by queue_size plus the broker's prefetch.
+
+A single writer thread applies frames in the order they arrive. With more than one, the listener
+must be safe to call from several threads at once, and frames may be committed out of order.
+
+Either way, the listener calls ack() once a frame has been committed. Acks are cumulative, so the
+client only acks up to the newest frame which has every frame before it committed too, and with
+ack_every > 1 it only does so every ack_every frames, when it has caught up, or once the oldest
+ack it's holding back is max_ack_delay seconds old.
+
+As nothing after a frame can be acked until it is, a frame which isn't committed would stall
+ingest. So if the listener raises, or a frame goes ack_timeout seconds without being committed,
+the client reconnects (see reconnect()), and the broker redelivers everything from that frame on,
+in order. A frame which fails every time is left to the broker's redelivery policy, which for
+ActiveMQ moves it to a dead letter queue after a few attempts.
+"""
 class Client:
-    def connect(self, server, port, user, password, queue, listener):
+    def connect(self, server, port, user, password, queue, listener, prefetch=None, queue_size=None,
+                writers=1, ack_every=1, max_ack_delay=1, ack_timeout=600, metrics=None):
         log.debug("StompClient.connect()")
         
         self.cb = listener
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.destination = queue
+        self.prefetch = prefetch
+        self.ack_every = ack_every
+        self.max_ack_delay = max_ack_delay
+        self.ack_timeout = ack_timeout
+        self.metrics = metrics or Metrics()
+
+        # Frames received but not acked yet: seq -> [headers, committed, when received], and
+        # message-id -> seq. unsent is the newest committed frame whose ack is being held back.
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.seqs = {}
+        self.next_seq = 0
+        self.next_ack_seq = 0
+        self.unsent = None
+        self.unsent_since = None
+        self.unsent_acks = 0
+
+        # Bumped whenever we reconnect. Frames from before then will be redelivered, so any still
+        # queued are dropped rather than applied, as are any received while reconnecting, or from
+        # the old connection (see ConnectionListener).
+        self.generation = 0
+        self.reconnecting = False
+
+        self.queue = None
+        if queue_size is not None:
+            self.queue = Queue(queue_size)
+            for n in range(0, writers):
+                writer = threading.Thread(target=self.write, name="darwindb-writer-{}".format(n))
+                writer.daemon = True
+                writer.start()
+
+        watchdog = threading.Thread(target=self.watch, name="darwindb-ack-watchdog")
+        watchdog.daemon = True
+        watchdog.start()
 
-        self.conn = StompConnection11([(server, port)], auto_decode=False)
-        self.conn.set_listener('', self)
+        self.open()
+
+    def open(self):
+        headers = {}
+        if self.prefetch is not None:
+            headers["activemq.prefetchSize"] = self.prefetch
+
+        self.conn = StompConnection11([(self.server, self.port)], auto_decode=False)
+        self.conn.set_listener('', ConnectionListener(self, self.generation))
         self.conn.start()
-        self.conn.connect(user, password)
-        self.conn.subscribe(queue, ack='client', id='1')
+        self.conn.connect(self.user, self.password)
+        self.conn.subscribe(self.destination, ack='client', id='1', headers=headers)
+
+    """ Drops the connection and makes a new one, so the broker redelivers every frame we haven't acked.
+
+    Frames received but not applied yet are dropped too, as they'll be redelivered after the frames
+    before them. This returns straight away, and the rest is done on a thread of its own, as it
+    has to wait for stomp.py's receiver thread, which may be the one calling this.
+    """
+    def reconnect(self, reason):
+        with self.lock:
+            if self.reconnecting:
+                return
+            self.reconnecting = True
+            self.generation += 1
+        log.error("StompClient: reconnecting, as {}".format(reason))
+
+        thread = threading.Thread(target=self.replace_connection, name="darwindb-reconnect")
+        thread.daemon = True
+        thread.start()
+
+    def replace_connection(self):
+        if self.queue is not None:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    break
+
+        conn = self.conn
+        try:
+            conn.disconnect()
+        except Exception:
+            log.exception("StompClient: failed to disconnect")
+        # The broker only redelivers the frames once the old connection has gone.
+        deadline = time.monotonic() + 10
+        while conn.is_connected() and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+        delay = 1
+        while True:
+            try:
+                self.open()
+                return
+            except Exception:
+                log.exception("StompClient: failed to reconnect, trying again in {}s".format(delay))
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
 
     def on_error(self, headers, message):
         log.debug("StompClient.onError(headers={}, message={})".format(headers, message))
@@ -42,6 +179,16 @@ class Client:
     def on_connected(self, headers, body):
         log.debug("StompClient.onConnected(headers={}, body={})".format(headers, body))
 
+        # Anything we hadn't acked will be redelivered, so stop waiting for it.
+        with self.lock:
+            self.frames.clear()
+            self.seqs.clear()
+            self.next_ack_seq = self.next_seq
+            self.unsent = None
+            self.unsent_since = None
+            self.unsent_acks = 0
+            self.reconnecting = False
+
         if has_method(self.cb, "on_connected"):
             self.cb.on_connected(headers, body)
 
@@ -51,13 +198,79 @@ class Client:
         if has_method(self.cb, "on_disconnected"):
             self.cb.on_disconnected()
 
-    def on_message(self, headers, message):
+    def on_message(self, headers, message, generation):
         log.debug("StompClient.onMessage(headers={}, body=<truncated>)".format(headers))
 
-        if has_method(self.cb, "on_message"):
-            self.cb.on_message(headers, message)
+        with self.lock:
+            if self.reconnecting or generation != self.generation:
+                return
+            self.frames[self.next_seq] = [headers, False, time.monotonic()]
+            self.seqs[headers["message-id"]] = self.next_seq
+            self.next_seq += 1
+
+        if self.queue is not None:
+            # Blocks the receiver thread once the writers have fallen queue_size frames behind.
+            self.queue.put((generation, headers, message))
+        else:
+            self.apply(headers, message)
+
+    def write(self):
+        while True:
+            generation, headers, message = self.queue.get()
+            if generation == self.generation:
+                self.apply(headers, message)
 
+    def apply(self, headers, message):
+        try:
+            if has_method(self.cb, "on_message"):
+                self.cb.on_message(headers, message)
+        except Exception:
+            log.exception("StompClient: listener failed on message {}".format(headers["message-id"]))
+            self.reconnect("the listener failed on message {}".format(headers["message-id"]))
+
+    """ Sends any ack held back for max_ack_delay, and reconnects if a frame's gone ack_timeout uncommitted. """
+    def watch(self):
+        while True:
+            time.sleep(max(0.01, min(1, self.max_ack_delay)))
+            now = time.monotonic()
+            with self.lock:
+                if self.reconnecting:
+                    continue
+                if self.unsent is not None and now - self.unsent_since >= self.max_ack_delay:
+                    self.send_ack()
+                oldest = self.frames.get(self.next_ack_seq, None)
+                if self.ack_timeout is None or oldest is None or now - oldest[2] < self.ack_timeout:
+                    continue
+            self.reconnect("message {} wasn't committed within {}s".format(oldest[0]["message-id"], self.ack_timeout))
+
+    # The subscription uses ack='client', so acking a frame also acks every frame received
+    # before it. This records that the frame has been committed, and acks the newest frame
+    # that has nothing uncommitted before it.
     def ack(self, headers):
-        self.conn.ack(headers["message-id"], headers["subscription"])
+        with self.lock:
+            # Frames from a connection we're replacing will be redelivered, so needn't be acked.
+            seq = self.seqs.pop(headers["message-id"], None)
+            if seq is None or self.reconnecting:
+                return
+            self.frames[seq][1] = True
+
+            while self.next_ack_seq in self.frames and self.frames[self.next_ack_seq][1]:
+                self.unsent = self.frames.pop(self.next_ack_seq)[0]
+                self.next_ack_seq += 1
+                self.unsent_acks += 1
+                if self.unsent_since is None:
+                    self.unsent_since = time.monotonic()
 
+            if self.unsent is None:
+                return
+            if self.unsent_acks < self.ack_every and self.next_ack_seq < self.next_seq:
+                return
+            self.send_ack()
 
+    # Called with the lock held, so acks can't reach the broker out of order.
+    def send_ack(self):
+        with self.metrics.time("darwindb_stage_seconds", stage="ack", type="frame"):
+            self.conn.ack(self.unsent["message-id"], self.unsent["subscription"])
+        self.unsent = None
+        self.unsent_since = None
+        self.unsent_acks = 0
@@ -0,0 +1,201 @@
+import io
+import json
+import re
+
+# orjson and ijson both let frames be decoded without holding the text of them in memory. orjson
+# is the faster of the two, as ijson is several times slower than the standard library's decoder,
+# even with its C backend.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# Whitespace, and the comma and whitespace which can follow a value, in frame text and bytes.
+whitespace = dict([(str, re.compile(r"[ \t\n\r]*")), (bytes, re.compile(rb"[ \t\n\r]*"))])
+separator = dict([(str, re.compile(r"[ \t\n\r]*(?:,[ \t\n\r]*)?")), (bytes, re.compile(rb"[ \t\n\r]*(?:,[ \t\n\r]*)?"))])
+
+# Matches one JSON value in a frame's bytes, for the orjson backend to skip over it, or to find
+# where it ends when the quicker way of doing that is thrown by brackets in strings. Brackets
+# aren't paired by kind, as orjson rejects values where they don't match, but they are counted,
+# which the re module can only do to a fixed depth. Darwin's messages are nested three deep.
+max_depth = 16
+string_pattern = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+other_pattern = rb'[^\[\]{}"]*'
+nested_pattern = other_pattern + rb'(?:' + string_pattern + other_pattern + rb')*'
+for _ in range(max_depth):
+    nested_pattern = other_pattern + rb'(?:(?:' + string_pattern + rb'|[\[{]' + nested_pattern + rb'[\]}])' + other_pattern + rb')*'
+value_pattern = re.compile(rb'(?:' + string_pattern + rb'|[\[{]' + nested_pattern + rb'[\]}]|[^,\]}\s"\[{]+)')
+brackets = dict([(ord("{"), (b"{", b"}")), (ord("["), (b"[", b"]"))])
+
+if orjson is not None:
+    default_backend = "orjson"
+elif ijson is not None:
+    default_backend = "ijson"
+else:
+    default_backend = "json"
+
+
+""" Decodes a frame's messages one at a time, rather than building them all at once with json.loads().
+
+It can be used in place of the decoded frame, as frame["schedule_messages"] and the like give an
+iterator over those messages, each one decoded only when it is reached. Each list of messages can
+only be iterated over once. frame["message_type"] gives the message type as usual.
+
+By default it picks the fastest backend which is installed that streams from the frame's bytes,
+so that memory use doesn't grow with the size of the frame beyond the bytes themselves:
+
+  orjson  Finds where each message ends by counting brackets, and decodes just that part of the
+          bytes with orjson. Values nested more than max_depth deep can't be read.
+  ijson   Several times slower than either of the others. Each list is read with a fresh pass over the bytes.
+  json    The standard library's decoder, used if neither of the others is installed. It is the
+          fastest, but isn't streaming: the whole frame is decoded to text up front, and the text
+          is held until the reader is done with, alongside the frame's bytes. That takes up to as
+          much memory again as the bytes, though far less than all of a large snapshot frame's
+          messages decoded at once would.
+
+backend can be passed to pick one. With orjson and json, reading the lists in the order the frame
+has them costs nothing extra, whereas reading them in some other order means skipping over the
+messages in between to find where later lists start.
+"""
+class FrameReader:
+
+    def __init__(self, data, backend=None):
+        self.data = data
+        self.backend = backend or default_backend
+
+        if self.backend in ["json", "orjson"]:
+            if self.backend == "json":
+                self.text = data.decode("utf-8")
+                self.decoder = json.JSONDecoder()
+            else:
+                self.text = bytes(data)
+                self.view = memoryview(self.text)
+            self.whitespace = whitespace[type(self.text)]
+            self.separator = separator[type(self.text)]
+            # Offsets of the values of the top level keys found so far, and where the next key
+            # starts. That's None while the list we've got furthest to is still being read.
+            self.offsets = {}
+            self.position = self.skip(self.text.index("{" if self.backend == "json" else b"{") + 1)
+            self.frontier = None
+
+    def __getitem__(self, key):
+        if self.backend == "ijson":
+            if key == "message_type":
+                return next(ijson.items(io.BytesIO(self.data), key))
+            return ijson.items(io.BytesIO(self.data), key + ".item", use_float=True)
+
+        if key == "message_type":
+            return self.decode(self.find(key))[0]
+        return self.items(key, self.find(key))
+
+    def char(self, position):
+        c = self.text[position]
+        return c if self.backend == "json" else chr(c)
+
+    """ Decodes the value starting at position, returning it and the offset of its end. """
+    def decode(self, position):
+        if self.backend == "json":
+            return self.decoder.raw_decode(self.text, position)
+
+        # Guess that an object or array ends at the first closing bracket which there have been
+        # as many of as opening ones. orjson only accepts exactly one value, so that's checked by
+        # decoding it, and it can only be wrong if there are brackets in strings.
+        if self.text[position] in brackets:
+            opening, closing = brackets[self.text[position]]
+            opened, closed, end = 1, 0, position + 1
+            while closed < opened:
+                found = self.text.find(closing, end)
+                if found == -1:
+                    break
+                opened += self.text.count(opening, end, found)
+                closed += 1
+                end = found + 1
+            else:
+                try:
+                    return orjson.loads(self.view[position:end]), end
+                except orjson.JSONDecodeError:
+                    pass
+
+        end = self.end(position)
+        return orjson.loads(self.view[position:end]), end
+
+    """ Returns the offset of the end of the value starting at position, without decoding it. """
+    def end(self, position):
+        if self.backend == "json":
+            return self.decoder.raw_decode(self.text, position)[1]
+        match = value_pattern.match(self.text, position)
+        if match is None:
+            raise ValueError("Couldn't find the end of the value at byte {}, which may be nested more than {} deep".format(
+                position, max_depth))
+        return match.end()
+
+    def skip(self, position):
+        return self.whitespace.match(self.text, position).end()
+
+    """ Moves on from the end of a value to the start of the next key. """
+    def after(self, position):
+        return self.separator.match(self.text, position).end()
+
+    """ Returns the offset of the value of a top level key, searching forwards as far as needed. """
+    def find(self, key):
+        if key in self.offsets:
+            return self.offsets[key]
+
+        if self.position is None:
+            self.position = self.skip_list(self.offsets[self.frontier])
+            self.frontier = None
+
+        while self.char(self.position) != "}":
+            name, position = self.decode(self.position)
+            position = self.skip(self.skip(position) + 1)
+            self.offsets[name] = position
+
+            if self.char(position) != "[":
+                self.position = self.after(self.end(position))
+            elif name == key:
+                # Leave this list to be read by whoever asked for it.
+                self.position = None
+                self.frontier = name
+                return position
+            else:
+                self.position = self.skip_list(position)
+
+            if name == key:
+                return position
+
+        raise KeyError(key)
+
+    def items(self, key, position):
+        position = self.skip(position + 1)
+        while self.char(position) != "]":
+            item, position = self.decode(position)
+            position = self.after(position)
+            yield item
+
+        if self.frontier == key:
+            self.position = self.after(position + 1)
+            self.frontier = None
+
+    def skip_list(self, position):
+        position = self.skip(position + 1)
+        while self.char(position) != "]":
+            position = self.after(self.end(position))
+        return self.after(position + 1)
+
+
+""" Splits an iterable into lists of at most size items. """
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
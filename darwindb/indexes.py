@@ -0,0 +1,36 @@
+""" Builds the indexes PostgresStore relies on which are missing or invalid, without stopping ingest.
+
+  $ POSTGRES_HOST=... POSTGRES_DB=... POSTGRES_USER=... POSTGRES_PASS=... \\
+        python -m darwindb.indexes
+
+create_tables() only builds the indexes on tables it has just created, as building them on tables
+which are already full of rows can take a long time. This builds the rest (see
+PostgresStore.build_indexes()), on a connection of its own, so run it alongside ingest whenever
+that warns of missing indexes.
+"""
+from darwindb.stores import PostgresConnection, PostgresStore
+
+import logging
+import os
+
+log = logging.getLogger("darwindb")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    connection = PostgresConnection(host=os.environ["POSTGRES_HOST"],
+                                    dbname=os.environ["POSTGRES_DB"],
+                                    user=os.environ["POSTGRES_USER"],
+                                    password=os.environ["POSTGRES_PASS"])
+    connection.connect()
+
+    # Which indexes are expected depends on how the tables are laid out.
+    cursor = connection.cursor()
+    _, compact, split_forecasts = PostgresStore(connection).table_layout(cursor)
+    connection.commit()
+    cursor.close()
+
+    store = PostgresStore(connection, compact=compact, split_forecasts=split_forecasts)
+    store.build_indexes()
+    for index in store.check_indexes():
+        log.warning("Index {} is still missing or invalid.".format(index))
@@ -0,0 +1,294 @@
+from darwindb.frames import chunked
+from darwindb.metrics import BufferedMetrics, Metrics
+from darwindb.stores.PostgresStore import Store as PostgresStore
+from darwindb.stores.PostgresStore import Connection as PostgresConnection
+
+import json
+import multiprocessing
+import queue
+import threading
+import traceback
+import zlib
+
+import logging
+log = logging.getLogger("darwindb")
+
+
+""" Saves every message in a frame to the store in a single transaction.
+
+The frame can be a decoded dict or a FrameReader. Snapshot schedules are bulk loaded a chunk at a
+time, so with a FrameReader, a large snapshot frame is never all decoded at once.
+"""
+def apply_frame(store, m, snapshot_chunk_size=1000):
+    snapshot = m["message_type"] == "snapshot"
+
+    with store.batch():
+        if snapshot:
+            for chunk in chunked(m["schedule_messages"], snapshot_chunk_size):
+                store.save_snapshot_schedule_messages(chunk)
+        else:
+            for s in m["schedule_messages"]:
+                store.save_schedule_message(s, snapshot)
+
+        for s in m["association_messages"]:
+            store.save_association_message(s, snapshot)
+
+        for d in m["deactivated_messages"]:
+            store.save_deactivated_message(d, snapshot)
+
+        for s in m["train_status_messages"]:
+            store.save_train_status_message(s, snapshot)
+
+
+""" Picks the shard a rid belongs to. This is stable across processes and restarts. """
+def shard_for_rid(rid, shards):
+    return zlib.crc32(rid.encode("utf-8")) % shards
+
+
+""" Splits a decoded frame into one frame per shard, keeping the messages in their original order.
+
+Messages are sharded by rid (associations by the rid of the main service), so everything about
+one train is always applied by the same shard, in the order it arrived. Shards which end up with
+no messages are left out of the result.
+"""
+def shard_frame(m, shards):
+    parts = {}
+
+    def part(rid):
+        shard = shard_for_rid(rid, shards)
+        if shard not in parts:
+            parts[shard] = {
+                "message_type": m["message_type"],
+                "schedule_messages": [],
+                "association_messages": [],
+                "deactivated_messages": [],
+                "train_status_messages": [],
+            }
+        return parts[shard]
+
+    for s in m["schedule_messages"]:
+        part(s["rid"])["schedule_messages"].append(s)
+
+    for s in m["association_messages"]:
+        part(s["main_service"]["rid"])["association_messages"].append(s)
+
+    for d in m["deactivated_messages"]:
+        part(d["rid"])["deactivated_messages"].append(d)
+
+    for s in m["train_status_messages"]:
+        part(s["rid"])["train_status_messages"].append(s)
+
+    return parts
+
+
+""" Entry point of each worker process. Applies frames from its task queue until it gets None.
+
+If a frame fails, the worker reports it and exits, rather than going on to apply the frames after
+it, which may be about the same trains. Anything left in its queue goes with it. The store's
+metrics are sent back with the result of each frame, for the parent process to record.
+"""
+def run_shard(shard, connection_args, store_args, tasks, results):
+    connection = PostgresConnection(**connection_args)
+    connection.connect()
+    metrics = BufferedMetrics()
+    store = PostgresStore(connection, metrics=metrics, **store_args)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, m = task
+        try:
+            apply_frame(store, m)
+        except Exception:
+            results.put((seq, shard, traceback.format_exc(), metrics.drain()))
+            break
+        else:
+            results.put((seq, shard, None, metrics.drain()))
+
+
+""" Listener which spreads ingest across several worker processes.
+
+Each worker has its own PostgresConnection and PostgresStore, and applies its share of every
+frame (see shard_frame()) in its own transaction. A frame is only acked once every shard has
+committed its part of it, and because acks are cumulative, only once every frame before it has
+been fully committed too.
+
+If a shard fails to apply its part of a frame, frames before it are still acked once complete,
+but nothing from that frame onwards is. Every worker is then stopped, dropping the frames they
+have queued, and the client reconnects (see Client.reconnect()), so the broker redelivers
+everything from the failed frame on, in order. New workers are started once it has reconnected.
+"""
+class ShardedIngest:
+
+    def __init__(self, client, connection_args, workers=None, store_args=None, queue_size=64, metrics=None):
+        self.client = client
+        # The workers' stores record to this too, by way of the results they send back.
+        self.metrics = metrics or Metrics()
+        self.connection_args = connection_args
+        self.store_args = store_args or {}
+        self.workers = workers or multiprocessing.cpu_count()
+        self.queue_size = queue_size
+
+        # Used for creating the tables, and their partitions, before any of the workers start.
+        self.connection = PostgresConnection(**connection_args)
+        self.store = PostgresStore(self.connection, **self.store_args)
+
+        # Spawned rather than forked, as the STOMP client has threads of its own running by now.
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = []
+        self.tasks = []
+        self.results = None
+        self.collector = None
+
+        # Frames which have been dispatched but not acked yet: seq -> [headers, shards outstanding].
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_seq = 0
+        self.next_ack_seq = 0
+        self.failed = None
+        self.failed_seq = None
+
+    def start(self):
+        if self.results is None:
+            self.results = self.context.Queue()
+            self.collector = threading.Thread(target=self.collect, name="darwindb-collector")
+            self.collector.daemon = True
+            self.collector.start()
+
+        for shard in range(0, self.workers):
+            tasks = self.context.Queue(self.queue_size)
+            process = self.context.Process(target=run_shard, name="darwindb-shard-{}".format(shard),
+                    args=(shard, self.connection_args, self.store_args, tasks, self.results))
+            process.daemon = True
+            process.start()
+            self.tasks.append(tasks)
+            self.processes.append(process)
+
+    """ Asks the workers to finish the frames they've been given, then waits for them to exit. """
+    def stop(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.tasks = []
+
+    """ Stops the workers straight away, dropping whatever they have queued and rolling back what they were applying. """
+    def terminate(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.tasks = []
+
+    """ Throws away everything from the failed frame on, and has it all redelivered. """
+    def restart(self, reason):
+        self.terminate()
+        self.client.reconnect(reason)
+
+    def on_connected(self, headers, body):
+        log.info("ShardedIngest: connected")
+        self.connection.connect()
+        self.store.create_tables()
+        for index in self.store.check_indexes():
+            log.warning("Index {} is missing or invalid. Build it with python -m darwindb.indexes.".format(index))
+        if self.store.partition_days is not None:
+            created, detached = self.store.maintain_partitions()
+            log.info("Created partitions {} and detached {}".format(created, detached))
+
+        # The workers are started before frames are let through again, so any frame let through
+        # is given to them, rather than to the ones we've stopped.
+        if not self.processes:
+            self.start()
+
+        # Anything unacked is redelivered on reconnecting, so we can start afresh.
+        with self.lock:
+            self.pending.clear()
+            self.next_ack_seq = self.next_seq
+            self.failed = None
+            self.failed_seq = None
+
+    def on_message(self, headers, message):
+        # Anything from an earlier frame failing on will be redelivered once we've reconnected.
+        if self.failed is not None:
+            return
+
+        with self.metrics.time("darwindb_stage_seconds", stage="decode", type="frame"):
+            m = json.loads(message.decode("utf-8"))
+        parts = shard_frame(m, self.workers)
+
+        with self.lock:
+            # Something may have failed while we were decoding.
+            if self.failed is not None:
+                return
+            seq = self.next_seq
+            self.next_seq += 1
+            self.pending[seq] = [headers, len(parts)]
+            if len(parts) == 0:
+                self.ack_completed()
+            # The workers the frame is for. They're replaced by new ones when anything fails.
+            tasks = self.tasks
+
+        # Blocks once a worker's queue is full, so we never read too far ahead of the database,
+        # unless something fails while we're waiting, and the workers are stopped. The frame is
+        # then dropped, even if new workers have been started since, as it'll be redelivered.
+        for shard, part in parts.items():
+            while True:
+                try:
+                    tasks[shard].put((seq, part), timeout=1)
+                    break
+                except queue.Full:
+                    if self.failed is not None or self.tasks is not tasks:
+                        return
+
+    def collect(self):
+        while True:
+            # The reason for a failure which needs the workers restarting, once we've let go of the lock.
+            restart = None
+            try:
+                seq, shard, error, metrics = self.results.get(timeout=1)
+            except queue.Empty:
+                dead = [p.name for p in self.processes if not p.is_alive()]
+                with self.lock:
+                    if dead and self.failed is None:
+                        restart = self.fail(self.next_ack_seq, "worker {} exited".format(", ".join(dead)))
+                if restart is not None:
+                    self.restart(restart)
+                continue
+            BufferedMetrics.replay(metrics, self.metrics)
+
+            with self.lock:
+                # Frames from before we last connected will be redelivered, so are of no interest.
+                if seq not in self.pending:
+                    continue
+                if error is not None:
+                    log.error(error)
+                    if self.failed is None:
+                        restart = self.fail(seq, "shard {} failed on frame {}".format(shard, seq))
+                    elif seq < self.failed_seq:
+                        self.fail(seq, "shard {} failed on frame {}".format(shard, seq))
+                else:
+                    self.pending[seq][1] -= 1
+                self.ack_completed()
+            if restart is not None:
+                self.restart(restart)
+
+    """ Stops acking from frame seq onwards, and drops any new frames. Returns the reason. """
+    def fail(self, seq, reason):
+        self.failed = reason
+        self.failed_seq = seq
+        log.error("ShardedIngest: {}".format(reason))
+        return reason
+
+    """ Acks, in order, every frame which has been fully committed along with every frame before it.
+
+    The client takes care of batching these up into cumulative acks to the broker.
+    """
+    def ack_completed(self):
+        while self.next_ack_seq in self.pending and self.pending[self.next_ack_seq][1] == 0:
+            if self.failed_seq is not None and self.next_ack_seq >= self.failed_seq:
+                break
+            self.client.ack(self.pending.pop(self.next_ack_seq)[0])
+            self.next_ack_seq += 1
@@ -0,0 +1,171 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import threading
+import time
+
+
+""" Where the store and clients send their counters and timings. This one throws them away.
+
+Subclass it and override increment() and observe() to send them somewhere. The names used are:
+
+  darwindb_messages_total{type}                   Messages saved.
+  darwindb_stage_seconds{stage, type}             Time spent in each stage of ingest: decode (of
+                                                  a frame's JSON), sanitise (working out the times
+                                                  on a schedule), execute (executing its statements
+                                                  in the database), save (the whole of saving one
+                                                  message, including sanitise and execute), commit
+                                                  and ack.
+  darwindb_rows_total{table, operation}           Rows inserted, updated, deleted or archived.
+  darwindb_train_status_unmatched_total{reason}   Train status messages with no schedule, and
+                                                  locations in them with no matching location.
+  darwindb_forecast_updates_total{result}         Forecasts written, or suppressed as unchanged.
+"""
+class Metrics:
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        yield
+        self.observe(name, time.perf_counter() - start, **labels)
+
+
+""" Holds on to counters and timings until they're taken with drain(), to be passed to replay() elsewhere.
+
+ShardedIngest's workers use this, as they run in processes of their own, and send what they've
+recorded back to the parent process with the result of each frame.
+"""
+class BufferedMetrics(Metrics):
+
+    def __init__(self):
+        self.counters = {}
+        self.observations = []
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        self.observations.append((name, seconds, labels))
+
+    """ Returns everything recorded since it was last drained, as something which can be pickled. """
+    def drain(self):
+        drained = (self.counters, self.observations)
+        self.counters = {}
+        self.observations = []
+        return drained
+
+    """ Sends what drain() returned on to metrics. """
+    @staticmethod
+    def replay(drained, metrics):
+        counters, observations = drained
+        for (name, labels), value in counters.items():
+            metrics.increment(name, value, **dict(labels))
+        for name, seconds, labels in observations:
+            metrics.observe(name, seconds, **labels)
+
+
+""" Keeps counters and latency histograms in memory, and renders them in Prometheus' text format.
+
+Call serve() to expose them on http://<address>:<port>/metrics for Prometheus to scrape.
+"""
+class PrometheusMetrics(Metrics):
+
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def increment(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                # Counts per bucket (not yet cumulative), then the sum and count of everything.
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(['{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                               for k, v in labels]) + "}"
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted([(k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items()])
+
+        lines = []
+        last = None
+        for (name, labels), value in counters:
+            if name != last:
+                lines.append("# TYPE {} counter".format(name))
+                last = name
+            lines.append("{}{} {}".format(name, self.format_labels(labels), value))
+
+        for (name, labels), (counts, total, count) in histograms:
+            if name != last:
+                lines.append("# TYPE {} histogram".format(name))
+                last = name
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(name, self.format_labels(labels, [("le", bound)]), cumulative))
+            lines.append("{}_bucket{} {}".format(name, self.format_labels(labels, [("le", "+Inf")]), count))
+            lines.append("{}_sum{} {}".format(name, self.format_labels(labels), total))
+            lines.append("{}_count{} {}".format(name, self.format_labels(labels), count))
+
+        return "\n".join(lines) + "\n"
+
+    """ Serves the metrics over HTTP from a background thread, and returns the server. """
+    def serve(self, port, address=""):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        server = Server((address, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="darwindb-metrics")
+        thread.daemon = True
+        thread.start()
+        return server
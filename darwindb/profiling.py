@@ -0,0 +1,149 @@
+from collections import deque
+
+import re
+import time
+
+import logging
+log = logging.getLogger("darwindb")
+
+
+explainable = re.compile(r"\s*(EXECUTE|SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.I)
+
+statement_name = re.compile(r"\s*(?:(EXECUTE|PREPARE)\s+(\w+)|(INSERT\s+INTO|UPDATE|DELETE\s+FROM|COPY|TRUNCATE|CREATE\s+\w+(?:\s+\w+)*?\s+(?:TABLE|INDEX)(?:\s+IF\s+NOT\s+EXISTS)?|WITH|SELECT)\s*(\w*))", re.I)
+
+
+""" Works out a short name for a statement, e.g. ts_update_point for "EXECUTE ts_update_point (...)". """
+def name_statement(query):
+    if isinstance(query, bytes):
+        query = query[:200].decode("utf-8", "replace")
+    match = statement_name.match(query)
+    if match is None:
+        return "other"
+    if match.group(1) is not None:
+        return match.group(2) if match.group(1).upper() == "EXECUTE" else "prepare " + match.group(2)
+    return " ".join(match.group(3).split()[:2]).lower() + (" " + match.group(4) if match.group(4) else "")
+
+
+""" Times every statement a store's cursor runs, and captures the ones which are slow.
+
+Pass one to PostgresStore(profiler=...) and its cursor is wrapped in a ProfilingCursor. Without one
+the store uses the plain psycopg2 cursor, so profiling costs nothing when it isn't switched on.
+
+Statements and commits are grouped by name (see name_statement()), and the statements each
+message needed are totalled up per message type. Commits are left out of those totals, as inside
+Store.batch() they happen once per frame rather than once per message.
+
+Any statement taking longer than slow_seconds is kept in slow, along with its parameters, and if
+explain is True, the output of running it again under EXPLAIN (ANALYZE, BUFFERS). The re-run
+happens inside a savepoint which is rolled back, so it doesn't change any rows (sequences still
+move on), but it does take as long again, so only use explain when investigating.
+"""
+class Profiler:
+
+    def __init__(self, slow_seconds=None, explain=False, max_slow=100, metrics=None):
+        self.slow_seconds = slow_seconds
+        self.explain = explain
+        self.metrics = metrics
+
+        # statement name -> [count, total seconds, max seconds]
+        self.statements = {}
+        # message type -> [messages, round trips]
+        self.messages = {}
+        self.round_trips = 0
+        self.slow = deque(maxlen=max_slow)
+
+    def wrap(self, cursor):
+        return ProfilingCursor(cursor, self)
+
+    def record(self, name, seconds):
+        stats = self.statements.get(name, None)
+        if stats is None:
+            stats = self.statements[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        self.round_trips += 1
+        if self.metrics is not None:
+            self.metrics.observe("darwindb_statement_seconds", seconds, statement=name)
+
+    def run(self, cursor, method, query, vars=None):
+        start = time.perf_counter()
+        r = getattr(cursor, method)(query, vars) if vars is not None else getattr(cursor, method)(query)
+        seconds = time.perf_counter() - start
+
+        name = name_statement(query)
+        self.record(name, seconds)
+
+        if self.slow_seconds is not None and seconds > self.slow_seconds:
+            self.capture(cursor, method, name, query, vars, seconds)
+        return r
+
+    def commit(self, connection):
+        start = time.perf_counter()
+        connection.commit()
+        self.record("commit", time.perf_counter() - start)
+
+    """ Attributes the round trips made since the last message ended to a message of this type. """
+    def end_message(self, message_type, round_trips):
+        stats = self.messages.get(message_type, None)
+        if stats is None:
+            stats = self.messages[message_type] = [0, 0]
+        stats[0] += 1
+        stats[1] += self.round_trips - round_trips
+
+    def capture(self, cursor, method, name, query, vars, seconds):
+        text = query.decode("utf-8", "replace") if isinstance(query, bytes) else query
+        slow = {"statement": name, "seconds": seconds, "query": text, "parameters": vars, "plan": None}
+
+        if self.explain and method == "execute" and explainable.match(text):
+            # A separate cursor, so the results of the statement itself can still be fetched.
+            explain = cursor.connection.cursor()
+            try:
+                explain.execute("SAVEPOINT darwindb_profiler")
+                explain.execute("EXPLAIN (ANALYZE, BUFFERS) " + text, vars)
+                slow["plan"] = "\n".join([r[0] for r in explain.fetchall()])
+            except Exception as e:
+                slow["plan"] = "Could not explain: {}".format(e)
+            finally:
+                explain.execute("ROLLBACK TO SAVEPOINT darwindb_profiler")
+                explain.close()
+
+        self.slow.append(slow)
+        log.warning("Slow statement {} took {:.1f}ms: {} {}{}".format(
+            name, seconds * 1000, text[:500], vars, "\n" + slow["plan"] if slow["plan"] else ""))
+
+    def report(self):
+        lines = ["  {:<50} {:>8} {:>10} {:>10} {:>10}".format("statement", "count", "total ms", "mean ms", "max ms")]
+        for name, (count, total, longest) in sorted(self.statements.items(), key=lambda s: -s[1][1]):
+            lines.append("  {:<50} {:>8} {:>10.1f} {:>10.3f} {:>10.3f}".format(
+                name, count, total * 1000, total / count * 1000, longest * 1000))
+        lines.append("  {:<50} {:>8} {:>12}".format("message", "count", "round trips"))
+        for message_type, (count, round_trips) in sorted(self.messages.items()):
+            lines.append("  {:<50} {:>8} {:>12.2f}".format(message_type, count, round_trips / count))
+        return "\n".join(lines)
+
+
+""" Stands in for a psycopg2 cursor, passing every statement through a Profiler. """
+class ProfilingCursor:
+
+    def __init__(self, cursor, profiler):
+        self.cursor = cursor
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, query, vars=None):
+        return self.profiler.run(self.cursor, "execute", query, vars)
+
+    def executemany(self, query, vars_list):
+        return self.profiler.run(self.cursor, "executemany", query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        r = self.cursor.copy_expert(sql, file, size)
+        self.profiler.record(name_statement(sql), time.perf_counter() - start)
+        return r
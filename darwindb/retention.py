@@ -0,0 +1,248 @@
+""" Moves finished services out of the live tables, so lookups on them don't pay for months of history.
+
+  $ POSTGRES_HOST=... POSTGRES_DB=... POSTGRES_USER=... POSTGRES_PASS=... \\
+        python -m darwindb.retention [--days N] [--export archive.gz] [--dry-run] ...
+
+Run with --help to see the options.
+"""
+from darwindb.metrics import Metrics
+
+from datetime import datetime, timedelta
+
+import gzip
+import pytz
+import time
+
+import logging
+log = logging.getLogger("darwindb")
+
+
+""" Archives schedules whose last location passed more than days ago, along with their locations
+and associations.
+
+Each batch removes up to batch_size schedules in its own transaction, so it holds locks only
+briefly, and skips over any schedule which ingest has locked rather than waiting for it. Set pause
+to sleep that many seconds between batches, to leave the database some room.
+
+The rows removed are copied into archive tables alongside the live ones (e.g. schedule_archive),
+which are created as needed, or, if export_path is set, appended to that file instead, gzip
+compressed as one line of JSON per row, {"table": ..., "row": ...}. Rows are written to the file
+before their batch commits, so if it fails to commit, they may be written again by the next run.
+
+Associations are archived with the schedules they refer to. With orphans set, associations
+where either schedule is missing altogether are archived as well, such as those whose
+schedules were in a partition which has since been dropped. Don't set it while ingest is still
+catching up, as associations can arrive before their schedules.
+
+With dry_run set, nothing is changed, and run() just counts the rows it would archive.
+"""
+class Archiver:
+
+    def __init__(self, store, days=7, batch_size=1000, pause=0, export_path=None, orphans=False, dry_run=False,
+                 metrics=None):
+        self.store = store
+        self.connection = store.connection
+        self.days = days
+        self.batch_size = batch_size
+        self.pause = pause
+        self.export_path = export_path
+        self.orphans = orphans
+        self.dry_run = dry_run
+        self.metrics = metrics or Metrics()
+
+        self.tables = [store.table_schedule_name, store.table_schedule_location_name, store.table_assoc_name]
+        self.columns = {
+            store.table_schedule_name: list(store.table_schedule_fields.keys()),
+            store.table_schedule_location_name: list(store.table_schedule_location_fields.keys()),
+            store.table_assoc_name: list(store.table_assoc_fields.keys()),
+        }
+
+        # What the archive tables look like, and the rows removed from each table, as a FROM item.
+        # When forecasts are split out, their table still has the ones for the removed locations
+        # as the statement started, even though they're deleted along with them.
+        self.sources = dict([(t, t) for t in self.tables])
+        self.removed = dict([(t, "{}_removed".format(t)) for t in self.tables])
+        if store.split_forecasts:
+            location = store.table_schedule_location_name
+            self.sources[location] = store.schedule_location_source
+            self.removed[location] = "(SELECT {} FROM {}_removed l LEFT JOIN {} f ON f.id = l.id)".format(
+                    ", ".join(["f.{}".format(k) if k in store.table_schedule_location_forecast_fields and k != "id" else "l.{}".format(k)
+                               for k in self.columns[location]]),
+                    location,
+                    store.table_schedule_location_forecast_name)
+
+        # Schedules are finished once none of their locations are at or after the cutoff. Services
+        # don't start before their start_date, so that's checked first to narrow down the search.
+        self.finished_query = (
+                "SELECT s.rid FROM {schedule} s WHERE s.start_date < %(cutoff_date)s AND NOT EXISTS (" +
+                    "SELECT 1 FROM {location} l WHERE l.rid = s.rid AND " +
+                    "GREATEST(l.working_arrival_time, l.working_pass_time, l.working_departure_time) >= %(cutoff)s)").format(
+                schedule=store.table_schedule_name,
+                location=store.table_schedule_location_name)
+
+        self.orphans_query = (
+                "SELECT a.id FROM {assoc} a WHERE NOT EXISTS (SELECT 1 FROM {schedule} WHERE rid = a.main_rid) " +
+                    "OR NOT EXISTS (SELECT 1 FROM {schedule} WHERE rid = a.assoc_rid)").format(
+                assoc=store.table_assoc_name,
+                schedule=store.table_schedule_name)
+
+        # The victims are removed from all three tables in one statement, which then either copies
+        # them into the archive tables and counts them, or returns them to be exported.
+        self.archive_schedules_query = self.archive_query(
+                "victims AS ({} ORDER BY s.start_date LIMIT %(limit)s FOR UPDATE OF s SKIP LOCKED), ".format(self.finished_query) +
+                "{location}_removed AS (DELETE FROM {location} WHERE rid IN (SELECT rid FROM victims) RETURNING *), " +
+                "{schedule}_removed AS (DELETE FROM {schedule} WHERE rid IN (SELECT rid FROM victims) RETURNING *), " +
+                "{assoc}_removed AS (DELETE FROM {assoc} WHERE main_rid IN (SELECT rid FROM victims) " +
+                    "OR assoc_rid IN (SELECT rid FROM victims) RETURNING *)")
+
+        self.archive_orphans_query = self.archive_query(
+                "victims AS ({} LIMIT %(limit)s FOR UPDATE OF a SKIP LOCKED), ".format(self.orphans_query) +
+                "{location}_removed AS (SELECT * FROM {location} WHERE false), " +
+                "{schedule}_removed AS (SELECT * FROM {schedule} WHERE false), " +
+                "{assoc}_removed AS (DELETE FROM {assoc} WHERE id IN (SELECT id FROM victims) RETURNING *)")
+
+    def archive_query(self, removed):
+        schedule, location, assoc = self.tables
+        query = "WITH " + removed.format(schedule=schedule, location=location, assoc=assoc)
+        if self.export_path is None:
+            for table in self.tables:
+                columns = ", ".join(self.columns[table])
+                query += ", {t}_archived AS (INSERT INTO {t}_archive ({c}) SELECT {c} FROM {r} r)".format(
+                        t=table, c=columns, r=self.removed[table])
+            return query + " SELECT " + ", ".join(["(SELECT count(*) FROM {}_removed)".format(t) for t in self.tables])
+        return query + " " + " UNION ALL ".join(["SELECT '{t}', to_jsonb(r)::text FROM {r} r".format(t=t, r=self.removed[t])
+                                                 for t in self.tables])
+
+    """ Creates any archive tables which don't exist, and adds any columns they're missing. """
+    def create_archive_tables(self, cursor):
+        for table in self.tables:
+            cursor.execute("CREATE TABLE IF NOT EXISTS {}_archive (LIKE {})".format(table, self.sources[table]))
+            cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s " +
+                           "AND table_schema = current_schema()", (table + "_archive",))
+            present = [r[0] for r in cursor.fetchall()]
+            for column in self.columns[table]:
+                if column not in present:
+                    cursor.execute("ALTER TABLE {t}_archive ADD COLUMN {c} {d}".format(
+                        t=table, c=column, d=self.column_type(cursor, table, column)))
+        self.connection.commit()
+
+    def column_type(self, cursor, table, column):
+        cursor.execute("SELECT format_type(atttypid, atttypmod) FROM pg_attribute WHERE attrelid = %s::regclass " +
+                       "AND attname = %s", (self.sources[table], column))
+        return cursor.fetchone()[0]
+
+    """ Archives everything finished before now, less days, and returns the numbers of rows per table. """
+    def run(self, now=None):
+        now = now or datetime.now(pytz.utc)
+        cutoff = now - timedelta(days=self.days)
+        parameters = {"cutoff": cutoff, "cutoff_date": cutoff.date(), "limit": self.batch_size}
+
+        cursor = self.connection.cursor()
+        if self.dry_run:
+            totals = self.count(cursor, parameters)
+            log.info("Would archive {}".format(self.describe(totals)))
+            cursor.close()
+            return totals
+
+        if self.export_path is None:
+            self.create_archive_tables(cursor)
+            export = None
+        else:
+            export = gzip.open(self.export_path, "ab")
+
+        totals = dict([(t, 0) for t in self.tables])
+        start = time.perf_counter()
+        try:
+            # Each query goes until a batch doesn't fill up with the rows it's picking out.
+            queries = [(self.archive_schedules_query, self.tables[0])]
+            if self.orphans:
+                queries.append((self.archive_orphans_query, self.tables[2]))
+            for query, picked in queries:
+                while True:
+                    batch = self.run_batch(cursor, query, parameters, export)
+                    for table, count in batch.items():
+                        totals[table] += count
+                        self.metrics.increment("darwindb_rows_total", count, table=table, operation="archive")
+                    elapsed = time.perf_counter() - start
+                    if sum(batch.values()) > 0:
+                        log.info("Archived {}; {} so far, {:.0f} rows/s".format(
+                            self.describe(batch), self.describe(totals), sum(totals.values()) / elapsed if elapsed else 0))
+
+                    if batch[picked] < self.batch_size:
+                        break
+                    if self.pause:
+                        time.sleep(self.pause)
+        finally:
+            if export is not None:
+                export.close()
+            cursor.close()
+
+        return totals
+
+    def run_batch(self, cursor, query, parameters, export):
+        try:
+            cursor.execute(query, parameters)
+            if export is None:
+                batch = dict(zip(self.tables, cursor.fetchone()))
+            else:
+                batch = dict([(t, 0) for t in self.tables])
+                for table, row in cursor:
+                    export.write('{{"table": "{}", "row": {}}}\n'.format(table, row).encode("utf-8"))
+                    batch[table] += 1
+                export.flush()
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        return batch
+
+    def count(self, cursor, parameters):
+        schedule, location, assoc = self.tables
+        cursor.execute(
+                ("WITH victims AS ({finished}) SELECT (SELECT count(*) FROM victims), " +
+                 "(SELECT count(*) FROM {location} WHERE rid IN (SELECT rid FROM victims)), " +
+                 "(SELECT count(*) FROM {assoc} WHERE main_rid IN (SELECT rid FROM victims) OR assoc_rid IN (SELECT rid FROM victims))" +
+                 (" + (SELECT count(*) FROM ({orphans}) o)" if self.orphans else "")).format(
+                    finished=self.finished_query, orphans=self.orphans_query, location=location, assoc=assoc),
+                parameters)
+        totals = dict(zip(self.tables, cursor.fetchone()))
+        self.connection.rollback()
+        return totals
+
+    def describe(self, counts):
+        return ", ".join(["{} {} rows".format(count, table) for table, count in counts.items()])
+
+
+if __name__ == "__main__":
+    from darwindb.stores import PostgresConnection, PostgresStore
+
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description="Archives schedules which finished more than --days ago.")
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--pause", type=float, default=0, help="Seconds to sleep between batches.")
+    parser.add_argument("--export", help="Append the archived rows to this gzip file rather than archive tables.")
+    parser.add_argument("--orphans", action="store_true",
+                        help="Also archive associations where either schedule is missing.")
+    parser.add_argument("--dry-run", action="store_true", help="Only count what would be archived.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    connection = PostgresConnection(host=os.environ["POSTGRES_HOST"],
+                                    dbname=os.environ["POSTGRES_DB"],
+                                    user=os.environ["POSTGRES_USER"],
+                                    password=os.environ["POSTGRES_PASS"])
+    connection.connect()
+
+    # Which tables the rows are archived from depends on how they're laid out.
+    cursor = connection.cursor()
+    _, compact, split_forecasts = PostgresStore(connection).table_layout(cursor)
+    connection.commit()
+    cursor.close()
+
+    store = PostgresStore(connection, compact=compact, split_forecasts=split_forecasts)
+    archiver = Archiver(store, days=args.days, batch_size=args.batch_size, pause=args.pause,
+                        export_path=args.export, orphans=args.orphans, dry_run=args.dry_run)
+    archiver.run()
@@ -0,0 +1,119 @@
+from darwindb.cache import LRUCache
+from darwindb.stores.PostgresStore import Store as PostgresStore
+from darwindb.stores.PostgresStore import Connection as PostgresConnection
+
+from collections import namedtuple
+import threading
+
+
+""" Everything stored about one service.
+
+schedule is its schedule row, locations its schedule_location rows in order, and associations the
+association rows where it's either the main or associated service, such as the trains it joins
+(category JJ), divides into (VV) or forms next (NP). Each row is a namedtuple of the table's
+columns, and times are in the connection's time zone.
+"""
+Service = namedtuple("Service", ["schedule", "locations", "associations"])
+
+
+""" Reads whole services from the tables a PostgresStore writes, each with one prepared statement.
+
+The statement gathers each column of the service's locations and associations into an array on
+the server, which psycopg2 parses far faster than it would arrays of rows, and they're zipped back
+into rows here. Lookups are made on a connection of their own, made from connection_args, in
+autocommit mode, so each takes one round trip and never touches a transaction an ingest store is
+part way through. They're made one at a time, whichever thread they come from. The tables are
+found from store_args, as given to the PostgresStore which writes them.
+
+With cache_bytes set, services which were found are kept in an LRUCache of about that size. Their
+entries are only invalidated when a store in this process, created with on_write=invalidate, writes
+to them, so don't set it if anything else writes to the database (such as ShardedIngest's
+workers). The services returned are shared with the cache, so shouldn't be modified.
+"""
+class Services:
+
+    def __init__(self, connection_args, store_args=None, cache_bytes=0):
+        self.connection = PostgresConnection(**connection_args)
+        self.connection.connect()
+        self.connection.set_autocommit(True)
+        store = PostgresStore(self.connection, **(store_args or {}))
+        self.tables = [store.table_schedule_name, store.schedule_location_source, store.table_assoc_name]
+        self.statement = "darwindb_service"
+        self.cursor = None
+        self.connection_lock = threading.Lock()
+
+        # Stores commit from whichever thread they're used on, so the cache is only touched with the
+        # lock held. Any invalidation while a service is being read might have been of that service,
+        # so then it's not cached, as it could already be out of date.
+        if cache_bytes:
+            self.cache = LRUCache(max_bytes=cache_bytes)
+        else:
+            self.cache = None
+        self.lock = threading.Lock()
+        self.invalidations = 0
+
+    """ Prepares the statement, and makes the row types, from the columns the tables actually have. """
+    def prepare(self, cursor):
+        columns = []
+        for table in self.tables:
+            cursor.execute("SELECT * FROM {} LIMIT 0".format(table))
+            columns.append([d[0] for d in cursor.description])
+        self.row_types = [namedtuple(name, c) for name, c in zip(["Schedule", "Location", "Association"], columns)]
+        self.widths = [len(c) for c in columns]
+
+        cursor.execute(
+                ("PREPARE {statement} (varchar) AS SELECT s.*, l.*, a.* FROM {schedule} s, " +
+                    "LATERAL (SELECT {location_arrays} FROM {location} l WHERE l.rid = s.rid) l, " +
+                    "LATERAL (SELECT {assoc_arrays} FROM {assoc} a WHERE a.main_rid = s.rid OR a.assoc_rid = s.rid) a " +
+                "WHERE s.rid = $1").format(
+                statement=self.statement,
+                schedule=self.tables[0],
+                location=self.tables[1],
+                assoc=self.tables[2],
+                location_arrays=", ".join(["array_agg(l.{} ORDER BY l.position)".format(c) for c in columns[1]]),
+                assoc_arrays=", ".join(["array_agg(a.{} ORDER BY a.id)".format(c) for c in columns[2]])))
+
+    """ Returns the Service with this rid, or None if there isn't one. """
+    def service(self, rid):
+        if self.cache is not None:
+            with self.lock:
+                cached = self.cache.get(rid)
+                invalidations = self.invalidations
+            if cached is not None:
+                return cached
+
+        service = self.fetch(rid)
+
+        if self.cache is not None and service is not None:
+            with self.lock:
+                if self.invalidations == invalidations:
+                    self.cache.put(rid, service)
+        return service
+
+    def fetch(self, rid):
+        with self.connection_lock:
+            if self.cursor is None:
+                cursor = self.connection.cursor()
+                self.prepare(cursor)
+                self.cursor = cursor
+
+            self.cursor.execute("EXECUTE {} (%s)".format(self.statement), (rid,))
+            row = self.cursor.fetchone()
+        if row is None:
+            return None
+
+        schedule, location, assoc = self.row_types
+        n, m = self.widths[0], self.widths[0] + self.widths[1]
+        return Service(
+                schedule(*row[:n]),
+                list(map(location, *row[n:m])) if row[n] is not None else [],
+                list(map(assoc, *row[m:])) if row[m] is not None else [])
+
+    """ Forgets any cached services with these rids. Pass this as a PostgresStore's on_write. """
+    def invalidate(self, rids):
+        if self.cache is None:
+            return
+        with self.lock:
+            self.invalidations += 1
+            for rid in rids:
+                self.cache.invalidate(rid)
@@ -0,0 +1,111 @@
+from darwindb.ingest import apply_frame, shard_for_rid, shard_frame
+from darwindb.stores.BaseStore import BaseStore
+from darwindb.stores.PostgresStore import Store as PostgresStore
+from darwindb.stores.PostgresStore import Connection as PostgresConnection
+
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+
+
+""" One PostgresStore, with its own connection, and the thread which all its calls are made on.
+
+As the lane only has a single thread, calls are made in exactly the order they were submitted.
+Once a call on any of the owner's lanes has failed, calls not yet made are refused (see Store).
+"""
+class Lane:
+
+    def __init__(self, n, owner, connection_args, store_args):
+        self.owner = owner
+        self.connection = PostgresConnection(**connection_args)
+        self.store = PostgresStore(self.connection, **store_args)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="darwindb-lane-{}".format(n))
+
+    """ Connects, or reconnects, the lane's store, forgetting its cursor and caches from any old connection. """
+    def connect(self):
+        self.connection.connect()
+        self.store.reset()
+
+    def submit(self, f, *args):
+        return asyncio.wrap_future(self.executor.submit(self.call, f, *args))
+
+    def call(self, f, *args):
+        if self.owner.failed is not None:
+            raise RuntimeError("Not saving, as an earlier save failed: {}".format(self.owner.failed))
+        try:
+            return f(*args)
+        except Exception as e:
+            if self.owner.failed is None:
+                self.owner.failed = repr(e)
+            raise
+
+
+""" An asyncio Store, which saves messages to PostgreSQL across several connections at once.
+
+psycopg2 blocks, so each connection is driven from its own thread (see Lane) and every method here
+is a coroutine which completes once the blocking call has. Messages are routed to a lane by rid
+(associations by the rid of the main service), so everything about one train is saved in the order
+it was submitted, while a slow statement only holds up the trains which share its lane.
+
+The routing happens as soon as a coroutine starts running, so callers wanting messages applied in
+order should start them in that order, e.g. by creating their tasks in the order received.
+
+If anything fails, every lane stops saving straight away, rather than going on to save later
+messages about trains which the failure may have left behind, or to commit their parts of later
+frames. Everything from the failed frame on should then be saved again, in order, once whatever
+was already submitted has finished and connect() has been called again, as AsyncClient does.
+"""
+class Store(BaseStore):
+
+    def __init__(self, connection_args, lanes=4, store_args=None, metrics=None):
+        store_args = dict(store_args or {}, metrics=metrics)
+        self.failed = None
+        self.lanes = [Lane(n, self, connection_args, store_args) for n in range(0, lanes)]
+
+    def lane(self, rid):
+        return self.lanes[shard_for_rid(rid, len(self.lanes))]
+
+    async def connect(self):
+        self.failed = None
+        await asyncio.gather(*[lane.submit(lane.connect) for lane in self.lanes])
+
+    async def create_tables(self):
+        await self.lanes[0].submit(self.lanes[0].store.create_tables)
+
+    async def check_indexes(self):
+        return await self.lanes[0].submit(self.lanes[0].store.check_indexes)
+
+    async def close(self):
+        for lane in self.lanes:
+            lane.executor.shutdown(wait=False)
+
+    """ Saves a decoded frame, each lane's share of it in a single transaction. """
+    async def save_frame(self, m):
+        parts = shard_frame(m, len(self.lanes))
+        await asyncio.gather(*[self.lanes[n].submit(apply_frame, self.lanes[n].store, part)
+                               for n, part in parts.items()])
+
+    async def save_association_message(self, message, snapshot=False):
+        lane = self.lane(message["main_service"]["rid"])
+        await lane.submit(lane.store.save_association_message, message, snapshot)
+
+    async def save_deactivated_message(self, message, snapshot=False):
+        lane = self.lane(message["rid"])
+        await lane.submit(lane.store.save_deactivated_message, message, snapshot)
+
+    async def save_schedule_message(self, message, snapshot=False):
+        lane = self.lane(message["rid"])
+        await lane.submit(lane.store.save_schedule_message, message, snapshot)
+
+    async def save_snapshot_schedule_messages(self, messages):
+        await self.save_frame({
+            "message_type": "snapshot",
+            "schedule_messages": messages,
+            "association_messages": [],
+            "deactivated_messages": [],
+            "train_status_messages": [],
+        })
+
+    async def save_train_status_message(self, message, snapshot=False):
+        lane = self.lane(message["rid"])
+        await lane.submit(lane.store.save_train_status_message, message, snapshot)
@@ -1,8 +1,19 @@
+from contextlib import contextmanager
+
 class StoreMethodNotImplementedError(Exception):
     pass
 
 class BaseStore:
 
+    """ Groups the messages saved inside the block into one unit of work.
+
+    Stores without transactions apply each message as it is saved, so the default
+    implementation does nothing beyond running the block.
+    """
+    @contextmanager
+    def batch(self):
+        yield self
+
     def save_association_message(self, message, snapshot):
         raise StoreMethodNotImplemented("Store does not implement save_association_message(self, message).")
 
@@ -12,6 +23,10 @@ class BaseStore:
     def save_schedule_message(self, message, snapshot):
         raise StoreMethodNotImplemented("Store does not implement save_schedule_message(self, message).")
 
+    def save_snapshot_schedule_messages(self, messages):
+        for message in messages:
+            self.save_schedule_message(message, True)
+
     def save_train_status_message(self, message, snapshot):
         raise StoreMethodNotImplemented("Store does not implement save_train_status_message(self, message).")
 
@@ -1,14 +1,23 @@
+from darwindb.cache import deep_sizeof, LRUCache
+from darwindb.metrics import Metrics
 from darwindb.stores import BaseStore
 from darwindb.utils import *
 
-from collections import OrderedDict
+from collections import Counter, deque, OrderedDict
+from contextlib import contextmanager
 
 from datetime import date, datetime, time, timedelta
-from dateutil.parser import parse
+from time import perf_counter
 
+import json
+import logging
 import psycopg2
 import pytz
 
+from psycopg2.extras import execute_values
+
+log = logging.getLogger("darwindb")
+
 """ Convenience class that wraps a Postgres Database Connection. """
 class Connection:
 
@@ -18,27 +27,131 @@ class Connection:
         self.user = user
         self.password = password
 
+    """ Connects, or reconnects, to the database.
+
+    On reconnecting, the old connection is closed, so any transaction left open on it is rolled
+    back. Stores using the connection notice and reset themselves (see Store.reset()).
+    """
     def connect(self):
+        old = getattr(self, "conn", None)
         self.conn = psycopg2.connect("host='{}' dbname='{}' user='{}' password='{}'".format(
             self.host, self.dbname, self.user, self.password))
-
-    def cursor(self):
-        return self.conn.cursor()
+        if old is not None:
+            try:
+                old.close()
+            except Exception:
+                pass
+
+    """ Returns a new cursor. Naming it makes it a server-side cursor, which streams its rows. """
+    def cursor(self, name=None):
+        return self.conn.cursor(name)
     
     def commit(self):
         return self.conn.commit()
 
+    def rollback(self):
+        return self.conn.rollback()
+
+    def set_autocommit(self, autocommit):
+        self.conn.autocommit = autocommit
+
+
+""" Stands in for a psycopg2 cursor, adding up the time spent in the database on the store.
+
+Stores time how long saving each message takes in the database this way (see Measure). COPY
+renders its rows as it goes (see CopyBuffer), so that time is included for copy_expert().
+"""
+class TimedCursor:
+
+    def __init__(self, cursor, store):
+        self.cursor = cursor
+        self.store = store
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, query, vars=None):
+        start = perf_counter()
+        try:
+            return self.cursor.execute(query, vars)
+        finally:
+            self.store.execute_seconds += perf_counter() - start
+
+    def executemany(self, query, vars_list):
+        start = perf_counter()
+        try:
+            return self.cursor.executemany(query, vars_list)
+        finally:
+            self.store.execute_seconds += perf_counter() - start
+
+    def copy_expert(self, sql, file, size=8192):
+        start = perf_counter()
+        try:
+            return self.cursor.copy_expert(sql, file, size)
+        finally:
+            self.store.execute_seconds += perf_counter() - start
+
+
+""" File-like object which renders rows lazily in the PostgreSQL COPY text format.
+
+psycopg2's copy_expert() pulls data from this with read(), so rows are only ever
+formatted a chunk at a time rather than building the whole payload in memory.
+"""
+class CopyBuffer:
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.pending = ""
+
+    def read(self, size=-1):
+        chunks = [self.pending]
+        length = len(self.pending)
+        while size < 0 or length < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            line = "\t".join([self.format_value(v) for v in row]) + "\n"
+            chunks.append(line)
+            length += len(line)
+        data = "".join(chunks)
+        if size < 0:
+            self.pending = ""
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+    @staticmethod
+    def format_value(v):
+        if v is None:
+            return "\\N"
+        if v is True:
+            return "t"
+        if v is False:
+            return "f"
+        return str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
 
 """ Injects a database cursor into the kwargs of the method call.
 
 The cursor is initialised as a member of the Object, and it's queries are
-prepared before the decorated method is actually called.
+prepared before the decorated method is actually called. If the connection has
+been reconnected since, the store is reset (see Store.reset()) and a new cursor
+made on the new connection, with its queries prepared again.
 """
 def Cursor(f):
     def wrapper(*args, **kwargs):
         self = args[0]
-        if not hasattr(self, '_cursor') or self._cursor is None:
+        if getattr(self, '_cursor', None) is not None and self._cursor_conn is not self.connection.conn:
+            self.reset()
+        if getattr(self, '_cursor', None) is None:
+            self._cursor_conn = self.connection.conn
             self._cursor = self.connection.cursor()
+            if self.profiler is not None:
+                self._cursor = self.profiler.wrap(self._cursor)
+            self._cursor = TimedCursor(self._cursor, self)
             self.prepare_queries(self._cursor)
         kwargs["cursor"] = self._cursor
         return f(*args, **kwargs)
@@ -48,17 +161,49 @@ def Cursor(f):
 """ Commits current transaction to the database once the decorated method returns.
 
 This decorator uses the object's database connection to commit the transaction
-after the decorated method has been completed.
+after the decorated method has been completed. If the method is called inside a
+Store.batch() block, the commit is left to the end of the batch instead. If the
+method or the commit raises outside of a batch, the transaction is rolled back so
+the connection remains usable, and nothing cached from it is kept.
 """
 def Commit(f):
     def wrapper(*args, **kwargs):
         self = args[0]
-        r = f(*args, **kwargs)
-        self.connection.commit()
+        if self._batch_depth > 0:
+            return f(*args, **kwargs)
+        try:
+            r = f(*args, **kwargs)
+            self.commit("message")
+        except:
+            self.rollback()
+            raise
         return r
     return wrapper
 
 
+""" Records how long the decorated save method takes, and how much of that was spent executing
+statements in the database, and counts the message it saves.
+
+It goes inside the @Commit decorator, so the time doesn't include committing.
+"""
+def Measure(message_type):
+    def decorator(f):
+        def wrapper(*args, **kwargs):
+            self = args[0]
+            if self.profiler is not None:
+                round_trips = self.profiler.round_trips
+            execute_seconds = self.execute_seconds
+            with self.metrics.time("darwindb_stage_seconds", stage="save", type=message_type):
+                r = f(*args, **kwargs)
+            self.metrics.observe("darwindb_stage_seconds", self.execute_seconds - execute_seconds, stage="execute", type=message_type)
+            self.metrics.increment("darwindb_messages_total", type=message_type)
+            if self.profiler is not None:
+                self.profiler.end_message(message_type, round_trips)
+            return r
+        return wrapper
+    return decorator
+
+
 class Store(BaseStore):
 
     table_schedule_name = "schedule"
@@ -141,8 +286,39 @@ class Store(BaseStore):
             ("forecast_pass_unknown_delay", "boolean"),
             ("forecast_pass_source", "varchar"),
             ("forecast_pass_source_cis", "varchar"),
+            ("start_date", "date"),
     ])
 
+    # With partition_days set, schedule and schedule_location are range partitioned by start_date.
+    # Their primary keys then have to include it, and schedule_location can't reference schedule,
+    # as every partition of it would need checking whenever one of schedule's was detached.
+    table_schedule_partitioned_fields = OrderedDict(table_schedule_fields, rid="varchar NOT NULL")
+    table_schedule_location_partitioned_fields = OrderedDict(table_schedule_location_fields,
+            id="bigserial NOT NULL", rid="varchar NOT NULL", start_date="date NOT NULL")
+    table_partitioned_keys = OrderedDict([
+            (table_schedule_name, "rid"),
+            (table_schedule_location_name, "id"),
+    ])
+
+    # With split_forecasts set, the columns train status messages update live in a narrow table of
+    # their own, so updating them doesn't copy the rest of the location. Its pages are left part
+    # empty, so the new versions of rows can usually go on the same page as a HOT update. Whole
+    # locations can be read from the view joining the two.
+    table_schedule_location_static_fields = OrderedDict(
+            list(table_schedule_location_fields.items())[0:20] + list(table_schedule_location_fields.items())[55:])
+    table_schedule_location_forecast_name = "schedule_location_forecast"
+    table_schedule_location_forecast_fields = OrderedDict(
+            [("id", "bigint PRIMARY KEY NOT NULL REFERENCES {} (id) ON DELETE CASCADE".format(table_schedule_location_name))] +
+            list(table_schedule_location_fields.items())[20:55])
+    table_schedule_location_forecast_fillfactor = 70
+    table_schedule_location_view_name = "schedule_location_full"
+
+    # Partitions cover partition_days from a Monday, so weekly ones line up with the timetable week.
+    partition_epoch = date(2000, 1, 3)
+
+    table_schedule_staging_name = "schedule_staging"
+    table_schedule_location_staging_name = "schedule_location_staging"
+
     table_assoc_name = "association"
     table_assoc_fields = OrderedDict([
         ("id", "bigserial PRIMARY KEY NOT NULL"),
@@ -163,24 +339,226 @@ class Store(BaseStore):
         ("assoc_raw_public_departure_time", "time"),
         ("assoc_raw_working_departure_time", "time"),
     ])
+    table_assoc_constraints = OrderedDict([
+        ("association_main_rid_assoc_rid_key", "UNIQUE (main_rid, assoc_rid)"),
+    ])
+
+    # The association lookups by (main_rid, assoc_rid), and darwindb.services' by main_rid, use the index
+    # behind the unique constraint above, while its lookups by assoc_rid have one of their own. The one
+    # on start_date lets darwindb.retention find old schedules without a full scan, and the ones on
+    # tiploc and working times serve darwindb.boards.
+    table_indexes = OrderedDict([
+        ("schedule_start_date_idx", (table_schedule_name, "(start_date)")),
+        ("schedule_location_rid_position_idx", (table_schedule_location_name, "(rid, position)")),
+        ("schedule_location_tiploc_working_departure_time_idx", (table_schedule_location_name, "(tiploc, working_departure_time)")),
+        ("schedule_location_tiploc_working_arrival_time_idx", (table_schedule_location_name, "(tiploc, working_arrival_time)")),
+        ("association_assoc_rid_idx", (table_assoc_name, "(assoc_rid)")),
+    ])
+
+    # With compact set, schedule_location is instead a view over schedule_location_compact, which
+    # stores each tiploc as an id in the tiploc table, and times as whole seconds: timestamps from
+    # midnight UTC on the service's start date, and raw times from midnight. The view presents the
+    # usual columns, and triggers on it translate writes, so the queries are the same either way.
+    table_schedule_location_compact_name = "schedule_location_compact"
+    table_tiploc_name = "tiploc"
+    table_tiploc_fields = OrderedDict([
+            ("id", "serial PRIMARY KEY NOT NULL"),
+            ("tiploc", "varchar UNIQUE NOT NULL"),
+    ])
 
-    def __init__(self, connection):
+    table_compact_indexes = OrderedDict([
+        ("schedule_start_date_idx", (table_schedule_name, "(start_date)")),
+        ("schedule_location_compact_rid_position_idx", (table_schedule_location_compact_name, "(rid, position)")),
+        ("schedule_location_compact_tiploc_working_departure_time_idx", (table_schedule_location_compact_name,
+            "(tiploc, darwindb_decode_timestamp(working_departure_time, start_date))")),
+        ("schedule_location_compact_tiploc_working_arrival_time_idx", (table_schedule_location_compact_name,
+            "(tiploc, darwindb_decode_timestamp(working_arrival_time, start_date))")),
+        ("association_assoc_rid_idx", (table_assoc_name, "(assoc_rid)")),
+    ])
+
+    # Each of these is simple enough for Postgres to inline it into the view's queries.
+    compact_functions = [
+        "CREATE OR REPLACE FUNCTION darwindb_encode_timestamp(t timestamp with time zone, d date) RETURNS integer AS " +
+            "$$ SELECT extract(epoch FROM t - (d::timestamp AT TIME ZONE 'UTC'))::integer $$ LANGUAGE sql IMMUTABLE STRICT",
+        "CREATE OR REPLACE FUNCTION darwindb_decode_timestamp(s integer, d date) RETURNS timestamp with time zone AS " +
+            "$$ SELECT to_timestamp((extract(epoch FROM d::timestamp) + s)::double precision) $$ LANGUAGE sql IMMUTABLE STRICT",
+        "CREATE OR REPLACE FUNCTION darwindb_encode_time(t time) RETURNS integer AS " +
+            "$$ SELECT extract(epoch FROM t)::integer $$ LANGUAGE sql IMMUTABLE STRICT",
+        "CREATE OR REPLACE FUNCTION darwindb_decode_time(s integer) RETURNS time AS " +
+            "$$ SELECT time '00:00' + s * interval '1 second' $$ LANGUAGE sql IMMUTABLE STRICT",
+    ]
+
+    def __init__(self, connection, set_based_train_status=False, schedule_cache_bytes=64*1024*1024, metrics=None,
+                 profiler=None, partition_days=None, compact=False, split_forecasts=False, on_write=None):
         self.connection = connection
+        self.set_based_train_status = set_based_train_status
+        self._batch_depth = 0
+
+        # How many days of schedules each partition holds, or None if the tables aren't partitioned
+        # (see create_tables() and maintain_partitions()).
+        self.partition_days = partition_days
+
+        # Whether schedule_location is stored in the compact layout (see create_tables()).
+        self.compact = compact
+        if compact:
+            if partition_days is not None:
+                raise Exception("The compact layout can't be partitioned.")
+            self.table_indexes = self.table_compact_indexes
+
+        # Whether the columns train status messages update are kept in a table of their own (see above).
+        self.split_forecasts = split_forecasts
+        if split_forecasts and (compact or partition_days is not None):
+            raise Exception("Forecasts can't be split out of compact or partitioned tables.")
+
+        # Where train status messages write to, and where whole schedule_location rows are read from.
+        forecast_table = self.table_schedule_location_forecast_name if split_forecasts else self.table_schedule_location_name
+        self.schedule_location_source = self.table_schedule_location_view_name if split_forecasts else self.table_schedule_location_name
+
+        # Where counters and timings of each stage of ingest are sent (see darwindb.metrics).
+        self.metrics = metrics or Metrics()
+
+        # Times every statement when set (see darwindb.profiling). Left as None, it costs nothing.
+        self.profiler = profiler
+
+        # Running totals of how many writes were made, or avoided, by this store, and of the time
+        # spent executing statements (see TimedCursor).
+        self.counters = Counter()
+        self.execute_seconds = 0.0
+
+        # Called with the set of rids each transaction wrote to once it commits, such as to invalidate
+        # a darwindb.services cache. Left as None, they aren't tracked.
+        self.on_write = on_write
+        self.written = set()
+
+        # Caches the timezone and ts_select_points rows of recently seen schedules by rid, so train
+        # status messages don't need to fetch them again. Setting the size to 0 disables it.
+        if schedule_cache_bytes:
+            self.schedule_cache = LRUCache(max_bytes=schedule_cache_bytes)
+        else:
+            self.schedule_cache = None
+
+        # Partitioned tables can only enforce uniqueness within a partition, so their schedules are
+        # keyed by start_date as well as rid.
+        schedule_key = "(rid)" if partition_days is None else "(rid, start_date)"
 
-        self.insert_schedule_query = "INSERT into {} ({}) VALUES({})".format(
+        # Snapshot schedules must not overwrite the ones we already have, whereas live ones do. The
+        # upsert reports whether the row was newly inserted (xmax is only set on the updated tuple).
+        # Partitioned tables can't return xmax, so there we look for the row as the statement starts.
+        if partition_days is None:
+            inserted = "xmax = 0"
+        else:
+            inserted = "NOT EXISTS (SELECT 1 FROM {} WHERE rid=$1 AND start_date=$4)".format(self.table_schedule_name)
+        self.prepare_insert_schedule_query = "PREPARE schedule_insert AS INSERT into {} ({}) VALUES({}) ON CONFLICT {} DO NOTHING RETURNING rid".format(
                 self.table_schedule_name,
                 ", ".join(["{}".format(k) for k, v in list(self.table_schedule_fields.items())[0:15]]),
+                ", ".join(["$"+str(n+1) for n in range(0, 15)]),
+                schedule_key)
+
+        self.prepare_upsert_schedule_query = "PREPARE schedule_upsert AS INSERT into {} ({}) VALUES({}) ON CONFLICT {} DO UPDATE SET {} RETURNING ({})".format(
+                self.table_schedule_name,
+                ", ".join(["{}".format(k) for k, v in list(self.table_schedule_fields.items())[0:15]]),
+                ", ".join(["$"+str(n+1) for n in range(0, 15)]),
+                schedule_key,
+                ", ".join(["{}=EXCLUDED.{}".format(k, k) for k, v in list(self.table_schedule_fields.items())[1:15]]),
+                inserted)
+
+        self.execute_insert_schedule_query = "EXECUTE schedule_insert ({})".format(
+                ", ".join(["%s" for n in range(0, 15)]))
+
+        self.execute_upsert_schedule_query = "EXECUTE schedule_upsert ({})".format(
                 ", ".join(["%s" for n in range(0, 15)]))
         
-        self.insert_schedule_location_query = "INSERT into {} ({}) VALUES({})".format(
+        # The columns schedule_location_values() gives values for.
+        schedule_location_columns = ", ".join([k for k, v in list(self.table_schedule_location_fields.items())[1:20]] + ["start_date"])
+
+        # Used with execute_values() so all of a schedule's locations go in one statement. New
+        # locations need an empty row of forecasts to go with them, if those are split out.
+        self.insert_schedule_locations_query = "INSERT into {} ({}) VALUES %s".format(
                 self.table_schedule_location_name,
-                ", ".join(["{}".format(k) for k, v in list(self.table_schedule_location_fields.items())[1:20]]),
-                ", ".join(["%s" for n in range(0, 19)]))
+                schedule_location_columns)
+        if split_forecasts:
+            self.insert_schedule_locations_query = "WITH l AS ({} RETURNING *), f AS (INSERT INTO {} (id) SELECT id FROM l) ".format(
+                    self.insert_schedule_locations_query,
+                    forecast_table)
+
+        schedule_columns = ", ".join([k for k, v in list(self.table_schedule_fields.items())[0:15]])
+
+        self.create_schedule_staging_query = "CREATE TEMP TABLE IF NOT EXISTS {} ON COMMIT DELETE ROWS AS SELECT 0 AS seq, {} FROM {} WITH NO DATA".format(
+                self.table_schedule_staging_name,
+                schedule_columns,
+                self.table_schedule_name)
+
+        self.create_schedule_location_staging_query = "CREATE TEMP TABLE IF NOT EXISTS {} ON COMMIT DELETE ROWS AS SELECT 0 AS seq, {} FROM {} WITH NO DATA".format(
+                self.table_schedule_location_staging_name,
+                schedule_location_columns,
+                self.table_schedule_location_name)
+
+        self.copy_schedule_staging_query = "COPY {} (seq, {}) FROM STDIN".format(
+                self.table_schedule_staging_name,
+                schedule_columns)
+
+        self.copy_schedule_location_staging_query = "COPY {} (seq, {}) FROM STDIN".format(
+                self.table_schedule_location_staging_name,
+                schedule_location_columns)
+
+        # Only the first staged copy of each rid is used, and only rids which were not already in
+        # the schedule table get their locations inserted.
+        self.merge_schedule_staging_query = (
+                "WITH staged AS (SELECT DISTINCT ON (rid) * FROM {staging} ORDER BY rid, seq), " +
+                "inserted AS (INSERT INTO {schedule} ({schedule_columns}) SELECT {schedule_columns} FROM staged " +
+                    "ON CONFLICT {schedule_key} DO NOTHING RETURNING rid), " +
+                "locations AS (INSERT INTO {location} ({location_columns}) SELECT {l_location_columns} FROM {location_staging} l " +
+                    "JOIN staged s ON s.rid = l.rid AND s.seq = l.seq JOIN inserted i ON i.rid = l.rid " +
+                    "ORDER BY l.seq, l.position RETURNING id){forecasts} " +
+                "SELECT (SELECT count(*) FROM staged), (SELECT count(*) FROM inserted), (SELECT count(*) FROM locations)").format(
+                staging=self.table_schedule_staging_name,
+                schedule=self.table_schedule_name,
+                schedule_key=schedule_key,
+                schedule_columns=schedule_columns,
+                location=self.table_schedule_location_name,
+                location_staging=self.table_schedule_location_staging_name,
+                location_columns=schedule_location_columns,
+                forecasts=", forecasts AS (INSERT INTO {} (id) SELECT id FROM locations)".format(forecast_table) if split_forecasts else "",
+                l_location_columns=", ".join(["l.{}".format(k) for k in schedule_location_columns.split(", ")]))
+
+        # Used to reconcile the locations of an existing schedule with the ones in a new message.
+        location_diff_columns = [
+                "type",
+                "position",
+                "activity_codes",
+                "planned_activity_codes",
+                "cancelled",
+                "false_tiploc",
+                "working_arrival_time",
+                "public_arrival_time",
+                "working_pass_time",
+                "public_departure_time",
+                "working_departure_time",
+                "raw_working_arrival_time",
+                "raw_public_arrival_time",
+                "raw_working_pass_time",
+                "raw_public_departure_time",
+                "raw_working_departure_time",
+        ]
+
+        self.prepare_select_locations_query = "PREPARE sl_select AS SELECT {} FROM {} WHERE rid=$1".format(
+                ", ".join(["id", "tiploc"] + location_diff_columns),
+                self.table_schedule_location_name)
+
+        self.execute_select_locations_query = "EXECUTE sl_select (%s)"
+
+        self.prepare_update_location_query = "PREPARE sl_update AS UPDATE {} SET {} WHERE id=${}".format(
+                self.table_schedule_location_name,
+                ", ".join(["{}=${}".format(k, i+1) for i, k in enumerate(location_diff_columns)]),
+                len(location_diff_columns)+1)
 
-        self.update_schedule_query = "UPDATE {} SET {} WHERE {}".format(
-                self.table_schedule_name,
-                ", ".join(["{}=%s".format(k) for k, v in list(self.table_schedule_fields.items())[1:15]]),
-                "rid=%s")
+        self.execute_update_location_query = "EXECUTE sl_update ({})".format(
+                ", ".join(["%s" for _ in range(0, len(location_diff_columns)+1)]))
+
+        self.prepare_delete_locations_query = "PREPARE sl_delete (bigint[]) AS DELETE FROM {} WHERE id = ANY($1)".format(
+                self.table_schedule_location_name)
+
+        self.execute_delete_locations_query = "EXECUTE sl_delete (%s)"
 
         self.prepare_deactivate_update_query = "PREPARE de_update AS UPDATE {} SET {} WHERE {}".format(
                 self.table_schedule_name,
@@ -190,39 +568,59 @@ class Store(BaseStore):
 
         self.execute_deactivate_update_query = "EXECUTE de_update (%s)"
 
-        self.prepare_insert_assoc_query = "PREPARE assoc_insert AS INSERT into {} ({}) VALUES({})".format(
+        assoc_columns = [k for k, v in list(self.table_assoc_fields.items())[1:]]
+
+        # Snapshot associations must not overwrite the ones we already have, whereas live ones do.
+        self.prepare_insert_assoc_query = "PREPARE assoc_insert AS INSERT into {} ({}) VALUES({}) ON CONFLICT (main_rid, assoc_rid) DO NOTHING".format(
                 self.table_assoc_name,
-                ", ".join(["{}".format(k) for k, v in list(self.table_assoc_fields.items())[1:]]),
-                ", ".join(["$"+str(n+1) for n in range(0, len(self.table_assoc_fields.items())-1)]),
+                ", ".join(assoc_columns),
+                ", ".join(["$"+str(n+1) for n in range(0, len(assoc_columns))]),
         )
 
-        self.prepare_update_assoc_query = "PREPARE assoc_update AS UPDATE {} SET {} WHERE {}".format(
+        self.prepare_upsert_assoc_query = "PREPARE assoc_upsert AS INSERT into {} ({}) VALUES({}) ON CONFLICT (main_rid, assoc_rid) DO UPDATE SET {}".format(
                 self.table_assoc_name,
-                ", ".join(["{}=${}".format(k, i+1) for i, (k, _) in enumerate(list(self.table_assoc_fields.items())[1:])]),
-                "id=${}".format(len(self.table_assoc_fields.items()))
+                ", ".join(assoc_columns),
+                ", ".join(["$"+str(n+1) for n in range(0, len(assoc_columns))]),
+                ", ".join(["{}=EXCLUDED.{}".format(k, k) for k in assoc_columns]),
         )
 
         self.execute_insert_assoc_query = "EXECUTE assoc_insert ({})".format(
-                ", ".join(["%s" for _ in range(0, len(self.table_assoc_fields.items())-1)])
+                ", ".join(["%s" for _ in assoc_columns])
         )
 
-        self.execute_update_assoc_query = "EXECUTE assoc_update ({})".format(
-                ", ".join(["%s" for _ in range(0, len(self.table_assoc_fields.items()))])
+        self.execute_upsert_assoc_query = "EXECUTE assoc_upsert ({})".format(
+                ", ".join(["%s" for _ in assoc_columns])
         )
 
-        self.prepare_check_assoc_query = "PREPARE assoc_check AS SELECT {} from {} WHERE {}".format(
-                "id", self.table_assoc_name, "main_rid=$1 and assoc_rid=$2"
-        )
-
-        self.execute_check_assoc_query = "EXECUTE assoc_check (%s, %s)"
+        # The first 12 columns are used to match train status locations to the schedule's locations
+        # and date their forecasts. The rest are the current forecasts, in the same order as the
+        # ts_update_point parameters, so unchanged ones don't need writing again.
+        self.select_points_columns = "id, tiploc, working_arrival_time, public_arrival_time, working_pass_time, public_departure_time, working_departure_time, raw_working_arrival_time, raw_public_arrival_time, raw_working_pass_time, raw_public_departure_time, raw_working_departure_time, " + \
+                "suppressed, length, detach_front, platform_suppressed, platform_suppressed_by_cis, platform_source, platform_confirmed, platform_number, " + \
+                ", ".join(["forecast_{}_{}".format(kind, k) for kind in ["arrival", "pass", "departure"] for k in [
+                    "estimated_time", "working_estimated_time", "actual_time", "actual_time_removed", "manual_estimate_lower_limit",
+                    "manual_estimate_unknown_delay", "unknown_delay", "source", "source_cis"]])
 
         self.select_points_prepare = "PREPARE ts_select_points as SELECT {} from {} WHERE {}".format(
-                "id, tiploc, working_arrival_time, public_arrival_time, working_pass_time, public_departure_time, working_departure_time, raw_working_arrival_time, raw_public_arrival_time, raw_working_pass_time, raw_public_departure_time, raw_working_departure_time",
-                self.table_schedule_location_name,
+                self.select_points_columns,
+                self.schedule_location_source,
                 "rid=$1")
 
+        # New locations have no forecasts yet, so when those are split out, they're returned empty.
+        if split_forecasts:
+            self.insert_schedule_locations_fetch_query = self.insert_schedule_locations_query + "SELECT {} FROM l".format(
+                    ", ".join([k if k in self.table_schedule_location_static_fields else "NULL" for k in self.select_points_columns.split(", ")]))
+            self.insert_schedule_locations_query += "SELECT 1"
+        else:
+            self.insert_schedule_locations_fetch_query = self.insert_schedule_locations_query + " RETURNING " + self.select_points_columns
+
+        # Which of the 35 ts_update_point parameters the other two statements cover.
+        self.forecast_columns_all = list(range(0, 35))
+        self.forecast_columns_arrival = list(range(0, 17))
+        self.forecast_columns_departure = list(range(0, 8)) + list(range(26, 35))
+
         self.update_point_prepare = "PREPARE ts_update_point as UPDATE {} SET {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {} WHERE {}".format(
-                self.table_schedule_location_name,
+                forecast_table,
                 "suppressed=$1",
                 "length=$2",
                 "detach_front=$3",
@@ -261,7 +659,7 @@ class Store(BaseStore):
                 "id=$36")
 
         self.update_point_arrival_prepare = "PREPARE ts_update_point_arrival as UPDATE {} SET {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {} WHERE {}".format(
-                self.table_schedule_location_name,
+                forecast_table,
                 "suppressed=$1",
                 "length=$2",
                 "detach_front=$3",
@@ -282,7 +680,7 @@ class Store(BaseStore):
                 "id=$18")
 
         self.update_point_departure_prepare = "PREPARE ts_update_point_departure as UPDATE {} SET {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {} WHERE {}".format(
-                self.table_schedule_location_name,
+                forecast_table,
                 "suppressed=$1",
                 "length=$2",
                 "detach_front=$3",
@@ -314,48 +712,517 @@ class Store(BaseStore):
 
         self.update_schedule_select_tz_execute = "EXECUTE ts_update_schedule_select_tz (%s, %s, %s, %s, %s)"
 
-
+        # Used instead of the above when we already know the timezone.
+        self.update_schedule_prepare = "PREPARE ts_update_schedule as UPDATE {} SET {}, {}, {}, {} WHERE {}".format(
+                self.table_schedule_name,
+                "reverse_formation=$1",
+                "late_reason_code=$2",
+                "late_reason_tiploc=$3",
+                "late_reason_near=$4",
+                "rid=$5")
+
+        self.update_schedule_execute = "EXECUTE ts_update_schedule (%s, %s, %s, %s, %s)"
+
+        # Set-based alternative to the train status queries above. All the locations in the message
+        # are passed as one JSON array, matched against the schedule's locations in the database,
+        # and updated with a single statement. Each message location goes to the location which
+        # matches on all of its working times, failing that the working arrival time, and failing
+        # that the working departure time. The dates of the forecast times are worked out in the
+        # same way as apply_date_and_tz_to_time() does in Python.
+        ts_location_fields = OrderedDict([
+                ("ord", "integer"),
+                ("tiploc", "varchar"),
+                ("raw_working_arrival_time", "time"),
+                ("raw_working_pass_time", "time"),
+                ("raw_working_departure_time", "time"),
+                ("suppressed", "boolean"),
+                ("length", "varchar"),
+                ("detach_front", "boolean"),
+                ("platform_suppressed", "boolean"),
+                ("platform_suppressed_by_cis", "boolean"),
+                ("platform_source", "varchar"),
+                ("platform_confirmed", "boolean"),
+                ("platform_number", "varchar"),
+        ])
+        for kind in ["arrival", "pass", "departure"]:
+            ts_location_fields["{}_working_estimated_time".format(kind)] = "time"
+            ts_location_fields["{}_estimated_time".format(kind)] = "time"
+            ts_location_fields["{}_actual_time".format(kind)] = "time"
+            ts_location_fields["{}_manual_estimate_lower_limit".format(kind)] = "time"
+            ts_location_fields["{}_actual_time_removed".format(kind)] = "boolean"
+            ts_location_fields["{}_manual_estimate_unknown_delay".format(kind)] = "boolean"
+            ts_location_fields["{}_unknown_delay".format(kind)] = "boolean"
+            ts_location_fields["{}_source".format(kind)] = "varchar"
+            ts_location_fields["{}_source_cis".format(kind)] = "varchar"
+        self.ts_location_fields = ts_location_fields
+
+        def dated(value, dated_column, raw_column):
+            return ("((l.{d}::date + CASE WHEN m.{v} - l.{r} < interval '-6 hours' THEN 1 " +
+                    "WHEN m.{v} - l.{r} < interval '18 hours' THEN 0 ELSE -1 END) + m.{v}) " +
+                    "AT TIME ZONE s.timezone").format(v=value, d=dated_column, r=raw_column)
+
+        def forecast_times(kind, dated_column, raw_column, estimated_columns):
+            return OrderedDict([
+                ("forecast_{}_estimated_time".format(kind), "CASE {} END".format(" ".join([
+                    "WHEN l.{} IS NOT NULL THEN {}".format(r, dated("{}_estimated_time".format(kind), d, r))
+                    for d, r in estimated_columns]))),
+                ("forecast_{}_working_estimated_time".format(kind), "CASE WHEN l.{} IS NOT NULL THEN {} END".format(
+                    raw_column, dated("{}_working_estimated_time".format(kind), dated_column, raw_column))),
+                ("forecast_{}_actual_time".format(kind), "CASE WHEN l.{} IS NOT NULL THEN {} END".format(
+                    raw_column, dated("{}_actual_time".format(kind), dated_column, raw_column))),
+                ("forecast_{}_actual_time_removed".format(kind), "m.{}_actual_time_removed".format(kind)),
+                ("forecast_{}_manual_estimate_lower_limit".format(kind), "CASE WHEN l.{} IS NOT NULL THEN {} END".format(
+                    raw_column, dated("{}_manual_estimate_lower_limit".format(kind), dated_column, raw_column))),
+                ("forecast_{}_manual_estimate_unknown_delay".format(kind), "m.{}_manual_estimate_unknown_delay".format(kind)),
+                ("forecast_{}_unknown_delay".format(kind), "m.{}_unknown_delay".format(kind)),
+                ("forecast_{}_source".format(kind), "m.{}_source".format(kind)),
+                ("forecast_{}_source_cis".format(kind), "m.{}_source_cis".format(kind)),
+            ])
+
+        # Just like the Python version, the arrival and departure forecasts both take their dates
+        # from the arrival times.
+        arrival_columns = [("public_arrival_time", "raw_public_arrival_time"),
+                           ("working_arrival_time", "raw_working_arrival_time")]
+        ts_platform_columns = OrderedDict([(k, "m.{}".format(k)) for k in list(ts_location_fields.keys())[5:13]])
+        ts_arrival_columns = forecast_times("arrival", "working_arrival_time", "raw_working_arrival_time", arrival_columns)
+        ts_pass_columns = forecast_times("pass", "working_pass_time", "raw_working_pass_time",
+                                         [("working_pass_time", "raw_working_pass_time")])
+        ts_departure_columns = forecast_times("departure", "working_arrival_time", "raw_working_arrival_time", arrival_columns)
+
+        # Columns which a partial match doesn't cover keep their current values.
+        def only_for(columns, tiers):
+            return OrderedDict([(k, "CASE WHEN l.tier IN ({}) THEN {} ELSE l.{} END".format(tiers, v, k))
+                                for k, v in columns.items()])
+
+        self.ts_set_columns = OrderedDict()
+        self.ts_set_columns.update(ts_platform_columns)
+        self.ts_set_columns.update(only_for(ts_arrival_columns, "0, 1"))
+        self.ts_set_columns.update(only_for(ts_pass_columns, "0"))
+        self.ts_set_columns.update(only_for(ts_departure_columns, "0, 2"))
+
+        self.apply_train_status_prepare = (
+                "PREPARE ts_apply (boolean, integer, varchar, boolean, varchar, jsonb) AS " +
+                "WITH s AS (UPDATE {schedule} SET reverse_formation=$1, late_reason_code=$2, late_reason_tiploc=$3, late_reason_near=$4 " +
+                    "WHERE rid=$5 AND EXISTS (SELECT 1 FROM {location} WHERE rid=$5) RETURNING timezone), " +
+                "m AS (SELECT * FROM jsonb_to_recordset($6) AS m({fields})), " +
+                "candidates AS (SELECT m.ord, l.id, {values} FROM m CROSS JOIN s CROSS JOIN LATERAL (" +
+                    "SELECT l.*, CASE " +
+                        "WHEN l.raw_working_arrival_time IS NOT DISTINCT FROM m.raw_working_arrival_time " +
+                        "AND l.raw_working_pass_time IS NOT DISTINCT FROM m.raw_working_pass_time " +
+                        "AND l.raw_working_departure_time IS NOT DISTINCT FROM m.raw_working_departure_time THEN 0 " +
+                        "WHEN l.raw_working_arrival_time = m.raw_working_arrival_time THEN 1 ELSE 2 END AS tier " +
+                    "FROM {source} l WHERE l.rid=$5 AND l.tiploc=m.tiploc AND (" +
+                        "(l.raw_working_arrival_time IS NOT DISTINCT FROM m.raw_working_arrival_time " +
+                        "AND l.raw_working_pass_time IS NOT DISTINCT FROM m.raw_working_pass_time " +
+                        "AND l.raw_working_departure_time IS NOT DISTINCT FROM m.raw_working_departure_time) " +
+                        "OR l.raw_working_arrival_time = m.raw_working_arrival_time " +
+                        "OR l.raw_working_departure_time = m.raw_working_departure_time) " +
+                    "ORDER BY tier, l.position LIMIT 1) l), " +
+                "matched AS (SELECT DISTINCT ON (id) * FROM candidates ORDER BY id, ord DESC), " +
+                "updated AS (UPDATE {forecasts} l SET {assignments} FROM matched WHERE l.id = matched.id " +
+                    "AND ({current}) IS DISTINCT FROM ({new}) RETURNING l.id) " +
+                "SELECT (SELECT count(*) FROM s), ARRAY(SELECT ord FROM candidates), " +
+                    "(SELECT count(*) FROM matched), (SELECT count(*) FROM updated)").format(
+                schedule=self.table_schedule_name,
+                location=self.table_schedule_location_name,
+                source=self.schedule_location_source,
+                forecasts=forecast_table,
+                fields=", ".join(["{} {}".format(k, v) for k, v in ts_location_fields.items()]),
+                values=", ".join(["{} AS {}".format(v, k) for k, v in self.ts_set_columns.items()]),
+                assignments=", ".join(["{}=matched.{}".format(k, k) for k in self.ts_set_columns.keys()]),
+                current=", ".join(["l.{}".format(k) for k in self.ts_set_columns.keys()]),
+                new=", ".join(["matched.{}".format(k) for k in self.ts_set_columns.keys()]))
+
+        self.apply_train_status_execute = "EXECUTE ts_apply (%s, %s, %s, %s, %s, %s)"
+
+
+
+    """ Applies every message saved inside the block in a single transaction.
+
+    The transaction is committed when the outermost batch block exits, or rolled back, along
+    with anything cached from it, if it exits with an exception or the commit fails. Batches may be nested, in which case the inner blocks simply join
+    the outer transaction. Anything that must only happen once the messages are persisted (such
+    as acknowledging the STOMP frame) should be done after the block has exited.
+    """
+    @contextmanager
+    def batch(self):
+        self._batch_depth += 1
+        try:
+            yield self
+            if self._batch_depth == 1:
+                self.commit("batch")
+        except:
+            if self._batch_depth == 1:
+                self.rollback()
+            raise
+        finally:
+            self._batch_depth -= 1
+
+    def commit(self, kind):
+        with self.metrics.time("darwindb_stage_seconds", stage="commit", type=kind):
+            if self.profiler is not None:
+                self.profiler.commit(self.connection)
+            else:
+                self.connection.commit()
+        if self.written:
+            written, self.written = self.written, set()
+            self.on_write(written)
+
+    """ Rolls back the current transaction, and forgets anything cached from it.
+
+    The caches are cleared first, so that's done even if the connection has gone.
+    """
+    def rollback(self):
+        self.written.clear()
+        if self.schedule_cache is not None:
+            self.schedule_cache.clear()
+        self.connection.rollback()
+
+    """ Forgets the cursor, and everything cached, from the connection the store was last used on.
+
+    Run it when the connection is reconnected, which the @Cursor decorator does by itself when it
+    notices. The old cursor's prepared statements went with the old connection, and whatever was
+    cached from it may have been in a transaction which was never committed.
+    """
+    def reset(self):
+        self.written.clear()
+        if self.schedule_cache is not None:
+            self.schedule_cache.clear()
+        cursor, self._cursor = getattr(self, "_cursor", None), None
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    """ Notes that the current transaction writes to these rids, if anything's listening (see on_write). """
+    def wrote(self, *rids):
+        if self.on_write is not None:
+            self.written.update(rids)
 
     # Note that this method deliberately doesn't use the @Cursor and @Commit decorators as they rely
     # on the tables already being created for them to work properly.
+    #
+    # With partition_days set, schedule and schedule_location are created partitioned by start_date,
+    # each with a default partition for schedules outside the ones maintain_partitions() makes.
+    # With compact set, schedule_location is created as a view over the compact layout, and with
+    # split_forecasts, its forecasts are created in a table of their own. Existing tables aren't
+    # converted from one layout to another.
     def create_tables(self):
         cursor = self.connection.cursor()
         
-        schedule_query = "CREATE TABLE IF NOT EXISTS {} ({});".format(
-                self.table_schedule_name,
-                ", ".join(["{} {}".format(k, v) for k, v in self.table_schedule_fields.items()])
-        )
-        
-        schedule_locations_query = "CREATE TABLE IF NOT EXISTS {} ({});".format(
-                self.table_schedule_location_name,
-                ", ".join(["{} {}".format(k, v) for k, v in self.table_schedule_location_fields.items()])
-        )
+        if self.partition_days is None:
+            schedule_query = "CREATE TABLE IF NOT EXISTS {} ({});".format(
+                    self.table_schedule_name,
+                    ", ".join(["{} {}".format(k, v) for k, v in self.table_schedule_fields.items()])
+            )
+
+            schedule_locations_query = "CREATE TABLE IF NOT EXISTS {} ({});".format(
+                    self.table_schedule_location_name,
+                    ", ".join(["{} {}".format(k, v) for k, v in (self.table_schedule_location_static_fields
+                        if self.split_forecasts else self.table_schedule_location_fields).items()])
+            )
+        else:
+            schedule_query = "CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({}, start_date)) PARTITION BY RANGE (start_date);".format(
+                    self.table_schedule_name,
+                    ", ".join(["{} {}".format(k, v) for k, v in self.table_schedule_partitioned_fields.items()]),
+                    self.table_partitioned_keys[self.table_schedule_name]
+            )
+
+            schedule_locations_query = "CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({}, start_date)) PARTITION BY RANGE (start_date);".format(
+                    self.table_schedule_location_name,
+                    ", ".join(["{} {}".format(k, v) for k, v in self.table_schedule_location_partitioned_fields.items()]),
+                    self.table_partitioned_keys[self.table_schedule_location_name]
+            )
 
         assoc_query = "CREATE TABLE IF NOT EXISTS {} ({})".format(
             self.table_assoc_name,
-            ", ".join(["{} {}".format(k, v) for k, v in self.table_assoc_fields.items()])
+            ", ".join(["{} {}".format(k, v) for k, v in self.table_assoc_fields.items()] +
+                      ["CONSTRAINT {} {}".format(k, v) for k, v in self.table_assoc_constraints.items()])
         )
 
-        # TODO: Create indexes.
+        tables = [self.table_schedule_name, self.table_schedule_location_name, self.table_assoc_name,
+                  self.table_schedule_location_compact_name, self.table_tiploc_name, self.table_schedule_location_forecast_name]
+        cursor.execute("SELECT {}".format(", ".join(["to_regclass(%s)" for _ in tables])), tables)
+        existing_tables = [t for t in cursor.fetchone() if t is not None]
+
+        # The queries are built for one layout, so they can't be used on tables in another.
+        if self.table_schedule_location_name in existing_tables:
+            layout = self.table_layout(cursor)
+            if layout != (self.partition_days is not None, self.compact, self.split_forecasts):
+                self.connection.rollback()
+                raise Exception("Tables are laid out with partitioned, compact, split_forecasts = {}, but the store has {}.".format(
+                    layout, (self.partition_days is not None, self.compact, self.split_forecasts)))
+
         cursor.execute(schedule_query)
-        cursor.execute(schedule_locations_query)
+        if self.compact:
+            self.create_compact_tables(cursor)
+        else:
+            cursor.execute(schedule_locations_query)
+        if self.split_forecasts:
+            self.create_forecast_table(cursor)
         cursor.execute(assoc_query)
 
+        if self.partition_days is not None:
+            for table in self.table_partitioned_keys.keys():
+                cursor.execute("CREATE TABLE IF NOT EXISTS {}_default PARTITION OF {} DEFAULT".format(table, table))
+
+        # Tables created before locations carried their schedule's start_date need the column adding.
+        # Their existing rows are left with it NULL, rather than rewriting the whole table.
+        if not self.compact:
+            cursor.execute("ALTER TABLE {} ADD COLUMN IF NOT EXISTS start_date date".format(self.table_schedule_location_name))
+
+        # Tables created before a constraint was introduced need it adding separately.
+        for name, definition in self.table_assoc_constraints.items():
+            cursor.execute("SELECT 1 FROM pg_constraint WHERE conname=%s AND conrelid=%s::regclass",
+                    (name, self.table_assoc_name))
+            if cursor.rowcount == 0:
+                cursor.execute("ALTER TABLE {} ADD CONSTRAINT {} {}".format(self.table_assoc_name, name, definition))
+
+        # Indexes on tables we've just created can be built straight away in this transaction.
+        for name, (table, columns) in self.table_indexes.items():
+            if table not in existing_tables:
+                cursor.execute("CREATE INDEX IF NOT EXISTS {} ON {} {}".format(name, table, columns))
+
         self.connection.commit()
+
+        # Indexes on tables which already exist could take a long time to build, so they're left to
+        # build_indexes(), and check_indexes() reports them as missing until that's been run.
         cursor.close()
 
+    """ Builds any indexes which are missing or invalid on tables which already exist.
+
+    This takes as long as the builds do, so run it away from ingest, on a connection of its own,
+    such as with python -m darwindb.indexes. The indexes are built concurrently so they don't lock
+    out ingest while they build. That can't be done inside a transaction, nor on a partitioned
+    table, where we have to make do with building them in the usual way.
+    """
+    def build_indexes(self):
+        cursor = self.connection.cursor()
+        concurrently = "" if self.table_layout(cursor)[0] else " CONCURRENTLY"
+        self.connection.commit()
+
+        self.connection.set_autocommit(True)
+        try:
+            for name in self.check_indexes(cursor=cursor):
+                if name not in self.table_indexes:
+                    continue
+                table, columns = self.table_indexes[name]
+                # A failed concurrent build leaves an invalid index behind, which needs rebuilding.
+                cursor.execute("DROP INDEX{} IF EXISTS {}".format(concurrently, name))
+                log.info("Creating index {} on {}. This may take a while.".format(name, table))
+                cursor.execute("CREATE INDEX{} IF NOT EXISTS {} ON {} {}".format(concurrently, name, table, columns))
+        finally:
+            self.connection.set_autocommit(False)
+            cursor.close()
+
+    """ Returns whether the existing tables are partitioned, whether they're in the compact layout, and
+    whether their forecasts are split out.
+    """
+    def table_layout(self, cursor):
+        cursor.execute("SELECT (SELECT relkind FROM pg_class WHERE oid = %s::regclass), " +
+                       "(SELECT relkind FROM pg_class WHERE oid = %s::regclass), to_regclass(%s)",
+                       (self.table_schedule_name, self.table_schedule_location_name, self.table_schedule_location_forecast_name))
+        schedule, location, forecasts = cursor.fetchone()
+        return schedule == "p", location == "v", forecasts is not None
+
+    def create_forecast_table(self, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS {} ({}) WITH (fillfactor = {})".format(
+            self.table_schedule_location_forecast_name,
+            ", ".join(["{} {}".format(k, v) for k, v in self.table_schedule_location_forecast_fields.items()]),
+            self.table_schedule_location_forecast_fillfactor))
+        cursor.execute("CREATE OR REPLACE VIEW {} AS SELECT {} FROM {} l LEFT JOIN {} f ON f.id = l.id".format(
+            self.table_schedule_location_view_name,
+            ", ".join(["f.{}".format(k) if k in self.table_schedule_location_forecast_fields and k != "id" else "l.{}".format(k)
+                       for k in self.table_schedule_location_fields.keys()]),
+            self.table_schedule_location_name,
+            self.table_schedule_location_forecast_name))
+
+    """ Returns how each schedule_location column is stored in the compact layout, as its type there,
+    the expression which encodes it from NEW in the triggers, and the one which decodes it in the view.
+    """
+    def compact_columns(self):
+        columns = OrderedDict()
+        for k, v in self.table_schedule_location_fields.items():
+            if k == "tiploc":
+                columns[k] = ("integer NOT NULL REFERENCES {} (id)".format(self.table_tiploc_name),
+                              "darwindb_tiploc(NEW.tiploc)", "t.tiploc")
+            elif k == "start_date":
+                columns[k] = ("date NOT NULL", "NEW.start_date", "c.start_date")
+            elif v == "timestamp with time zone":
+                columns[k] = ("integer", "darwindb_encode_timestamp(NEW.{}, NEW.start_date)".format(k),
+                              "darwindb_decode_timestamp(c.{}, c.start_date)".format(k))
+            elif v == "time":
+                columns[k] = ("integer", "darwindb_encode_time(NEW.{})".format(k), "darwindb_decode_time(c.{})".format(k))
+            else:
+                columns[k] = (v, "NEW.{}".format(k), "c.{}".format(k))
+        return columns
+
+    def create_compact_tables(self, cursor):
+        columns = self.compact_columns()
+        location = self.table_schedule_location_name
+        compact = self.table_schedule_location_compact_name
+
+        cursor.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(
+            self.table_tiploc_name, ", ".join(["{} {}".format(k, v) for k, v in self.table_tiploc_fields.items()])))
+        cursor.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(
+            compact, ", ".join(["{} {}".format(k, v[0]) for k, v in columns.items()])))
+
+        for function in self.compact_functions:
+            cursor.execute(function)
+
+        # Looks up a tiploc's id, adding it if it's new. Another connection may be adding it too.
+        cursor.execute(
+                ("CREATE OR REPLACE FUNCTION darwindb_tiploc(name varchar) RETURNS integer AS $$ " +
+                 "DECLARE tiploc_id integer; " +
+                 "BEGIN " +
+                     "SELECT id INTO tiploc_id FROM {tiploc} WHERE tiploc = name; " +
+                     "IF NOT FOUND THEN " +
+                         "INSERT INTO {tiploc} (tiploc) VALUES (name) ON CONFLICT (tiploc) DO NOTHING RETURNING id INTO tiploc_id; " +
+                         "IF tiploc_id IS NULL THEN " +
+                             "SELECT id INTO tiploc_id FROM {tiploc} WHERE tiploc = name; " +
+                         "END IF; " +
+                     "END IF; " +
+                     "RETURN tiploc_id; " +
+                 "END $$ LANGUAGE plpgsql").format(tiploc=self.table_tiploc_name))
+
+        cursor.execute("CREATE OR REPLACE VIEW {} AS SELECT {} FROM {} c JOIN {} t ON t.id = c.tiploc".format(
+            location, ", ".join(["{} AS {}".format(v[2], k) for k, v in columns.items()]), compact, self.table_tiploc_name))
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (compact,))
+        cursor.execute("ALTER VIEW {} ALTER COLUMN id SET DEFAULT nextval('{}')".format(location, cursor.fetchone()[0]))
+
+        # Tiplocs of existing rows are only looked up again if they have actually changed.
+        assignments = ["{}={}".format(k, v[1]) for k, v in columns.items() if k not in ("id", "tiploc")]
+        assignments.append("tiploc=CASE WHEN NEW.tiploc = OLD.tiploc THEN tiploc ELSE darwindb_tiploc(NEW.tiploc) END")
+        cursor.execute(
+                ("CREATE OR REPLACE FUNCTION {location}_write() RETURNS trigger AS $$ " +
+                 "BEGIN " +
+                     "IF TG_OP = 'DELETE' THEN " +
+                         "DELETE FROM {compact} WHERE id = OLD.id; " +
+                         "RETURN OLD; " +
+                     "ELSIF TG_OP = 'INSERT' THEN " +
+                         "INSERT INTO {compact} ({columns}) VALUES ({values}); " +
+                     "ELSE " +
+                         "UPDATE {compact} SET {assignments} WHERE id = OLD.id; " +
+                     "END IF; " +
+                     "RETURN NEW; " +
+                 "END $$ LANGUAGE plpgsql").format(
+                location=location,
+                compact=compact,
+                columns=", ".join(columns.keys()),
+                values=", ".join([v[1] for v in columns.values()]),
+                assignments=", ".join(assignments)))
+        cursor.execute("DROP TRIGGER IF EXISTS {l}_write ON {l}".format(l=location))
+        cursor.execute("CREATE TRIGGER {l}_write INSTEAD OF INSERT OR UPDATE OR DELETE ON {l} FOR EACH ROW EXECUTE PROCEDURE {l}_write()".format(
+            l=location))
+
+    """ Creates upcoming partitions, and detaches (or drops) ones which are entirely in the past.
+
+    Makes sure there are partitions covering every start date from keep_days before today up to
+    ahead_days after it. Partitions which only hold schedules starting before then are detached,
+    which, unlike deleting their rows, takes the same time however many rows they hold. They're
+    left behind as tables in their own right, to archive or drop, unless drop is True.
+
+    Run it at least daily, with ahead_days covering how far in advance schedules arrive. Schedules
+    which don't have a partition go in the default one, and are moved out of it into the partition
+    for their start date once that's created. Only works with partition_days set. Returns the names
+    of the partitions created and the ones detached.
+    """
+    def maintain_partitions(self, today=None, ahead_days=14, keep_days=28, drop=False):
+        today = today or date.today()
+        first = self.partition_start(today - timedelta(days=keep_days))
+        last = today + timedelta(days=ahead_days)
+
+        cursor = self.connection.cursor()
+        created = []
+        detached = []
+
+        try:
+            # schedule_location is detached before schedule and created after it, so neither ever has
+            # locations for schedules the other lacks.
+            start = first
+            while start <= last:
+                end = start + timedelta(days=self.partition_days)
+                for table in self.table_partitioned_keys.keys():
+                    name = self.partition_name(table, start)
+                    cursor.execute("SELECT to_regclass(%s)", (name,))
+                    if cursor.fetchone()[0] is None:
+                        self.create_partition(cursor, table, name, start, end)
+                        created.append(name)
+                start = end
+
+            for table in reversed(self.table_partitioned_keys.keys()):
+                cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid " +
+                               "WHERE i.inhparent = %s::regclass AND c.relname LIKE %s ORDER BY c.relname",
+                               (table, table + "\\_p%"))
+                for (name,) in cursor.fetchall():
+                    if datetime.strptime(name[-8:], "%Y%m%d").date() + timedelta(days=self.partition_days) <= first:
+                        cursor.execute("ALTER TABLE {} DETACH PARTITION {}".format(table, name))
+                        if drop:
+                            cursor.execute("DROP TABLE {}".format(name))
+                        detached.append(name)
+
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        return created, detached
+
+    # A partition can't be created while the default partition holds rows which belong in it, so
+    # then it's created as a table of its own, they're moved into it, and it's attached afterwards.
+    def create_partition(self, cursor, table, name, start, end):
+        default = "{}_default".format(table)
+        cursor.execute("SELECT 1 FROM {} WHERE start_date >= %s AND start_date < %s LIMIT 1".format(default), (start, end))
+        if cursor.rowcount == 0:
+            cursor.execute("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)".format(name, table), (start, end))
+            return
+
+        cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(name, table))
+        cursor.execute(("WITH moved AS (DELETE FROM {} WHERE start_date >= %s AND start_date < %s RETURNING *) " +
+                        "INSERT INTO {} SELECT * FROM moved").format(default, name), (start, end))
+        cursor.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)".format(table, name), (start, end))
+
+    """ Returns the start of the partition holding schedules starting on the given date. """
+    def partition_start(self, day):
+        return day - timedelta(days=(day - self.partition_epoch).days % self.partition_days)
+
+    def partition_name(self, table, start):
+        return "{}_p{}".format(table, start.strftime("%Y%m%d"))
+
+    """ Returns the names of the indexes the hot queries rely on which are missing or invalid. """
+    def check_indexes(self, cursor=None):
+        close = cursor is None
+        if close:
+            cursor = self.connection.cursor()
+
+        expected = list(self.table_indexes.keys()) + list(self.table_assoc_constraints.keys())
+        cursor.execute("SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid " +
+                       "WHERE c.relname = ANY(%s) AND i.indisvalid AND pg_table_is_visible(c.oid)", (expected,))
+        present = [r[0] for r in cursor.fetchall()]
+
+        if close:
+            self.connection.commit()
+            cursor.close()
+
+        return [name for name in expected if name not in present]
+
     @Commit
     def prepare_queries(self, cursor):
         # Association Queries
         cursor.execute(self.prepare_insert_assoc_query)
-        cursor.execute(self.prepare_check_assoc_query)
-        cursor.execute(self.prepare_update_assoc_query)
+        cursor.execute(self.prepare_upsert_assoc_query)
 
         # Deactivated Queries
         cursor.execute(self.prepare_deactivate_update_query)
 
         # Schedule Queries
-        # TODO: Make all the schedule queries prepared.
+        cursor.execute(self.prepare_insert_schedule_query)
+        cursor.execute(self.prepare_upsert_schedule_query)
+        cursor.execute(self.prepare_select_locations_query)
+        cursor.execute(self.prepare_update_location_query)
+        cursor.execute(self.prepare_delete_locations_query)
 
         # Train Status Queries
         cursor.execute(self.select_points_prepare)
@@ -363,274 +1230,290 @@ class Store(BaseStore):
         cursor.execute(self.update_point_arrival_prepare)
         cursor.execute(self.update_point_departure_prepare)
         cursor.execute(self.update_schedule_select_tz_prepare)
+        cursor.execute(self.update_schedule_prepare)
+        cursor.execute(self.apply_train_status_prepare)
 
     @Cursor
     @Commit
+    @Measure("schedule")
     def save_schedule_message(self, message, snapshot=False, cursor=None):
         # Calculate the date-times on the schedule message.
-        self.build_sanitised_times(message)
+        with self.metrics.time("darwindb_stage_seconds", stage="sanitise", type="schedule"):
+            self.build_sanitised_times(message)
 
-        # Check if the schedule message is already found with that RTTI ID
-        cursor.execute("SELECT rid FROM schedule WHERE rid=%s", (message["rid"],));
+        if snapshot is True:
+            cursor.execute(self.execute_insert_schedule_query, self.schedule_values(message))
+            if cursor.rowcount == 0:
+                print("Didn't add schedule {} becuase it's from a snapshot and we arelady have one with that RID.".format(message["rid"]))
+                return
+            inserted = True
+        else:
+            cursor.execute(self.execute_upsert_schedule_query, self.schedule_values(message))
+            inserted = cursor.fetchone()[0]
+        self.metrics.increment("darwindb_rows_total", table="schedule", operation="insert" if inserted else "update")
+        self.wrote(message["rid"])
 
         #print("*** Saving Schedule Message.")
 
         # Check if this is a new Schedule.
-        if cursor.rowcount == 0:
-            cursor.execute(self.insert_schedule_query, (
-                message["rid"],
-                message["uid"],
-                message["headcode"],
-                message["start_date"],
-                message["toc_code"],
-                message["passenger_service"],
-                message["status"],
-                message["category"],
-                message["active"],
-                message["deleted"],
-                message["charter"],
-                message["cancellation_reason"]["code"] if message.get("cancellation_reason", None) is not None else None,
-                message["cancellation_reason"].get("tiploc", None) if message.get("cancellation_reason", None) is not None else None,
-                message["cancellation_reason"].get("near", None) if message.get("cancellation_reason", None) is not None else None,
-                message["timezone"].zone,
-            ))
-            i = 0
-            for p in message["locations"]:
-                cursor.execute(self.insert_schedule_location_query, (
-                    message["rid"],
-                    p["location_type"],
-                    i,
-                    p.get("tiploc", None),
-                    p.get("activity_codes", None),
-                    p.get("planned_activity_codes", None),
-                    p.get("cancelled", None),
-                    p.get("false_tiploc", None),
-                    p.get("route_delay", None),
-                    p.get("working_arrival_time", None),
-                    p.get("public_arrival_time", None),
-                    p.get("working_pass_time", None),
-                    p.get("public_departure_time", None),
-                    p.get("working_departure_time", None),
-                    p.get("raw_working_arrival_time", None),
-                    p.get("raw_public_arrival_time", None),
-                    p.get("raw_working_pass_time", None),
-                    p.get("raw_public_departure_time", None),
-                    p.get("raw_working_departure_time", None),
-                ))
-                i += 1
-        elif cursor.rowcount == 1 and snapshot is False:
+        if inserted:
+            rows = self.insert_schedule_locations(cursor, [
+                self.schedule_location_values(message["rid"], message["start_date"], i, p)
+                for i, p in enumerate(message["locations"])], fetch=True)
+            self.metrics.increment("darwindb_rows_total", len(rows), table="schedule_location", operation="insert")
+            if self.schedule_cache is not None and len(rows) > 0:
+                self.schedule_cache.put(message["rid"], (message["timezone"].zone,) + self.split_points(rows))
+        else:
             #print("+++ Updating Schedule {}".format(message["rid"]))
-            cursor.execute(self.update_schedule_query, (
-                message["uid"],
-                message["headcode"],
-                message["start_date"],
-                message["toc_code"],
-                message["passenger_service"],
-                message["status"],
-                message["category"],
-                message["active"],
-                message["deleted"],
-                message["charter"],
-                message["cancellation_reason"]["code"] if message.get("cancellation_reason", None) is not None else None,
-                message["cancellation_reason"].get("tiploc", None) if message.get("cancellation_reason", None) is not None else None,
-                message["cancellation_reason"].get("near", None) if message.get("cancellation_reason", None) is not None else None,
-                message["timezone"].zone,
-                message["rid"],
-            ))
-            cursor.execute("SELECT * from {} WHERE rid=%s".format(self.table_schedule_location_name), (message["rid"],));
-            rows = cursor.fetchall()
-            #cursor.execute("DELETE from {} WHERE rid=%s".format(self.table_schedule_location_name), (message["rid"],));
-            # Loop through each position in the new list of locations.
-            updated_rows = []
-            position = -1
-            for i, p in enumerate(message["locations"]):
-                position += 1
-                # Loop through the existing locations.
-                last_j = None
-                for j, r in enumerate(rows):
-                    # Continue if we don't have a match.
-                    if r[4] != p["tiploc"]:
-                        continue
-                    if r[10] != p["working_arrival_time"]:
-                        continue
-                    if r[12] != p["working_pass_time"]:
-                        continue
-                    if r[14] != p["working_departure_time"]:
-                        continue
-
-                    # Looks like we do have a match. Update the database, mark this row as updated
-                    # and move on to the next location.
-                    cursor.execute("UPDATE {} SET {} WHERE {}".format(
-                        self.table_schedule_location_name,
-                        "type=%s, "+
-                        "position=%s, "+
-                        "activity_codes=%s, "+
-                        "planned_activity_codes=%s, "+
-                        "cancelled=%s, "+
-                        "false_tiploc=%s, "+
-                        "working_arrival_time=%s, "+
-                        "public_arrival_time=%s, "+
-                        "working_pass_time=%s, "+
-                        "public_departure_time=%s, "+
-                        "working_departure_time=%s, "+
-                        "raw_working_arrival_time=%s, "+
-                        "raw_public_arrival_time=%s, "+
-                        "raw_working_pass_time=%s, "+
-                        "raw_public_departure_time=%s, "+
-                        "raw_working_departure_time=%s",
-                        "id=%s"),
-                        (   p["location_type"],
-                            position,
-                            p.get("activity_codes", None),
-                            p.get("planned_activity_codes", None),
-                            p.get("cancelled", None),
-                            p.get("false_tiploc", None),
-                            p.get("working_arrival_time", None),
-                            p.get("public_arrival_time", None),
-                            p.get("working_pass_time", None),
-                            p.get("public_departure_time", None),
-                            p.get("working_departure_time", None),
-                            p.get("raw_working_arrival_time", None),
-                            p.get("raw_public_arrival_time", None),
-                            p.get("raw_working_pass_time", None),
-                            p.get("raw_public_departure_time", None),
-                            p.get("raw_working_departure_time", None),
-                            r[0]
-                        )
-                    )
-
-                    last_j = j
-                    break
-                # Check if we updated a row, or if instead we need to insert a new one.
-                if last_j is None:
-                    # Need to insert a new one.
-                    #print("   +++ Running INSERT on Schedule_Location")
-                    cursor.execute(self.insert_schedule_location_query, (
-                        message["rid"],
-                        p["location_type"],
-                        position,
-                        p.get("tiploc", None),
-                        p.get("activity_codes", None),
-                        p.get("planned_activity_codes", None),
-                        p.get("cancelled", None),
-                        p.get("false_tiploc", None),
-                        p.get("route_delay", None),
-                        p.get("working_arrival_time", None),
-                        p.get("public_arrival_time", None),
-                        p.get("working_pass_time", None),
-                        p.get("public_departure_time", None),
-                        p.get("working_departure_time", None),
-                        p.get("raw_working_arrival_time", None),
-                        p.get("raw_public_arrival_time", None),
-                        p.get("raw_working_pass_time", None),
-                        p.get("raw_public_departure_time", None),
-                        p.get("raw_working_departure_time", None),
-                    ))
-             
-                else:
-                    # We updated one successfully.
-                    # Delete from the list of rows the one that we've already updated.
-                    del rows[last_j]
-
-            # OK, so now we've updated all the rows we can, and inserted all the new ones, we need
-            # to go through all the rows that are left over and delete them.
-            for r in rows:
-                print("!!! Deleting spurious schedule_location with id {}, rid {}, tiploc {}".format(r[0], r[1], r[4]))
-                cursor.execute("DELETE from {} where id=%s".format(self.table_schedule_location_name), (r[0],))
-        elif cursor.rowcount == 1 and snapshot is True:
-            print("Didn't add schedule {} becuase it's from a snapshot and we arelady have one with that RID.".format(message["rid"]))
-
-       
+            if self.schedule_cache is not None:
+                self.schedule_cache.invalidate(message["rid"])
+            cursor.execute(self.execute_select_locations_query, (message["rid"],))
+            inserts, updates, deletes = self.diff_schedule_locations(
+                    message["rid"], message["start_date"], cursor.fetchall(), message["locations"])
+
+            for values in updates:
+                cursor.execute(self.execute_update_location_query, values)
+
+            self.insert_schedule_locations(cursor, inserts)
+
+            # Anything left over isn't in the schedule any more.
+            for r in deletes:
+                print("!!! Deleting spurious schedule_location with id {}, rid {}, tiploc {}".format(r[0], message["rid"], r[1]))
+            if len(deletes) > 0:
+                cursor.execute(self.execute_delete_locations_query, ([r[0] for r in deletes],))
+
+            self.metrics.increment("darwindb_rows_total", len(inserts), table="schedule_location", operation="insert")
+            self.metrics.increment("darwindb_rows_total", len(updates), table="schedule_location", operation="update")
+            self.metrics.increment("darwindb_rows_total", len(deletes), table="schedule_location", operation="delete")
+
+    """ Works out the minimal changes to turn a schedule's stored locations into the new ones.
+
+    The rows are those returned by the sl_select statement. Each new location is matched with the
+    first unmatched row which has the same tiploc and working times. Returns the values to insert
+    for unmatched locations, the sl_update parameters for matched rows where anything has
+    actually changed, and the rows which were not matched at all.
+    """
+    def diff_schedule_locations(self, rid, start_date, rows, locations):
+        existing = {}
+        for r in rows:
+            existing.setdefault((r[1], r[8], r[10], r[12]), deque()).append(r)
+
+        inserts = []
+        updates = []
+        for position, p in enumerate(locations):
+            matches = existing.get((p["tiploc"], p["working_arrival_time"], p["working_pass_time"], p["working_departure_time"]), None)
+            if not matches:
+                inserts.append(self.schedule_location_values(rid, start_date, position, p))
+                continue
+
+            r = matches.popleft()
+            values = (
+                p["location_type"],
+                position,
+                p.get("activity_codes", None),
+                p.get("planned_activity_codes", None),
+                p.get("cancelled", None),
+                p.get("false_tiploc", None),
+                p.get("working_arrival_time", None),
+                p.get("public_arrival_time", None),
+                p.get("working_pass_time", None),
+                p.get("public_departure_time", None),
+                p.get("working_departure_time", None),
+                p.get("raw_working_arrival_time", None),
+                p.get("raw_public_arrival_time", None),
+                p.get("raw_working_pass_time", None),
+                p.get("raw_public_departure_time", None),
+                p.get("raw_working_departure_time", None),
+            )
+            if values != tuple(r[2:]):
+                updates.append(values + (r[0],))
+
+        deletes = [r for matches in existing.values() for r in matches]
+        deletes.sort(key=lambda r: r[3])
+        return inserts, updates, deletes
+
+    """ Bulk loads the schedule messages from a snapshot using COPY.
+
+    The schedules and their locations are streamed into session-local staging tables and then
+    merged into the real tables in a single statement. As with save_schedule_message() in
+    snapshot mode, schedules whose rid is already in the database are left untouched, and if the
+    same rid appears more than once in the batch, the first one wins.
+    """
     @Cursor
     @Commit
+    def save_snapshot_schedule_messages(self, messages, cursor=None):
+        if self.profiler is not None:
+            round_trips = self.profiler.round_trips
+        execute_seconds = self.execute_seconds
+        with self.metrics.time("darwindb_stage_seconds", stage="save", type="schedule_snapshot"):
+            self.copy_snapshot_schedule_messages(messages, cursor)
+        self.metrics.observe("darwindb_stage_seconds", self.execute_seconds - execute_seconds, stage="execute", type="schedule_snapshot")
+        self.metrics.increment("darwindb_messages_total", len(messages), type="schedule")
+        if self.profiler is not None:
+            self.profiler.end_message("schedule_snapshot", round_trips)
+
+    def copy_snapshot_schedule_messages(self, messages, cursor):
+        with self.metrics.time("darwindb_stage_seconds", stage="sanitise", type="schedule_snapshot"):
+            for message in messages:
+                self.build_sanitised_times(message)
+
+        cursor.execute(self.create_schedule_staging_query)
+        cursor.execute(self.create_schedule_location_staging_query)
+        cursor.execute("TRUNCATE {}, {}".format(
+            self.table_schedule_staging_name, self.table_schedule_location_staging_name))
+
+        cursor.copy_expert(self.copy_schedule_staging_query, CopyBuffer(
+            (seq,) + self.schedule_values(message) for seq, message in enumerate(messages)))
+
+        cursor.copy_expert(self.copy_schedule_location_staging_query, CopyBuffer(
+            (seq,) + self.schedule_location_values(message["rid"], message["start_date"], i, p)
+            for seq, message in enumerate(messages)
+            for i, p in enumerate(message["locations"])))
+
+        cursor.execute(self.merge_schedule_staging_query)
+        staged, inserted, locations = cursor.fetchone()
+        self.wrote(*[message["rid"] for message in messages])
+        self.metrics.increment("darwindb_rows_total", inserted, table="schedule", operation="insert")
+        self.metrics.increment("darwindb_rows_total", locations, table="schedule_location", operation="insert")
+        if staged != inserted:
+            print("Didn't add {} schedules because they're from a snapshot and we already have ones with those RIDs.".format(
+                staged - inserted))
+
+    """ Inserts schedule_location rows in one statement.
+
+    If fetch is True, the new rows are returned with the same columns as ts_select_points.
+    """
+    def insert_schedule_locations(self, cursor, rows, fetch=False):
+        if len(rows) == 0:
+            return []
+        if fetch:
+            return execute_values(cursor, self.insert_schedule_locations_fetch_query, rows, page_size=len(rows), fetch=True)
+        execute_values(cursor, self.insert_schedule_locations_query, rows, page_size=len(rows))
+        return []
+
+    def schedule_values(self, message):
+        if message.get("cancellation_reason", None) is not None:
+            cancellation_reason_code = message["cancellation_reason"]["code"]
+            cancellation_reason_tiploc = message["cancellation_reason"].get("tiploc", None)
+            cancellation_reason_near = message["cancellation_reason"].get("near", None)
+        else:
+            cancellation_reason_code = None
+            cancellation_reason_tiploc = None
+            cancellation_reason_near = None
+
+        return (
+            message["rid"],
+            message["uid"],
+            message["headcode"],
+            message["start_date"],
+            message["toc_code"],
+            message["passenger_service"],
+            message["status"],
+            message["category"],
+            message["active"],
+            message["deleted"],
+            message["charter"],
+            cancellation_reason_code,
+            cancellation_reason_tiploc,
+            cancellation_reason_near,
+            message["timezone"].zone,
+        )
+
+    def schedule_location_values(self, rid, start_date, position, p):
+        return (
+            rid,
+            p["location_type"],
+            position,
+            p.get("tiploc", None),
+            p.get("activity_codes", None),
+            p.get("planned_activity_codes", None),
+            p.get("cancelled", None),
+            p.get("false_tiploc", None),
+            p.get("route_delay", None),
+            p.get("working_arrival_time", None),
+            p.get("public_arrival_time", None),
+            p.get("working_pass_time", None),
+            p.get("public_departure_time", None),
+            p.get("working_departure_time", None),
+            p.get("raw_working_arrival_time", None),
+            p.get("raw_public_arrival_time", None),
+            p.get("raw_working_pass_time", None),
+            p.get("raw_public_departure_time", None),
+            p.get("raw_working_departure_time", None),
+            start_date,
+        )
+
+    @Cursor
+    @Commit
+    @Measure("deactivated")
     def save_deactivated_message(self, message, snapshot=False, cursor=None):
         rid = message["rid"]
+        if self.schedule_cache is not None:
+            self.schedule_cache.invalidate(rid)
+        self.wrote(rid)
         cursor.execute(self.execute_deactivate_update_query, (rid,));
+        self.metrics.increment("darwindb_rows_total", cursor.rowcount, table="schedule", operation="update")
         if cursor.rowcount != 1:
             print("!!! Could not find a matching schedule to deactivate for RID: {}".format(rid))
 
     @Cursor
     @Commit
+    @Measure("association")
     def save_association_message(self, message, snapshot=False, cursor=None):
-        cursor.execute(self.execute_check_assoc_query,
-                (message["main_service"]["rid"], message["associated_service"]["rid"])
-        )
-
-        if cursor.rowcount == 0:
-            #print("+++ Inserting new Association")
-            cursor.execute(self.execute_insert_assoc_query, (
-                message["tiploc"],
-                message["category"],
-                message.get("deleted", None),
-                message.get("cancelled", None),
-                message["main_service"]["rid"],
-                message["main_service"].get("working_arrival_time", None),
-                message["main_service"].get("public_arrival_time", None),
-                message["main_service"].get("working_pass_time", None),
-                message["main_service"].get("public_departure_time", None),
-                message["main_service"].get("working_departure_time", None),
-                message["associated_service"]["rid"],
-                message["associated_service"].get("working_arrival_time", None),
-                message["associated_service"].get("public_arrival_time", None),
-                message["associated_service"].get("working_pass_time", None),
-                message["associated_service"].get("public_departure_time", None),
-                message["associated_service"].get("working_departure_time", None)
-            ))
-
-        elif cursor.rowcount == 1 and snapshot is False:
-            #print("+++ Updating existing Association")
-            rows = cursor.fetchall()
-            aid = rows[0][0]
-            cursor.execute(self.execute_update_assoc_query, (
-                message["tiploc"],
-                message["category"],
-                message.get("deleted", None),
-                message.get("cancelled", None),
-                message["main_service"]["rid"],
-                message["main_service"].get("working_arrival_time", None),
-                message["main_service"].get("public_arrival_time", None),
-                message["main_service"].get("working_pass_time", None),
-                message["main_service"].get("public_departure_time", None),
-                message["main_service"].get("working_departure_time", None),
-                message["associated_service"]["rid"],
-                message["associated_service"].get("working_arrival_time", None),
-                message["associated_service"].get("public_arrival_time", None),
-                message["associated_service"].get("working_pass_time", None),
-                message["associated_service"].get("public_departure_time", None),
-                message["associated_service"].get("working_departure_time", None),
-                aid,
-            ))
-        elif cursor.rowcount == 1 and snapshot is True:
-            print("Didn't add assocation message with rids {} and {} because it's from a snapshot and we already have one in the DB.".format(message["main_service"]["rid"], message["associated_service"]["rid"]))
+        self.wrote(message["main_service"]["rid"], message["associated_service"]["rid"])
+        if snapshot is True:
+            cursor.execute(self.execute_insert_assoc_query, self.association_values(message))
+            self.metrics.increment("darwindb_rows_total", cursor.rowcount, table="association", operation="insert")
+            if cursor.rowcount == 0:
+                print("Didn't add assocation message with rids {} and {} because it's from a snapshot and we already have one in the DB.".format(message["main_service"]["rid"], message["associated_service"]["rid"]))
         else:
-            print("$$$ Association message matched {} associations in the database."+\
-                  "This Shouldn't happen.".format(cursor.rowcount))
-            print("{}".format(message))
+            cursor.execute(self.execute_upsert_assoc_query, self.association_values(message))
+            self.metrics.increment("darwindb_rows_total", cursor.rowcount, table="association", operation="upsert")
+
+    def association_values(self, message):
+        return (
+            message["tiploc"],
+            message["category"],
+            message.get("deleted", None),
+            message.get("cancelled", None),
+            message["main_service"]["rid"],
+            message["main_service"].get("working_arrival_time", None),
+            message["main_service"].get("public_arrival_time", None),
+            message["main_service"].get("working_pass_time", None),
+            message["main_service"].get("public_departure_time", None),
+            message["main_service"].get("working_departure_time", None),
+            message["associated_service"]["rid"],
+            message["associated_service"].get("working_arrival_time", None),
+            message["associated_service"].get("public_arrival_time", None),
+            message["associated_service"].get("working_pass_time", None),
+            message["associated_service"].get("public_departure_time", None),
+            message["associated_service"].get("working_departure_time", None),
+        )
 
     def build_sanitised_times(self, message):
         # Convert the start date to a date.
-        message["start_date"] = parse(message["start_date"]).date()
+        message["start_date"] = parse_darwin_date(message["start_date"])
 
         #Convert the times into time objects.
         for l in message["locations"]:
             if l.get("working_arrival_time", None) is not None:
-                l["raw_working_arrival_time"] = parse(l["working_arrival_time"]).time()
+                l["raw_working_arrival_time"] = parse_darwin_time(l["working_arrival_time"])
             else:
                 l["raw_working_arrival_time"] = None
             if l.get("working_pass_time", None) is not None:
-                l["raw_working_pass_time"] = parse(l["working_pass_time"]).time()
+                l["raw_working_pass_time"] = parse_darwin_time(l["working_pass_time"])
             else:
                 l["raw_working_pass_time"] = None
             if l.get("working_departure_time", None) is not None:
-                l["raw_working_departure_time"] = parse(l["working_departure_time"]).time()
+                l["raw_working_departure_time"] = parse_darwin_time(l["working_departure_time"])
             else:
                 l["raw_working_departure_time"] = None
             if l.get("public_arrival_time", None) is not None:
-                l["raw_public_arrival_time"] = parse(l["public_arrival_time"]).time()
+                l["raw_public_arrival_time"] = parse_darwin_time(l["public_arrival_time"])
             else:
                 l["raw_public_arrival_time"] = None
             if l.get("public_departure_time", None) is not None:
-                l["raw_public_departure_time"] = parse(l["public_departure_time"]).time()
+                l["raw_public_departure_time"] = parse_darwin_time(l["public_departure_time"])
             else:
                 l["raw_public_departure_time"] = None
 
@@ -734,7 +1617,7 @@ class Store(BaseStore):
 
             t = add_minutes_to_time(t, this_location.get("route_delay", None))
 
-            return tz.localize(datetime.combine(start_date, t)).astimezone(pytz.utc)
+            return localize_to_utc(start_date, t, tz)
         
         if previous_location["working_departure_time"] is not None:
             return previous_location["working_departure_time"]
@@ -751,21 +1634,30 @@ class Store(BaseStore):
 
     @Cursor
     @Commit
+    @Measure("train_status")
     def save_train_status_message(self, message, snapshot=False, cursor=None):
         # Prepare message
         self.prepare_train_status_message(message)
+        self.wrote(message["rid"])
 
-        # Check the train concerned is in the database.
-        cursor.execute("EXECUTE ts_select_points (%s)", (message["rid"],))
+        if self.set_based_train_status:
+            return self.apply_train_status_message(message, cursor)
 
-        if cursor.rowcount == 0:
+        # Check the train concerned is in the database, unless we've got its locations cached.
+        cached = self.schedule_cache.get(message["rid"]) if self.schedule_cache is not None else None
+        if cached is not None:
+            timezone, rows, forecasts = cached
+        else:
+            timezone = None
+            cursor.execute("EXECUTE ts_select_points (%s)", (message["rid"],))
+            rows, forecasts = self.split_points(cursor.fetchall())
+
+        if len(rows) == 0:
             print("--- Cannot apply TS because we don't have the relevant schedule record yet. RID: {}".format(message["rid"]))
+            self.metrics.increment("darwindb_train_status_unmatched_total", reason="no_schedule")
         else:
             #print("+++ Schedule record is present. Can apply.")
 
-            # Get the rows from that query.
-            rows = cursor.fetchall()
-
             # Get the timezone to apply the schedule to.
             if message.get("late_reason", None) is not None:
                 late_reason_code = message["late_reason"].get("code", None)
@@ -776,7 +1668,7 @@ class Store(BaseStore):
                 late_reason_tiploc = None
                 late_reason_near = None
 
-            cursor.execute(self.update_schedule_select_tz_execute, (
+            cursor.execute(self.update_schedule_select_tz_execute if timezone is None else self.update_schedule_execute, (
                 message.get("reverse_formation", None),
                 late_reason_code,
                 late_reason_tiploc,
@@ -787,7 +1679,12 @@ class Store(BaseStore):
                 print("ERROR Row Count not equal to one when getting timezone. This should be impossible.")
                 return
 
-            tz = pytz.timezone(cursor.fetchall()[0][0])
+            if timezone is None:
+                timezone = cursor.fetchall()[0][0]
+                if self.schedule_cache is not None:
+                    self.schedule_cache.put(message["rid"], (timezone, rows, forecasts))
+
+            tz = pytz.timezone(timezone)
 
             for m in message["locations"]:
                 found = False
@@ -805,25 +1702,25 @@ class Store(BaseStore):
                         arrival_working_estimated_time = None
                         if r[7] is not None:
                             if m.get("arrival", None) is not None and m["arrival"].get("working_estimated_time", None) is not None:
-                                arrival_working_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["arrival"]["working_estimated_time"]).time())
+                                arrival_working_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["arrival"]["working_estimated_time"]))
                         
                         arrival_estimated_time = None
                         if r[8] is not None:
                             if m.get("arrival", None) is not None and m["arrival"].get("estimated_time", None) is not None:
-                                arrival_estimated_time = apply_date_and_tz_to_time(r[3], tz, r[8], parse(m["arrival"]["estimated_time"]).time())
+                                arrival_estimated_time = apply_date_and_tz_to_time(r[3], tz, r[8], parse_darwin_time(m["arrival"]["estimated_time"]))
                         elif r[7] is not None:
                             if m.get("arrival", None) is not None and m["arrival"].get("estimated_time", None) is not None:
-                                arrival_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["arrival"]["estimated_time"]).time())
+                                arrival_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["arrival"]["estimated_time"]))
                         
                         arrival_actual_time = None
                         if r[7] is not None:
                             if m.get("arrival", None) is not None and m["arrival"].get("actual_time", None) is not None:
-                                arrival_actual_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["arrival"]["actual_time"]).time())
+                                arrival_actual_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["arrival"]["actual_time"]))
 
                         arrival_manual_estimate_lower_limit = None
                         if r[7] is not None:
                             if m.get("arrival", None) is not None and m["arrival"].get("manual_estimate_lower_limit_minutes", None) is not None:
-                                arrival_manual_estimate_lower_limit = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["arrival"]["manual_estimate_lower_limit_minutes"]).time())
+                                arrival_manual_estimate_lower_limit = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["arrival"]["manual_estimate_lower_limit_minutes"]))
 
                         arrival_actual_time_removed = None
                         arrival_manual_estimate_unknown_delay = None
@@ -842,22 +1739,22 @@ class Store(BaseStore):
                         pass_working_estimated_time = None
                         if r[9] is not None:
                             if m.get("pass", None) is not None and m["pass"].get("working_estimated_time", None) is not None:
-                                pass_working_estimated_time = apply_date_and_tz_to_time(r[4], tz, r[9], parse(m["pass"]["working_estimated_time"]).time())
+                                pass_working_estimated_time = apply_date_and_tz_to_time(r[4], tz, r[9], parse_darwin_time(m["pass"]["working_estimated_time"]))
                         
                         pass_estimated_time = None
                         if r[9] is not None:
                             if m.get("pass", None) is not None and m["pass"].get("estimated_time", None) is not None:
-                                pass_estimated_time = apply_date_and_tz_to_time(r[4], tz, r[9], parse(m["pass"]["estimated_time"]).time())
+                                pass_estimated_time = apply_date_and_tz_to_time(r[4], tz, r[9], parse_darwin_time(m["pass"]["estimated_time"]))
                         
                         pass_actual_time = None
                         if r[9] is not None:
                             if m.get("pass", None) is not None and m["pass"].get("actual_time", None) is not None:
-                                pass_actual_time = apply_date_and_tz_to_time(r[4], tz, r[9], parse(m["pass"]["actual_time"]).time())
+                                pass_actual_time = apply_date_and_tz_to_time(r[4], tz, r[9], parse_darwin_time(m["pass"]["actual_time"]))
 
                         pass_manual_estimate_lower_limit = None
                         if r[9] is not None:
                             if m.get("pass", None) is not None and m["pass"].get("manual_estimate_lower_limit_minutes", None) is not None:
-                                pass_manual_estimate_lower_limit = apply_date_and_tz_to_time(r[4], tz, r[9], parse(m["pass"]["manual_estimate_lower_limit_minutes"]).time())
+                                pass_manual_estimate_lower_limit = apply_date_and_tz_to_time(r[4], tz, r[9], parse_darwin_time(m["pass"]["manual_estimate_lower_limit_minutes"]))
 
                         pass_actual_time_removed = None
                         pass_manual_estimate_unknown_delay = None
@@ -876,25 +1773,25 @@ class Store(BaseStore):
                         departure_working_estimated_time = None
                         if r[7] is not None:
                             if m.get("departure", None) is not None and m["departure"].get("working_estimated_time", None) is not None:
-                                departure_working_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["departure"]["working_estimated_time"]).time())
+                                departure_working_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["departure"]["working_estimated_time"]))
                         
                         departure_estimated_time = None
                         if r[8] is not None:
                             if m.get("departure", None) is not None and m["departure"].get("estimated_time", None) is not None:
-                                departure_estimated_time = apply_date_and_tz_to_time(r[3], tz, r[8], parse(m["departure"]["estimated_time"]).time())
+                                departure_estimated_time = apply_date_and_tz_to_time(r[3], tz, r[8], parse_darwin_time(m["departure"]["estimated_time"]))
                         elif r[7] is not None:
                             if m.get("departure", None) is not None and m["departure"].get("estimated_time", None) is not None:
-                                departure_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["departure"]["estimated_time"]).time())
+                                departure_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["departure"]["estimated_time"]))
                         
                         departure_actual_time = None
                         if r[7] is not None:
                             if m.get("departure", None) is not None and m["departure"].get("actual_time", None) is not None:
-                                departure_actual_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["departure"]["actual_time"]).time())
+                                departure_actual_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["departure"]["actual_time"]))
 
                         departure_manual_estimate_lower_limit = None
                         if r[7] is not None:
                             if m.get("departure", None) is not None and m["departure"].get("manual_estimate_lower_limit_minutes", None) is not None:
-                                departure_manual_estimate_lower_limit = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["departure"]["manual_estimate_lower_limit_minutes"]).time())
+                                departure_manual_estimate_lower_limit = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["departure"]["manual_estimate_lower_limit_minutes"]))
 
                         departure_actual_time_removed = None
                         departure_manual_estimate_unknown_delay = None
@@ -923,7 +1820,7 @@ class Store(BaseStore):
                             platform_confirmed = None
                             platform_number = None
 
-                        cursor.execute("EXECUTE ts_update_point (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (
+                        self.update_forecast(cursor, message["rid"], forecasts, r[0], self.forecast_columns_all, "EXECUTE ts_update_point (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (
                             m.get("suppressed", None),
                             m.get("length", None),
                             m.get("detach_front", None),
@@ -959,7 +1856,6 @@ class Store(BaseStore):
                             departure_unknown_delay,
                             departure_source,
                             departure_source_cis,
-                            r[0],
                         ))
                         break
 
@@ -975,25 +1871,25 @@ class Store(BaseStore):
                         arrival_working_estimated_time = None
                         if r[7] is not None:
                             if m.get("arrival", None) is not None and m["arrival"].get("working_estimated_time", None) is not None:
-                                arrival_working_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["arrival"]["working_estimated_time"]).time())
+                                arrival_working_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["arrival"]["working_estimated_time"]))
                         
                         arrival_estimated_time = None
                         if r[8] is not None:
                             if m.get("arrival", None) is not None and m["arrival"].get("estimated_time", None) is not None:
-                                arrival_estimated_time = apply_date_and_tz_to_time(r[3], tz, r[8], parse(m["arrival"]["estimated_time"]).time())
+                                arrival_estimated_time = apply_date_and_tz_to_time(r[3], tz, r[8], parse_darwin_time(m["arrival"]["estimated_time"]))
                         elif r[7] is not None:
                             if m.get("arrival", None) is not None and m["arrival"].get("estimated_time", None) is not None:
-                                arrival_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["arrival"]["estimated_time"]).time())
+                                arrival_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["arrival"]["estimated_time"]))
                         
                         arrival_actual_time = None
                         if r[7] is not None:
                             if m.get("arrival", None) is not None and m["arrival"].get("actual_time", None) is not None:
-                                arrival_actual_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["arrival"]["actual_time"]).time())
+                                arrival_actual_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["arrival"]["actual_time"]))
 
                         arrival_manual_estimate_lower_limit = None
                         if r[7] is not None:
                             if m.get("arrival", None) is not None and m["arrival"].get("manual_estimate_lower_limit_minutes", None) is not None:
-                                arrival_manual_estimate_lower_limit = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["arrival"]["manual_estimate_lower_limit_minutes"]).time())
+                                arrival_manual_estimate_lower_limit = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["arrival"]["manual_estimate_lower_limit_minutes"]))
 
                         arrival_actual_time_removed = None
                         arrival_manual_estimate_unknown_delay = None
@@ -1021,7 +1917,7 @@ class Store(BaseStore):
                             platform_confirmed = None
                             platform_number = None
 
-                        cursor.execute("EXECUTE ts_update_point_arrival (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (
+                        self.update_forecast(cursor, message["rid"], forecasts, r[0], self.forecast_columns_arrival, "EXECUTE ts_update_point_arrival (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (
                             m.get("suppressed", None),
                             m.get("length", None),
                             m.get("detach_front", None),
@@ -1039,7 +1935,6 @@ class Store(BaseStore):
                             arrival_unknown_delay,
                             arrival_source,
                             arrival_source_cis,
-                            r[0],
                         ))
                         break
 
@@ -1055,25 +1950,25 @@ class Store(BaseStore):
                         departure_working_estimated_time = None
                         if r[7] is not None:
                             if m.get("departure", None) is not None and m["departure"].get("working_estimated_time", None) is not None:
-                                departure_working_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["departure"]["working_estimated_time"]).time())
+                                departure_working_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["departure"]["working_estimated_time"]))
                         
                         departure_estimated_time = None
                         if r[8] is not None:
                             if m.get("departure", None) is not None and m["departure"].get("estimated_time", None) is not None:
-                                departure_estimated_time = apply_date_and_tz_to_time(r[3], tz, r[8], parse(m["departure"]["estimated_time"]).time())
+                                departure_estimated_time = apply_date_and_tz_to_time(r[3], tz, r[8], parse_darwin_time(m["departure"]["estimated_time"]))
                         elif r[7] is not None:
                             if m.get("departure", None) is not None and m["departure"].get("estimated_time", None) is not None:
-                                departure_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["departure"]["estimated_time"]).time())
+                                departure_estimated_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["departure"]["estimated_time"]))
                         
                         departure_actual_time = None
                         if r[7] is not None:
                             if m.get("departure", None) is not None and m["departure"].get("actual_time", None) is not None:
-                                departure_actual_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["departure"]["actual_time"]).time())
+                                departure_actual_time = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["departure"]["actual_time"]))
 
                         departure_manual_estimate_lower_limit = None
                         if r[7] is not None:
                             if m.get("departure", None) is not None and m["departure"].get("manual_estimate_lower_limit_minutes", None) is not None:
-                                departure_manual_estimate_lower_limit = apply_date_and_tz_to_time(r[2], tz, r[7], parse(m["departure"]["manual_estimate_lower_limit_minutes"]).time())
+                                departure_manual_estimate_lower_limit = apply_date_and_tz_to_time(r[2], tz, r[7], parse_darwin_time(m["departure"]["manual_estimate_lower_limit_minutes"]))
 
                         departure_actual_time_removed = None
                         departure_manual_estimate_unknown_delay = None
@@ -1102,7 +1997,7 @@ class Store(BaseStore):
                             platform_confirmed = None
                             platform_number = None
 
-                        cursor.execute("EXECUTE ts_update_point_departure (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (
+                        self.update_forecast(cursor, message["rid"], forecasts, r[0], self.forecast_columns_departure, "EXECUTE ts_update_point_departure (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (
                             m.get("suppressed", None),
                             m.get("length", None),
                             m.get("detach_front", None),
@@ -1120,12 +2015,12 @@ class Store(BaseStore):
                             departure_unknown_delay,
                             departure_source,
                             departure_source_cis,
-                            r[0],
                         ))
                         break
 
                 if not found:
                     print("--- Did not find matching schedule_location row for TS {} at {}".format(message["rid"], m["tiploc"]))
+                    self.metrics.increment("darwindb_train_status_unmatched_total", reason="no_location")
                     print("        Times: {} {} {} {} {}".format(
                         m.get("working_arrival_time", None),
                         m.get("public_arrival_time", None),
@@ -1135,31 +2030,147 @@ class Store(BaseStore):
                     ))
                     pass
 
+    """ Splits ts_select_points rows into the location rows and a dict of their current forecasts. """
+    def split_points(self, points):
+        return [p[:12] for p in points], dict([(p[0], tuple(p[12:])) for p in points])
+
+    """ Writes a location's forecasts, unless they are the same as the ones already stored.
+
+    columns are the positions of the values within the full ts_update_point parameter list, and
+    forecasts is updated with what has been written.
+    """
+    def update_forecast(self, cursor, rid, forecasts, location_id, columns, statement, values):
+        stored = forecasts.get(location_id, None)
+        if stored is not None and tuple([stored[i] for i in columns]) == values:
+            self.counters["forecast_updates_suppressed"] += 1
+            self.metrics.increment("darwindb_forecast_updates_total", result="suppressed")
+            return
+
+        cursor.execute(statement, values + (location_id,))
+        self.counters["forecast_updates"] += 1
+        self.metrics.increment("darwindb_forecast_updates_total", result="written")
+        self.metrics.increment("darwindb_rows_total", table="schedule_location", operation="update")
+
+        if stored is not None:
+            updated = list(stored)
+            for i, v in zip(columns, values):
+                updated[i] = v
+            forecasts[location_id] = tuple(updated)
+            if self.schedule_cache is not None and rid in self.schedule_cache:
+                self.schedule_cache.resize(rid, deep_sizeof(forecasts[location_id]) - deep_sizeof(stored))
+
+    """ Applies a train status message with the single ts_apply statement.
+
+    Gives the same results as the row by row code in save_train_status_message(), except that
+    where a message location matches several schedule locations, the best match is used rather
+    than whichever comes first. Locations whose forecasts haven't changed are not written.
+    """
+    def apply_train_status_message(self, message, cursor):
+        if message.get("late_reason", None) is not None:
+            late_reason_code = message["late_reason"].get("code", None)
+            late_reason_tiploc = message["late_reason"].get("tiploc", None)
+            late_reason_near = message["late_reason"].get("near", None)
+        else:
+            late_reason_code = None
+            late_reason_tiploc = None
+            late_reason_near = None
+
+        locations = [self.train_status_location_values(i, m) for i, m in enumerate(message["locations"])]
+
+        cursor.execute(self.apply_train_status_execute, (
+            message.get("reverse_formation", None),
+            late_reason_code,
+            late_reason_tiploc,
+            late_reason_near,
+            message["rid"],
+            json.dumps(locations),
+        ))
+        schedules, matched, rows, updated = cursor.fetchone()
+        self.counters["forecast_updates"] += updated
+        self.counters["forecast_updates_suppressed"] += rows - updated
+        self.metrics.increment("darwindb_forecast_updates_total", updated, result="written")
+        self.metrics.increment("darwindb_forecast_updates_total", rows - updated, result="suppressed")
+        self.metrics.increment("darwindb_rows_total", updated, table="schedule_location", operation="update")
+
+        if schedules == 0:
+            print("--- Cannot apply TS because we don't have the relevant schedule record yet. RID: {}".format(message["rid"]))
+            self.metrics.increment("darwindb_train_status_unmatched_total", reason="no_schedule")
+            return
+
+        for i, m in enumerate(message["locations"]):
+            if i not in matched:
+                print("--- Did not find matching schedule_location row for TS {} at {}".format(message["rid"], m["tiploc"]))
+                self.metrics.increment("darwindb_train_status_unmatched_total", reason="no_location")
+                print("        Times: {} {} {} {} {}".format(
+                    m.get("working_arrival_time", None),
+                    m.get("public_arrival_time", None),
+                    m.get("working_pass_time", None),
+                    m.get("public_departure_time", None),
+                    m.get("working_departure_time", None)
+                ))
+
+    def train_status_location_values(self, ord, m):
+        def raw(t):
+            return str(t) if t is not None else None
+
+        values = {
+            "ord": ord,
+            "tiploc": m["tiploc"],
+            "raw_working_arrival_time": raw(m["raw_working_arrival_time"]),
+            "raw_working_pass_time": raw(m["raw_working_pass_time"]),
+            "raw_working_departure_time": raw(m["raw_working_departure_time"]),
+            "suppressed": m.get("suppressed", None),
+            "length": m.get("length", None),
+            "detach_front": m.get("detach_front", None),
+        }
+
+        platform = m.get("platform", None) or {}
+        values["platform_suppressed"] = platform.get("suppressed", None)
+        values["platform_suppressed_by_cis"] = platform.get("suppressed_by_cis", None)
+        values["platform_source"] = platform.get("source", None)
+        values["platform_confirmed"] = platform.get("confirmed", None)
+        values["platform_number"] = platform.get("number", None)
+
+        for kind in ["arrival", "pass", "departure"]:
+            forecast = m.get(kind, None) or {}
+            for key, field in [("working_estimated_time", "working_estimated_time"),
+                               ("estimated_time", "estimated_time"),
+                               ("actual_time", "actual_time"),
+                               ("manual_estimate_lower_limit_minutes", "manual_estimate_lower_limit")]:
+                if forecast.get(key, None) is not None:
+                    values["{}_{}".format(kind, field)] = raw(parse_darwin_time(forecast[key]))
+                else:
+                    values["{}_{}".format(kind, field)] = None
+            for key in ["actual_time_removed", "manual_estimate_unknown_delay", "unknown_delay", "source", "source_cis"]:
+                values["{}_{}".format(kind, key)] = forecast.get(key, None)
+
+        return values
+
     def prepare_train_status_message(self, message):
 
         for l in message["locations"]:
             if "working_arrival_time" in l:
-                l["raw_working_arrival_time"] = parse(l["working_arrival_time"]).time()
+                l["raw_working_arrival_time"] = parse_darwin_time(l["working_arrival_time"])
             else:
                 l["raw_working_arrival_time"] = None
 
             if "working_pass_time" in l:
-                l["raw_working_pass_time"] = parse(l["working_pass_time"]).time()
+                l["raw_working_pass_time"] = parse_darwin_time(l["working_pass_time"])
             else:
                 l["raw_working_pass_time"] = None
 
             if "working_departure_time" in l:
-                l["raw_working_departure_time"] = parse(l["working_departure_time"]).time()
+                l["raw_working_departure_time"] = parse_darwin_time(l["working_departure_time"])
             else:
                 l["raw_working_departure_time"] = None
 
             if "public_arrival_time" in l:
-                l["raw_public_arrival_time"] = parse(l["public_arrival_time"]).time()
+                l["raw_public_arrival_time"] = parse_darwin_time(l["public_arrival_time"])
             else:
                 l["raw_public_arrival_time"] = None
 
             if "public_departure_time" in l:
-                l["raw_public_departure_time"] = parse(l["public_departure_time"]).time()
+                l["raw_public_departure_time"] = parse_darwin_time(l["public_departure_time"])
             else:
                 l["raw_public_departure_time"] = None
 
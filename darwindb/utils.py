@@ -1,15 +1,85 @@
 import pytz
+from bisect import bisect_right
 from datetime import datetime, timedelta, date, time
+from dateutil.parser import parse
+from functools import lru_cache
+
+# Parses a Darwin HH:MM or HH:MM:SS time string, handing anything else to dateutil. Darwin times
+# are whole or half minutes, so there are at most 2880 distinct ones to memoize.
+@lru_cache(maxsize=4096)
+def parse_darwin_time(s):
+    try:
+        if len(s) == 5 and s[2] == ":" and s[0:2].isdigit() and s[3:5].isdigit():
+            return time(int(s[0:2]), int(s[3:5]))
+        if len(s) == 8 and s[2] == ":" and s[5] == ":" and s[0:2].isdigit() and s[3:5].isdigit() and s[6:8].isdigit():
+            return time(int(s[0:2]), int(s[3:5]), int(s[6:8]))
+    except ValueError:
+        pass
+    return parse(s).time()
+
+
+# Parses a Darwin YYYY-MM-DD date string, handing anything else to dateutil.
+@lru_cache(maxsize=1024)
+def parse_darwin_date(s):
+    try:
+        if len(s) == 10 and s[4] == "-" and s[7] == "-" and s[0:4].isdigit() and s[5:7].isdigit() and s[8:10].isdigit():
+            return date(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+    except ValueError:
+        pass
+    return parse(s).date()
+
+
+# UK summer time starts and ends at 01:00 UTC on the last Sundays of March and October, which
+# has been the rule since 1996. Between first_year and last_year, the timezone lookups below use a
+# table of these transitions. Outside that range they fall back to asking pytz.
+def last_sunday(year, month):
+    d = date(year, month + 1, 1) - timedelta(days=1)
+    return d - timedelta(days=(d.weekday() + 1) % 7)
+
+
+def build_summer_time_table(first_year=1996, last_year=2037):
+    global summer_time_first_year, summer_time_last_year, summer_time_transitions
+    transitions = []
+    for year in range(first_year, last_year + 1):
+        transitions.append(datetime.combine(last_sunday(year, 3), time(1)))
+        transitions.append(datetime.combine(last_sunday(year, 10), time(1)))
+    summer_time_first_year = first_year
+    summer_time_last_year = last_year
+    summer_time_transitions = transitions
+
+build_summer_time_table()
+
+# Think the timezones below are wrong? Read the whole of the linked file, then think again.
+# https://github.com/eggert/tz/blob/master/etcetera
+GMT = pytz.timezone("Etc/GMT")
+BST = pytz.timezone("Etc/GMT-1")
+
+utc_offsets = {
+    GMT.zone: timedelta(0),
+    BST.zone: timedelta(hours=1),
+}
+
+one_day = timedelta(days=1)
+
 
 def timezone_for_date_and_time(d, t):
+    if d.year < summer_time_first_year or d.year > summer_time_last_year:
+        return pytz_timezone_for_date_and_time(d, t)
+
+    # An odd number of transitions before the time means we're in summer time.
+    if bisect_right(summer_time_transitions, datetime.combine(d, t)) % 2 == 1:
+        return BST
+    else:
+        return GMT
+
+
+def pytz_timezone_for_date_and_time(d, t):
     tz = pytz.timezone("Europe/London")
     dt = pytz.utc.localize(datetime.combine(d, t))
     if dt.astimezone(tz).utcoffset().seconds / 3600 == 1:
-        # Think the timezone below is wrong? Read the whole of the linked file, then think again.
-        # https://github.com/eggert/tz/blob/master/etcetera
-        return pytz.timezone("Etc/GMT-1")
+        return BST
     else:
-        return pytz.timezone("Etc/GMT")
+        return GMT
 
 
 def subtract_times(a, b):
@@ -17,11 +87,24 @@ def subtract_times(a, b):
     return (delta.days*24*60*60)+delta.seconds
 
 
+def time_to_microseconds(t):
+    return ((t.hour*60 + t.minute)*60 + t.second)*1000000 + t.microsecond
+
+
+# Gives the UTC datetime of time t on date d in timezone tz.
+def localize_to_utc(d, t, tz):
+    offset = utc_offsets.get(tz.zone, None)
+    if offset is None:
+        return tz.localize(datetime.combine(d, t)).astimezone(pytz.utc)
+    return datetime(d.year, d.month, d.day, t.hour, t.minute, t.second, t.microsecond, tzinfo=pytz.utc) - offset
+
+
 def apply_date_and_tz_to_time(dated_time, tz, previous_time, this_time):
-    delta = subtract_times(this_time, previous_time)
+    # The same as subtract_times(this_time, previous_time), without going through datetimes.
+    delta = (time_to_microseconds(this_time) - time_to_microseconds(previous_time)) // 1000000
     if delta < -21600:
         # Crossed Midnight into the next day.
-        d = (dated_time + timedelta(days=1)).date()
+        d = dated_time.date() + one_day
 
     elif delta < 64800:
         # Normal time.
@@ -29,6 +112,18 @@ def apply_date_and_tz_to_time(dated_time, tz, previous_time, this_time):
 
     else:
         # Delayed backwards over midnight into previous day.
+        d = dated_time.date() - one_day
+
+    return localize_to_utc(d, this_time, tz)
+
+
+def pytz_apply_date_and_tz_to_time(dated_time, tz, previous_time, this_time):
+    delta = subtract_times(this_time, previous_time)
+    if delta < -21600:
+        d = (dated_time + timedelta(days=1)).date()
+    elif delta < 64800:
+        d = dated_time.date()
+    else:
         d = (dated_time + timedelta(days=-1)).date()
 
     return tz.localize(datetime.combine(d, this_time)).astimezone(pytz.utc)
@@ -1,60 +1,112 @@
-from darwindb import Client
+from darwindb import Client, ShardedIngest
+from darwindb.capture import Recorder
+from darwindb.frames import FrameReader
+from darwindb.ingest import apply_frame
+from darwindb.metrics import PrometheusMetrics
 
 from darwindb.stores import PostgresConnection, PostgresStore
 
-import json
 import os
+import threading
 import time
 
+def partition_days():
+    return int(os.environ["PARTITION_DAYS"]) if "PARTITION_DAYS" in os.environ else None
+
+def postgres_connection():
+    return PostgresConnection(host=os.environ["POSTGRES_HOST"],
+                              dbname=os.environ["POSTGRES_DB"],
+                              user=os.environ["POSTGRES_USER"],
+                              password=os.environ["POSTGRES_PASS"])
+
+# Partitions are created on connecting, but a connection can last for weeks, so they're kept up to
+# date every PARTITION_INTERVAL seconds too, on a connection of their own.
+def maintain_partitions(interval):
+    connection = postgres_connection()
+    store = PostgresStore(connection, partition_days=partition_days())
+    while True:
+        time.sleep(interval)
+        try:
+            connection.connect()
+            created, detached = store.maintain_partitions()
+            print("Created partitions {} and detached {}".format(created, detached))
+        except Exception as e:
+            print("Failed to maintain partitions: {}".format(e))
+
 class Listener:
-    def __init__(self, client):
+    def __init__(self, client, metrics):
         print("Setting up listener")
-        self.connection = PostgresConnection(host=os.environ["POSTGRES_HOST"],
-                                             dbname=os.environ["POSTGRES_DB"],
-                                             user=os.environ["POSTGRES_USER"],
-                                             password=os.environ["POSTGRES_PASS"])
+        self.connection = postgres_connection()
         print("Connected to Postgres. Now instantiating Postgres Store")
-        self.store = PostgresStore(self.connection)
+        # Set PARTITION_DAYS to partition the schedule tables by start date when creating them.
+        self.store = PostgresStore(self.connection, metrics=metrics, partition_days=partition_days())
         self.client = client
+        self.metrics = metrics
         
     def on_connected(self, headers, body):
         print("On Connected")
         self.connection.connect()
         self.store.create_tables()
+        for index in self.store.check_indexes():
+            print("WARNING: Index {} is missing or invalid. Build it with python -m darwindb.indexes.".format(index))
+        if self.store.partition_days is not None:
+            created, detached = self.store.maintain_partitions()
+            print("Created partitions {} and detached {}".format(created, detached))
     
     def on_message(self, headers, message):
-        m = json.loads(message.decode("utf-8"))
-
-        snapshot = False
-        if m["message_type"] == "snapshot":
-            snapshot = True
+        # Messages are decoded one at a time as they are saved, rather than all up front.
+        with self.metrics.time("darwindb_stage_seconds", stage="decode", type="frame"):
+            m = FrameReader(message)
 
-        for s in m["schedule_messages"]:
-            self.store.save_schedule_message(s, snapshot)
+        # Apply the whole frame in a single transaction.
+        apply_frame(self.store, m)
 
-        for s in m["association_messages"]:
-            self.store.save_association_message(s, snapshot)
-
-        for d in m["deactivated_messages"]:
-            self.store.save_deactivated_message(d, snapshot)
+        # Now the frame has been committed, ack the message.
+        self.client.ack(headers)
 
-        for s in m["train_status_messages"]:
-            self.store.save_train_status_message(s, snapshot)
+# The sharded ingest starts worker processes, which import this module again.
+if __name__ == "__main__":
+    c = Client()
 
-        # Now we have finished processing, ack the message.
-        self.client.ack(headers)
+    # Set METRICS_PORT to expose metrics for Prometheus to scrape on http://...:<port>/metrics.
+    metrics = PrometheusMetrics()
+    if "METRICS_PORT" in os.environ:
+        metrics.serve(int(os.environ["METRICS_PORT"]))
 
-c = Client()
-l = Listener(c)
+    # Set INGEST_WORKERS to spread ingest over several processes, e.g. when catching up on a backlog.
+    workers = int(os.environ.get("INGEST_WORKERS", "1"))
+    if workers > 1:
+        l = ShardedIngest(c, dict(host=os.environ["POSTGRES_HOST"],
+                                  dbname=os.environ["POSTGRES_DB"],
+                                  user=os.environ["POSTGRES_USER"],
+                                  password=os.environ["POSTGRES_PASS"]), workers=workers, metrics=metrics,
+                          store_args=dict(partition_days=partition_days()))
+    else:
+        l = Listener(c, metrics)
 
-c.connect(server=os.environ["STOMP_HOST"],
-          port=int(os.environ["STOMP_PORT"]),
-          user=os.environ["STOMP_USER"],
-          password=os.environ["STOMP_PASS"],
-          queue=os.environ["STOMP_QUEUE"],
-          listener=l)
+    if partition_days() is not None:
+        maintainer = threading.Thread(target=maintain_partitions, name="darwindb-partitions",
+                                      args=(float(os.environ.get("PARTITION_INTERVAL", "3600")),))
+        maintainer.daemon = True
+        maintainer.start()
 
-while True:
-    time.sleep(1)
+    # Set CAPTURE_FILE to record every frame, for replaying with benchmarks.replay later.
+    if "CAPTURE_FILE" in os.environ:
+        l = Recorder(l, os.environ["CAPTURE_FILE"])
 
+    c.connect(server=os.environ["STOMP_HOST"],
+              port=int(os.environ["STOMP_PORT"]),
+              user=os.environ["STOMP_USER"],
+              password=os.environ["STOMP_PASS"],
+              queue=os.environ["STOMP_QUEUE"],
+              listener=l,
+              # Optionally decouple reading from the broker and writing to the database.
+              prefetch=int(os.environ["STOMP_PREFETCH"]) if "STOMP_PREFETCH" in os.environ else None,
+              queue_size=int(os.environ["INGEST_QUEUE_SIZE"]) if "INGEST_QUEUE_SIZE" in os.environ else None,
+              ack_every=int(os.environ.get("STOMP_ACK_EVERY", "1")),
+              # Reconnect, so the broker redelivers it, if a frame goes this many seconds uncommitted.
+              ack_timeout=float(os.environ.get("STOMP_ACK_TIMEOUT", "600")),
+              metrics=metrics)
 
+    while True:
+        time.sleep(1)
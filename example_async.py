@@ -0,0 +1,53 @@
+from darwindb import AsyncClient, AsyncPostgresStore
+from darwindb.metrics import PrometheusMetrics
+
+import asyncio
+import json
+import os
+
+class Listener:
+    def __init__(self):
+        print("Setting up listener")
+        # Set METRICS_PORT to expose metrics for Prometheus to scrape on http://...:<port>/metrics.
+        self.metrics = PrometheusMetrics()
+        if "METRICS_PORT" in os.environ:
+            self.metrics.serve(int(os.environ["METRICS_PORT"]))
+        self.store = AsyncPostgresStore(dict(host=os.environ["POSTGRES_HOST"],
+                                             dbname=os.environ["POSTGRES_DB"],
+                                             user=os.environ["POSTGRES_USER"],
+                                             password=os.environ["POSTGRES_PASS"]),
+                                        lanes=int(os.environ.get("INGEST_LANES", "4")),
+                                        metrics=self.metrics)
+        # Reconnects, so the broker redelivers it, if a frame fails or goes STOMP_ACK_TIMEOUT seconds uncommitted.
+        self.client = AsyncClient(self, max_in_flight=int(os.environ.get("INGEST_IN_FLIGHT", "16")),
+                                  ack_timeout=float(os.environ.get("STOMP_ACK_TIMEOUT", "600")),
+                                  metrics=self.metrics)
+
+    async def on_connected(self, headers, body):
+        print("On Connected")
+        await self.store.connect()
+        await self.store.create_tables()
+        for index in await self.store.check_indexes():
+            print("WARNING: Index {} is missing or invalid. Build it with python -m darwindb.indexes.".format(index))
+
+    async def on_message(self, headers, message):
+        with self.metrics.time("darwindb_stage_seconds", stage="decode", type="frame"):
+            m = json.loads(message.decode("utf-8"))
+
+        # Each lane applies its share of the frame in a single transaction.
+        await self.store.save_frame(m)
+
+        # Now the frame has been committed, ack the message.
+        await self.client.ack(headers)
+
+async def main():
+    l = Listener()
+    await l.client.connect(server=os.environ["STOMP_HOST"],
+                           port=int(os.environ["STOMP_PORT"]),
+                           user=os.environ["STOMP_USER"],
+                           password=os.environ["STOMP_PASS"],
+                           queue=os.environ["STOMP_QUEUE"])
+    await l.client.run()
+
+if __name__ == "__main__":
+    asyncio.run(main())
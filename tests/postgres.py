@@ -0,0 +1,61 @@
+""" Helpers for tests which need a PostgreSQL database.
+
+They're skipped unless TEST_POSTGRES_HOST, TEST_POSTGRES_DB, TEST_POSTGRES_USER and
+TEST_POSTGRES_PASS point at a scratch database, whose darwindb tables are dropped by each test.
+"""
+from darwindb.stores import PostgresConnection, PostgresStore
+
+import os
+import unittest
+
+
+def connection_args():
+    if "TEST_POSTGRES_HOST" not in os.environ:
+        raise unittest.SkipTest("TEST_POSTGRES_HOST isn't set")
+    return dict(host=os.environ["TEST_POSTGRES_HOST"],
+                dbname=os.environ["TEST_POSTGRES_DB"],
+                user=os.environ["TEST_POSTGRES_USER"],
+                password=os.environ.get("TEST_POSTGRES_PASS", ""))
+
+
+""" Connects to the scratch database, and drops any tables left there by earlier tests. """
+def scratch_connection():
+    connection = PostgresConnection(**connection_args())
+    connection.connect()
+    cursor = connection.cursor()
+    cursor.execute("DROP VIEW IF EXISTS {} CASCADE".format(PostgresStore.table_schedule_location_view_name))
+    for table in [PostgresStore.table_schedule_name, PostgresStore.table_schedule_location_name,
+                  PostgresStore.table_schedule_location_forecast_name, PostgresStore.table_schedule_location_compact_name,
+                  PostgresStore.table_tiploc_name, PostgresStore.table_assoc_name]:
+        cursor.execute("DROP TABLE IF EXISTS {} CASCADE".format(table))
+    connection.commit()
+    return connection
+
+
+def schedule_rids(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT rid FROM {} ORDER BY rid".format(PostgresStore.table_schedule_name))
+    rids = [r[0] for r in cursor.fetchall()]
+    connection.commit()
+    return rids
+
+
+""" A frame holding a single live schedule for this rid, calling at two locations. """
+def schedule_frame(rid, start_date="2016-03-27"):
+    return {
+        "message_type": "live",
+        "schedule_messages": [{
+            "rid": rid, "uid": "U" + rid[-5:], "headcode": "1A23", "start_date": start_date, "toc_code": "GW",
+            "passenger_service": True, "status": "P", "category": "XX", "active": True, "deleted": False,
+            "charter": False, "cancellation_reason": None,
+            "locations": [
+                {"location_type": "OR", "tiploc": "ORIGIN", "working_departure_time": "10:00:30",
+                 "public_departure_time": "10:00", "activity_codes": "TB"},
+                {"location_type": "DT", "tiploc": "DEST", "working_arrival_time": "10:30",
+                 "public_arrival_time": "10:30", "activity_codes": "TF"},
+            ],
+        }],
+        "association_messages": [],
+        "deactivated_messages": [],
+        "train_status_messages": [],
+    }
@@ -0,0 +1,228 @@
+from darwindb.async_client import AsyncClient, escape_header
+
+import asyncio
+import unittest
+
+
+""" One client's connection to the Broker, recording the frames sent on it. """
+class BrokerConnection:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.frames = []
+        self.acks = []
+        self.closed = False
+
+    async def serve(self):
+        while True:
+            try:
+                data = await self.reader.readuntil(b"\x00")
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            head, _, body = data[:-1].lstrip(b"\r\n").partition(b"\n\n")
+            lines = head.decode("utf-8").split("\n")
+            headers = dict(line.split(":", 1) for line in lines[1:])
+            self.frames.append((lines[0], headers, body))
+
+            if lines[0] == "CONNECT":
+                self.send(b"CONNECTED\nversion:1.1\n\n\x00")
+            elif lines[0] == "ACK":
+                self.acks.append(headers["id"])
+        self.closed = True
+        self.writer.close()
+
+    def send(self, data):
+        self.writer.write(data)
+
+    """ Sends a MESSAGE frame, with a content-length header unless content_length is False. """
+    def message(self, message_id, body=b"", content_length=True, **headers):
+        headers = dict({"message-id": message_id, "subscription": "1", "destination": "/queue/test"}, **headers)
+        if content_length:
+            headers["content-length"] = len(body)
+        lines = ["MESSAGE"] + ["{}:{}".format(escape_header(k), escape_header(v)) for k, v in headers.items()]
+        self.send("\n".join(lines).encode("utf-8") + b"\n\n" + body + b"\x00")
+
+
+""" Stands in for the STOMP broker, on a local port. """
+class Broker:
+
+    def __init__(self):
+        self.connections = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.accept, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def accept(self, reader, writer):
+        connection = BrokerConnection(reader, writer)
+        self.connections.append(connection)
+        await connection.serve()
+
+    async def stop(self):
+        for connection in self.connections:
+            connection.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+
+""" Acks every frame it's given once its gate (if it has one) opens, but raises the first time it's given any in fail. """
+class Listener:
+
+    def __init__(self, fail=(), gates=None):
+        self.client = None
+        self.fail = set(fail)
+        self.gates = gates or {}
+        self.applied = []
+        self.connected = 0
+
+    async def on_connected(self, headers, body):
+        self.connected += 1
+
+    async def on_message(self, headers, message):
+        self.applied.append((headers["message-id"], message))
+        if headers["message-id"] in self.gates:
+            await self.gates[headers["message-id"]].wait()
+        if headers["message-id"] in self.fail:
+            self.fail.remove(headers["message-id"])
+            raise RuntimeError("failed to apply {}".format(headers["message-id"]))
+        await self.client.ack(headers)
+
+
+async def wait_for(condition, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("timed out")
+        await asyncio.sleep(0.01)
+
+
+class AsyncClientTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.broker = Broker()
+        await self.broker.start()
+
+    async def asyncTearDown(self):
+        await self.broker.stop()
+
+    async def connect(self, listener, **kwargs):
+        client = AsyncClient(listener, **kwargs)
+        listener.client = client
+        await client.connect("127.0.0.1", self.broker.port, "user", "pass:word", "/queue/test")
+        run = asyncio.ensure_future(client.run())
+        self.addAsyncCleanup(self.cancel, run)
+        return client
+
+    async def cancel(self, task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def test_connects_and_subscribes(self):
+        await self.connect(Listener(), prefetch=5)
+        connection = self.broker.connections[0]
+        await wait_for(lambda: len(connection.frames) == 2)
+
+        command, headers, body = connection.frames[0]
+        self.assertEqual(command, "CONNECT")
+        # Headers on CONNECT frames aren't escaped.
+        self.assertEqual(headers["passcode"], "pass:word")
+        command, headers, body = connection.frames[1]
+        self.assertEqual(command, "SUBSCRIBE")
+        self.assertEqual(headers, {"destination": "/queue/test", "id": "1", "ack": "client",
+                                   "activemq.prefetchSize": "5"})
+
+    async def test_reads_frames(self):
+        listener = Listener()
+        await self.connect(listener)
+        connection = self.broker.connections[0]
+
+        # A body with a content-length can contain NULs, and heart-beats can come between frames.
+        connection.message("1", b'{"a":\x00"b"}')
+        connection.send(b"\n\r\n\n")
+        connection.message("2", b'{"c": 1}', content_length=False)
+        connection.message("3", b"", note="a:b\nc\\d")
+        await wait_for(lambda: len(listener.applied) == 3)
+
+        self.assertEqual([m for _, m in listener.applied], [b'{"a":\x00"b"}', b'{"c": 1}', b""])
+        await wait_for(lambda: connection.acks == ["1", "2", "3"])
+
+    async def test_unescapes_headers(self):
+        seen = []
+        listener = Listener()
+        on_message = listener.on_message
+
+        async def record(headers, message):
+            seen.append(headers)
+            await on_message(headers, message)
+        listener.on_message = record
+
+        await self.connect(listener)
+        self.broker.connections[0].message("1", note="a:b\nc\\d")
+        await wait_for(lambda: len(seen) == 1)
+        self.assertEqual(seen[0]["note"], "a:b\nc\\d")
+
+    async def test_acks_are_cumulative_and_in_order(self):
+        gates = dict([(n, asyncio.Event()) for n in ["1", "2", "3"]])
+        listener = Listener(gates=gates)
+        await self.connect(listener)
+        connection = self.broker.connections[0]
+        for n in ["1", "2", "3"]:
+            connection.message(n)
+        await wait_for(lambda: len(listener.applied) == 3)
+
+        gates["2"].set()
+        gates["3"].set()
+        await asyncio.sleep(0.1)
+        self.assertEqual(connection.acks, [])
+        gates["1"].set()
+        await wait_for(lambda: connection.acks == ["3"])
+
+    async def test_failure_does_not_block_later_acks(self):
+        listener = Listener(fail=["2"])
+        client = await self.connect(listener)
+        for n in ["1", "2", "3"]:
+            self.broker.connections[0].message(n)
+
+        # The client drops the connection, and the broker redelivers everything from the failed frame on.
+        await wait_for(lambda: len(self.broker.connections) == 2 and listener.connected == 2)
+        self.assertTrue(self.broker.connections[0].closed)
+        self.assertEqual(self.broker.connections[0].acks, ["1"])
+        for n in ["2", "3"]:
+            self.broker.connections[1].message(n)
+        await wait_for(lambda: self.broker.connections[1].acks[-1:] == ["3"])
+        self.assertIsNone(client.failed)
+
+    async def test_frame_left_uncommitted_times_out(self):
+        listener = Listener(gates={"1": asyncio.Event()})
+        await self.connect(listener, ack_timeout=0.2)
+        self.broker.connections[0].message("1")
+        self.broker.connections[0].message("2")
+
+        await wait_for(lambda: self.broker.connections[0].closed)
+        self.assertEqual(self.broker.connections[0].acks, [])
+        # The client only reconnects once the stuck frame has finished.
+        self.assertEqual(len(self.broker.connections), 1)
+        listener.gates["1"].set()
+        await wait_for(lambda: listener.connected == 2)
+        self.assertEqual(self.broker.connections[0].acks, [])
+
+    async def test_held_back_ack_is_sent_after_max_ack_delay(self):
+        listener = Listener(gates={"2": asyncio.Event()})
+        await self.connect(listener, ack_every=10, max_ack_delay=0.1, ack_timeout=None)
+        connection = self.broker.connections[0]
+        connection.message("1")
+        connection.message("2")
+        await wait_for(lambda: len(listener.applied) == 2)
+        self.assertEqual(connection.acks, [])
+
+        await wait_for(lambda: connection.acks == ["1"])
+        listener.gates["2"].set()
+        await wait_for(lambda: connection.acks == ["1", "2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
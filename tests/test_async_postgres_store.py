@@ -0,0 +1,72 @@
+from darwindb.stores.AsyncPostgresStore import Store
+from darwindb.stores import PostgresConnection
+
+from postgres import connection_args, schedule_frame, schedule_rids, scratch_connection
+
+import threading
+import unittest
+
+
+class StoreTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_lanes_stop_once_one_fails(self):
+        store = Store(dict(host="localhost", dbname="darwin", user="darwin", password=""), lanes=2)
+        self.addAsyncCleanup(store.close)
+        calls = []
+        released = threading.Event()
+
+        def fail():
+            raise RuntimeError("failed")
+
+        # Work already queued on either lane behind the failure isn't done.
+        store.lanes[1].submit(released.wait)
+        other_lane = store.lanes[1].submit(calls.append, "other lane")
+        failure = store.lanes[0].submit(fail)
+        same_lane = store.lanes[0].submit(calls.append, "same lane")
+
+        with self.assertRaisesRegex(RuntimeError, "^failed$"):
+            await failure
+        released.set()
+        with self.assertRaisesRegex(RuntimeError, "earlier save failed"):
+            await same_lane
+        with self.assertRaisesRegex(RuntimeError, "earlier save failed"):
+            await other_lane
+        self.assertEqual(calls, [])
+
+        # Until the store is reset, as it is by connecting again.
+        store.failed = None
+        await store.lanes[1].submit(calls.append, "after reset")
+        self.assertEqual(calls, ["after reset"])
+
+    async def test_lanes_commit_after_reconnecting(self):
+        scratch_connection().conn.close()
+        store = Store(connection_args(), lanes=2)
+        self.addAsyncCleanup(store.close)
+        await store.connect()
+        await store.create_tables()
+        checker = PostgresConnection(**connection_args())
+        checker.connect()
+        self.addCleanup(lambda: checker.conn.close())
+
+        # Rids for both lanes, before and after reconnecting.
+        rids = ["2016032700{:02d}".format(n) for n in range(0, 16)]
+        before, after = rids[0::2], rids[1::2]
+        self.assertEqual(set(store.lanes.index(store.lane(rid)) for rid in after), {0, 1})
+        for rid in before:
+            await store.save_frame(schedule_frame(rid))
+
+        # Reconnecting after a failure, as AsyncClient has the listener do, with one lane's old
+        # connection broken and the other's still working.
+        broken = store.lane(after[0])
+        broken.connection.conn.close()
+        with self.assertRaises(Exception):
+            await store.save_frame(schedule_frame(after[0]))
+        await store.connect()
+
+        for rid in after:
+            await store.save_frame(schedule_frame(rid))
+        self.assertEqual(schedule_rids(checker), rids)
+
+
+if __name__ == "__main__":
+    unittest.main()
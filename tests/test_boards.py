@@ -0,0 +1,50 @@
+from darwindb.boards import Boards
+from darwindb.ingest import apply_frame
+from darwindb.stores import PostgresStore
+
+from postgres import connection_args, schedule_frame, scratch_connection
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+import datetime
+import unittest
+
+
+class BoardsTest(unittest.TestCase):
+
+    def setUp(self):
+        connection = scratch_connection()
+        self.addCleanup(lambda: connection.conn.close())
+        store = PostgresStore(connection)
+        store.create_tables()
+        for rid in ["201603270001", "201603270002", "201603270003"]:
+            apply_frame(store, schedule_frame(rid))
+
+        self.boards = Boards(connection_args(), itersize=1)
+        self.addCleanup(lambda: self.boards.connection.conn.close())
+        self.start = datetime.datetime(2016, 3, 27, 9)
+        self.end = datetime.datetime(2016, 3, 27, 12)
+
+    def transaction_status(self):
+        return self.boards.connection.conn.get_transaction_status()
+
+    def test_reading_to_the_end_ends_the_transaction(self):
+        calls = list(self.boards.departures("ORIGIN", self.start, self.end))
+        self.assertEqual([c.rid for c in calls], ["201603270001", "201603270002", "201603270003"])
+        self.assertEqual(self.transaction_status(), TRANSACTION_STATUS_IDLE)
+
+    def test_closing_a_board_part_way_through_ends_the_transaction(self):
+        first = self.boards.departures("ORIGIN", self.start, self.end)
+        second = self.boards.arrivals("DEST", self.start, self.end)
+        self.assertEqual(next(first).rid, "201603270001")
+        self.assertEqual(next(second).rid, "201603270001")
+
+        # Not until every board open on the connection is closed.
+        first.close()
+        self.assertEqual(self.transaction_status(), TRANSACTION_STATUS_INTRANS)
+        second.close()
+        self.assertEqual(self.transaction_status(), TRANSACTION_STATUS_IDLE)
+        self.assertEqual(self.boards.open_boards, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
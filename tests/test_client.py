@@ -0,0 +1,139 @@
+from darwindb.client import Client
+
+from unittest import mock
+
+import threading
+import time
+import unittest
+
+
+""" Stands in for stomp.py's connection, recording the acks sent on it. """
+class FakeConnection:
+
+    def __init__(self, hosts_and_ports, auto_decode=True):
+        self.listener = None
+        self.connected = False
+        self.acks = []
+
+    def set_listener(self, name, listener):
+        self.listener = listener
+
+    def start(self):
+        pass
+
+    def connect(self, user, password):
+        self.connected = True
+        self.listener.on_connected({}, b"")
+
+    def subscribe(self, destination, ack, id, headers):
+        pass
+
+    def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    def ack(self, message_id, subscription):
+        self.acks.append(message_id)
+
+    def deliver(self, *message_ids):
+        for message_id in message_ids:
+            self.listener.on_message({"message-id": message_id, "subscription": "1"}, b"")
+
+
+""" Acks every frame it's given, except that it raises the first time it's given any in fail. """
+class Listener:
+
+    def __init__(self, client, fail=(), unacked=()):
+        self.client = client
+        self.fail = set(fail)
+        self.unacked = set(unacked)
+        self.applied = []
+
+    def on_message(self, headers, message):
+        self.applied.append(headers["message-id"])
+        if headers["message-id"] in self.fail:
+            self.fail.remove(headers["message-id"])
+            raise RuntimeError("failed to apply {}".format(headers["message-id"]))
+        if headers["message-id"] not in self.unacked:
+            self.client.ack(headers)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+        def connection(*args, **kwargs):
+            self.connections.append(FakeConnection(*args, **kwargs))
+            return self.connections[-1]
+
+        patch = mock.patch("darwindb.client.StompConnection11", side_effect=connection)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def connect(self, listener_args={}, **kwargs):
+        client = Client()
+        listener = Listener(client, **listener_args)
+        client.connect("localhost", 61613, "user", "password", "/queue/test", listener, **kwargs)
+        return client, listener
+
+    def check_failure_does_not_block_later_acks(self, **kwargs):
+        client, listener = self.connect({"fail": ["2"]}, **kwargs)
+        self.connections[0].deliver("1", "2", "3", "4")
+
+        # The broker redelivers everything from the failed frame on to the new connection.
+        wait_for(lambda: len(self.connections) == 2 and self.connections[1].listener is not None)
+        wait_for(lambda: not client.reconnecting)
+        self.connections[1].deliver("2", "3", "4")
+        wait_for(lambda: "4" in self.connections[1].acks)
+
+        self.assertEqual(self.connections[0].acks, ["1"])
+        self.assertFalse(self.connections[0].connected)
+        # Nothing after the failed frame was applied before it.
+        self.assertEqual(listener.applied, ["1", "2", "2", "3", "4"])
+
+    def test_failure_does_not_block_later_acks(self):
+        self.check_failure_does_not_block_later_acks()
+
+    def test_failure_does_not_block_later_acks_when_queued(self):
+        self.check_failure_does_not_block_later_acks(queue_size=10)
+
+    def test_frame_left_uncommitted_times_out(self):
+        client, listener = self.connect({"unacked": ["1"]}, ack_timeout=0.2)
+        self.connections[0].deliver("1", "2")
+        self.assertEqual(self.connections[0].acks, [])
+
+        wait_for(lambda: len(self.connections) == 2)
+        self.assertFalse(self.connections[0].connected)
+
+    def test_held_back_ack_is_sent_after_max_ack_delay(self):
+        client, listener = self.connect({"unacked": ["1", "2"]}, ack_every=10, max_ack_delay=0.1, ack_timeout=None)
+        self.connections[0].deliver("1", "2")
+        client.ack({"message-id": "1", "subscription": "1"})
+        self.assertEqual(self.connections[0].acks, [])
+
+        wait_for(lambda: self.connections[0].acks == ["1"])
+
+    def test_acks_are_cumulative_and_in_order(self):
+        client, listener = self.connect({"unacked": ["1", "2", "3"]})
+        self.connections[0].deliver("1", "2", "3")
+
+        client.ack({"message-id": "2", "subscription": "1"})
+        client.ack({"message-id": "3", "subscription": "1"})
+        self.assertEqual(self.connections[0].acks, [])
+        client.ack({"message-id": "1", "subscription": "1"})
+        self.assertEqual(self.connections[0].acks, ["3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
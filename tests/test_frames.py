@@ -0,0 +1,74 @@
+from darwindb.frames import FrameReader, ijson, orjson
+
+import json
+import unittest
+
+
+keys = ["schedule_messages", "association_messages", "deactivated_messages", "train_status_messages"]
+
+frame = {
+    "message_type": "snapshot",
+    "schedule_messages": [
+        {"rid": "201603270001", "toc_code": "GW", "active": True, "deleted": False, "cancellation_reason": None,
+         "locations": [{"tiploc": "PADTON", "platform": {"number": "1", "suppressed": False}, "activity_codes": "TB"},
+                       {"tiploc": "RDNGSTN", "activity_codes": ""}]},
+        # Strings with brackets, quotes, escapes and characters outside ASCII in them.
+        {"rid": "201603270002", "toc_code": "X[\"}{,", "category": "a\\\"]é☃\U0001f682",
+         "locations": []},
+    ],
+    "association_messages": [],
+    "deactivated_messages": [{"rid": "201603270001"}, {"rid": "201603270003"}],
+    "train_status_messages": [{"rid": "201603270001", "delay": -1.5e3, "reverse_formation": False, "late": 12}],
+}
+
+
+class FrameReaderTest(unittest.TestCase):
+
+    def backends(self):
+        backends = ["json"]
+        if orjson is not None:
+            backends.append("orjson")
+        if ijson is not None:
+            backends.append("ijson")
+        return backends
+
+    def test_backends_decode_as_json_loads_does(self):
+        for separators in [(",", ":"), (", ", ": ")]:
+            data = json.dumps(frame, separators=separators, ensure_ascii=False).encode("utf-8")
+            for backend in self.backends():
+                with self.subTest(backend=backend, separators=separators):
+                    reader = FrameReader(data, backend)
+                    self.assertEqual(reader["message_type"], "snapshot")
+                    for key in keys:
+                        self.assertEqual(list(reader[key]), frame[key])
+
+    def test_lists_can_be_read_out_of_order(self):
+        data = json.dumps(frame, indent=2).encode("utf-8")
+        for backend in self.backends():
+            with self.subTest(backend=backend):
+                reader = FrameReader(data, backend)
+                self.assertEqual(list(reader["train_status_messages"]), frame["train_status_messages"])
+                self.assertEqual(list(reader["schedule_messages"]), frame["schedule_messages"])
+                self.assertEqual(reader["message_type"], "snapshot")
+
+    def test_lists_can_be_read_part_way_before_the_next(self):
+        data = json.dumps(frame).encode("utf-8")
+        for backend in self.backends():
+            with self.subTest(backend=backend):
+                reader = FrameReader(data, backend)
+                schedules = reader["schedule_messages"]
+                self.assertEqual(next(schedules), frame["schedule_messages"][0])
+                self.assertEqual(list(reader["deactivated_messages"]), frame["deactivated_messages"])
+
+    def test_picks_a_streaming_backend_when_one_is_installed(self):
+        backend = FrameReader(json.dumps(frame).encode("utf-8")).backend
+        if orjson is not None:
+            self.assertEqual(backend, "orjson")
+        elif ijson is not None:
+            self.assertEqual(backend, "ijson")
+        else:
+            self.assertEqual(backend, "json")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+from darwindb.ingest import ShardedIngest
+from darwindb.metrics import BufferedMetrics, PrometheusMetrics
+
+from unittest import mock
+
+import json
+import pickle
+import queue
+import threading
+import unittest
+
+
+class ShardedIngestTest(unittest.TestCase):
+
+    def test_frame_for_stopped_workers_is_dropped(self):
+        ingest = ShardedIngest(mock.Mock(), dict(host="localhost", dbname="darwin", user="darwin", password=""),
+                               workers=1)
+        # The worker's queue is full, as it is when a worker has died part way through.
+        tasks = queue.Queue(1)
+        tasks.put(None)
+        ingest.tasks = [tasks]
+
+        frame = {"message_type": "live", "schedule_messages": [], "association_messages": [],
+                 "deactivated_messages": [{"rid": "201603270001"}], "train_status_messages": []}
+        thread = threading.Thread(target=ingest.on_message,
+                                  args=({"message-id": "1", "subscription": "1"}, json.dumps(frame).encode("utf-8")))
+        thread.daemon = True
+        thread.start()
+
+        # New workers are started, and frames let through again, before the put gives up waiting.
+        ingest.tasks = [queue.Queue(1)]
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(ingest.tasks[0].empty())
+
+    def test_worker_metrics_are_replayed(self):
+        worker = BufferedMetrics()
+        worker.increment("darwindb_messages_total", type="schedule")
+        worker.increment("darwindb_messages_total", type="schedule")
+        worker.observe("darwindb_stage_seconds", 0.25, stage="execute", type="schedule")
+
+        # What a worker records goes back to the parent with each frame's result.
+        metrics = PrometheusMetrics()
+        BufferedMetrics.replay(pickle.loads(pickle.dumps(worker.drain())), metrics)
+        rendered = metrics.render()
+        self.assertIn('darwindb_messages_total{type="schedule"} 2', rendered)
+        self.assertIn('darwindb_stage_seconds_count{stage="execute",type="schedule"} 1', rendered)
+        self.assertEqual(worker.drain(), ({}, []))
+
+
+if __name__ == "__main__":
+    unittest.main()
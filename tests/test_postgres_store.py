@@ -0,0 +1,39 @@
+from darwindb.ingest import apply_frame
+from darwindb.stores import PostgresConnection, PostgresStore
+
+from postgres import connection_args, schedule_frame, schedule_rids, scratch_connection
+
+import unittest
+
+
+class PostgresStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = scratch_connection()
+        self.addCleanup(lambda: self.connection.conn.close())
+        self.store = PostgresStore(self.connection)
+        self.store.create_tables()
+        self.checker = PostgresConnection(**connection_args())
+        self.checker.connect()
+        self.addCleanup(lambda: self.checker.conn.close())
+
+    def test_writes_are_committed_after_reconnecting(self):
+        apply_frame(self.store, schedule_frame("201603270001"))
+        self.connection.connect()
+        apply_frame(self.store, schedule_frame("201603270002"))
+
+        self.assertEqual(schedule_rids(self.checker), ["201603270001", "201603270002"])
+
+    def test_reconnecting_recovers_from_a_broken_connection(self):
+        apply_frame(self.store, schedule_frame("201603270001"))
+        self.connection.conn.close()
+        with self.assertRaises(Exception):
+            apply_frame(self.store, schedule_frame("201603270002"))
+
+        self.connection.connect()
+        apply_frame(self.store, schedule_frame("201603270002"))
+        self.assertEqual(schedule_rids(self.checker), ["201603270001", "201603270002"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+from darwindb.utils import apply_date_and_tz_to_time, pytz_apply_date_and_tz_to_time
+from darwindb.utils import timezone_for_date_and_time, pytz_timezone_for_date_and_time
+from darwindb.utils import summer_time_transitions
+
+from datetime import datetime, time, timedelta
+from psycopg2.tz import FixedOffsetTimezone
+
+import pytz
+import random
+import unittest
+
+
+def random_time(rng):
+    return time(rng.randrange(24), rng.randrange(60), rng.choice([0, 0, 30]))
+
+
+def random_dated_time(rng, day):
+    # Dated times come back from the database in the session's time zone.
+    tzinfo = rng.choice([pytz.utc, FixedOffsetTimezone(offset=60), FixedOffsetTimezone(offset=-300)])
+    return datetime.combine(day, random_time(rng)).replace(tzinfo=tzinfo)
+
+
+""" Checks the table-driven timezone functions give exactly what the pytz versions do.
+
+They're checked on the edges of the day, and randomly chosen times, around every summer time
+change in the table. The random times come from a fixed seed, so any failure can be repeated.
+"""
+class TimezoneTest(unittest.TestCase):
+
+    samples = 50
+    edges = [time(0, 0), time(0, 59, 30), time(1, 0), time(1, 0, 30), time(23, 59, 30)]
+
+    def days(self):
+        for transition in summer_time_transitions:
+            for days in [-1, 0, 1]:
+                yield (transition + timedelta(days=days)).date()
+
+    def test_timezone_for_date_and_time(self):
+        rng = random.Random(20160327)
+        for day in self.days():
+            for t in self.edges + [random_time(rng) for _ in range(self.samples)]:
+                self.assertIs(timezone_for_date_and_time(day, t), pytz_timezone_for_date_and_time(day, t), (day, t))
+
+    def test_apply_date_and_tz_to_time(self):
+        rng = random.Random(20160328)
+        for day in self.days():
+            for t in self.edges + [random_time(rng) for _ in range(self.samples)]:
+                tz = timezone_for_date_and_time(day, t)
+                dated_time = random_dated_time(rng, day)
+                previous_time = rng.choice([dated_time.time(), random_time(rng)])
+                a = apply_date_and_tz_to_time(dated_time, tz, previous_time, t)
+                b = pytz_apply_date_and_tz_to_time(dated_time, tz, previous_time, t)
+                self.assertEqual(a, b, (dated_time, tz, previous_time, t))
+                self.assertIs(a.tzinfo, b.tzinfo, (dated_time, tz, previous_time, t))
+
+
+if __name__ == "__main__":
+    unittest.main()